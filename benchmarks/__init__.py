@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks
+    ~~~~~~~~~~
+
+    Benchmarks for the Flask-Security hot paths. Run a benchmark module from
+    the root of the repository, for example::
+
+        python -m benchmarks.mail_benchmarks
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+from __future__ import print_function
+
+import os
+import tempfile
+import timeit
+
+
+def _get_sqlalchemy_factory():
+    from tests.test_app.sqlalchemy import create_app
+    return create_app, {}
+
+
+def _get_mongoengine_factory():
+    import mongomock  # noqa
+    from tests.test_app.mongoengine import create_app
+    settings = dict(db='flask_security_bench', host='mongomock://localhost')
+    return create_app, {'MONGODB_SETTINGS': settings}
+
+
+def _get_peewee_factory():
+    from tests.test_app.peewee_app import create_app
+    fd, name = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    return create_app, {'DATABASE': {'name': name,
+                                     'engine': 'peewee.SqliteDatabase'}}
+
+
+#: The test applications the benchmarks can run against. The SQLAlchemy and
+#: Peewee applications use SQLite and the MongoEngine application uses
+#: mongomock so that no database server is needed.
+DATASTORES = {
+    'sqlalchemy': _get_sqlalchemy_factory,
+    'mongoengine': _get_mongoengine_factory,
+    'peewee': _get_peewee_factory,
+}
+
+
+def create_app(config=None, datastore='sqlalchemy', **kwargs):
+    """Creates a test application and populates its data. Raises
+    `ImportError` when the datastore's dependencies are not installed.
+
+    :param config: The configuration of the application
+    :param datastore: The name of one of the :data:`DATASTORES`
+    """
+    factory, defaults = DATASTORES[datastore]()
+    defaults.update(config or {})
+    app = factory(defaults, **kwargs)
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.test_client().get('/')
+    return app
+
+
+def bench(name, fn, number=1000, repeat=3):
+    """Times `fn` and prints the best time per call in microseconds.
+
+    :param name: The name of the benchmark
+    :param fn: The callable to time
+    :param number: The number of calls per run
+    :param repeat: The number of runs
+    """
+    per_call = min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+    print('%-60s %12.1f us' % (name, per_call * 1e6))
+    return per_call
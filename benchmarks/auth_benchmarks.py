@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.auth_benchmarks
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Measures the authentication hot paths per datastore and password hash
+    scheme::
+
+        python -m benchmarks.auth_benchmarks --output baseline.json
+        python -m benchmarks.auth_benchmarks --compare baseline.json
+
+    With ``--compare`` the command exits with a non-zero status if any
+    benchmark got slower than the baseline by more than ``--tolerance``.
+"""
+
+from __future__ import print_function
+
+import base64
+import itertools
+import json
+import optparse
+import platform
+import sys
+
+from passlib.exc import MissingBackendError
+
+from flask_security.forms import RegisterForm, TextField
+from flask_security.passwordless import generate_login_token
+from flask_security.utils import get_token_status
+
+from benchmarks import DATASTORES, bench, create_app
+
+
+#: The password hash schemes to benchmark and the number of calls per run of
+#: the benchmarks that hash a password
+HASH_SCHEMES = [
+    ('plaintext', 200),
+    ('sha512_crypt', 3),
+    ('pbkdf2_sha512', 10),
+    ('bcrypt', 3),
+]
+
+
+class BenchmarkRegisterForm(RegisterForm):
+    # the Peewee test application requires a username
+    username = TextField('Username')
+
+
+class SetupError(Exception):
+    """Raised when the application of a benchmark run can not be set up."""
+
+
+def setup(datastore, scheme):
+    """Returns the application to benchmark a datastore and password hash
+    scheme with. Raises :class:`SetupError` if it can not be created, for
+    example because a dependency is missing or rejects the configuration.
+    """
+    try:
+        return create_app({'SECURITY_PASSWORD_HASH': scheme,
+                           'SECURITY_PASSWORD_SALT': 'salty',
+                           'SECURITY_REGISTERABLE': True,
+                           'SECURITY_SEND_REGISTER_EMAIL': False},
+                          datastore=datastore, register_form=BenchmarkRegisterForm)
+    except Exception as e:
+        raise SetupError('%s: %s' % (type(e).__name__, e))
+
+
+def _json_login(client):
+    data = json.dumps(dict(email='matt@lp.com', password='password'))
+    return client.post('/login', data=data, content_type='application/json')
+
+
+def run(datastore, scheme, number):
+    """Runs the benchmarks against a datastore with a password hash scheme
+    and returns a dictionary of the seconds per call of each benchmark.
+    """
+    app = setup(datastore, scheme)
+    results = {}
+
+    def measure(name, fn, calls=200):
+        key = '%s/%s/%s' % (datastore, scheme, name)
+        results[key] = bench(key, fn, number=calls)
+
+    session_client = app.test_client()
+    session_client.post('/login', data=dict(email='matt@lp.com', password='password'))
+    measure('session_request', lambda: session_client.get('/profile'))
+
+    token = json.loads(_json_login(app.test_client()).data)['response']['user'][
+        'authentication_token']
+    token_client = app.test_client()
+    measure('token_request', lambda: token_client.get(
+        '/token', headers={'Authentication-Token': token}))
+
+    credentials = base64.b64encode(b'matt@lp.com:password').decode('ascii')
+    basic_client = app.test_client()
+    measure('basic_auth_request', lambda: basic_client.get(
+        '/http', headers={'Authorization': 'Basic ' + credentials}), number)
+
+    measure('json_login', lambda: _json_login(app.test_client()), number)
+
+    names = ('bench%d' % i for i in itertools.count())
+
+    def register():
+        name = next(names)
+        return app.test_client().post('/register', data=dict(
+            email=name + '@lp.com', username=name, password='password',
+            password_confirm='password'))
+
+    measure('register', register, number)
+
+    with app.test_request_context():
+        user = app.security.datastore.find_user(email='matt@lp.com')
+        login_token = generate_login_token(user)
+        measure('token_status', lambda: get_token_status(
+            login_token, 'login', 'LOGIN'))
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Prints the benchmarks that got slower than the baseline by more than
+    `tolerance` and returns their number.
+    """
+    regressions = 0
+    for name, seconds in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous and seconds > previous * (1 + tolerance):
+            regressions += 1
+            print('REGRESSION %-49s %+11.0f%%' % (name, (seconds / previous - 1) * 100))
+    return regressions
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--datastore', action='append', dest='datastores',
+                      help='benchmark only this datastore (repeatable)')
+    parser.add_option('--hash', action='append', dest='schemes',
+                      help='benchmark only this hash scheme (repeatable)')
+    parser.add_option('--output', help='write the results to this JSON file')
+    parser.add_option('--compare', help='compare with the results in this JSON file')
+    parser.add_option('--tolerance', type='float', default=0.1,
+                      help='the allowed slowdown when comparing [default: %default]')
+    options, args = parser.parse_args(argv)
+
+    print('Python %s on %s' % (platform.python_version(), platform.platform()))
+    results = {}
+    for datastore in options.datastores or sorted(DATASTORES):
+        for scheme, number in HASH_SCHEMES:
+            if options.schemes and scheme not in options.schemes:
+                continue
+            try:
+                results.update(run(datastore, scheme, number))
+            except (SetupError, MissingBackendError) as e:
+                print('Skipping %s/%s: %s' % (datastore, scheme, e))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            return 1 if compare(results, json.load(f), options.tolerance) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.mail_benchmarks
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Measures the cost of rendering security emails per message.
+"""
+
+from flask import render_template
+
+from flask_security.recoverable import generate_reset_password_token
+from flask_security.utils import render_mail, send_mail, url_for_security
+
+from benchmarks import bench, create_app
+
+
+def main():
+    for prerender in (False, True):
+        app = create_app({'SECURITY_RECOVERABLE': True,
+                          'SECURITY_EMAIL_PRERENDER': prerender})
+
+        with app.test_request_context():
+            user = app.security.datastore.find_user(email='matt@lp.com')
+            token = generate_reset_password_token(user)
+            link = url_for_security('reset_password', token=token, _external=True)
+            context = dict(user=user, reset_link=link, security=app.security)
+
+            if not prerender:
+                def render_uncompiled():
+                    for ext in ('txt', 'html'):
+                        render_template('security/email/reset_instructions.%s' % ext,
+                                        **context)
+                bench('render_template reset_instructions', render_uncompiled)
+
+            bench('render_mail reset_instructions (prerender=%s)' % prerender,
+                  lambda: render_mail('reset_instructions', dict(context),
+                                      ['user', 'reset_link']))
+            bench('send_mail reset_instructions (prerender=%s)' % prerender,
+                  lambda: send_mail('Reset', user.email, 'reset_instructions',
+                                    user=user, reset_link=link))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.token_benchmarks
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Measures the cost of generating and verifying confirmation, reset
+    password and login tokens.
+"""
+
+from flask_security.confirmable import confirm_email_token_status, \
+    generate_confirmation_token
+from flask_security.passwordless import generate_login_token, \
+    login_token_status
+from flask_security.recoverable import generate_reset_password_token, \
+    reset_password_token_status
+from flask_security.utils import get_max_age
+
+from benchmarks import bench, create_app
+
+
+def main():
+    app = create_app({'SECURITY_CONFIRMABLE': True,
+                      'SECURITY_RECOVERABLE': True})
+    # the configuration is only checked for changes in testing mode
+    app.testing = False
+
+    with app.test_request_context():
+        user = app.security.datastore.find_user(email='matt@lp.com')
+        serializer = app.security.login_serializer
+        token = serializer.dumps([str(user.id)])
+
+        bench('get_max_age', lambda: get_max_age('LOGIN'), number=10000)
+        bench('login serializer loads', lambda: serializer.loads(token), number=10000)
+
+        for name, generate, status in [
+                ('confirm', generate_confirmation_token, confirm_email_token_status),
+                ('reset', generate_reset_password_token, reset_password_token_status),
+                ('login', generate_login_token, login_token_status)]:
+            token = generate(user)
+            bench('%s token generation' % name, lambda: generate(user))
+            bench('%s token status' % name, lambda: status(token))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,8 @@
 __version__ = '1.7.1'
 
 from .core import Security, RoleMixin, UserMixin, AnonymousUser, current_user
-from .datastore import SQLAlchemyUserDatastore, MongoEngineUserDatastore, PeeweeUserDatastore
+from .datastore import SQLAlchemyUserDatastore, MongoEngineUserDatastore, \
+    PeeweeUserDatastore, CachedUserDatastore
 from .decorators import auth_token_required, http_auth_required, \
      login_required, roles_accepted, roles_required, auth_required
 from .forms import ForgotPasswordForm, LoginForm, RegisterForm, \
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.security.cache
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Flask-Security cache module
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import time
+
+from threading import Lock
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+class LRUCache(object):
+    """A bounded in-process cache with per-item expiry. Once `threshold`
+    items are stored the least recently used item is discarded.
+
+    The interface mirrors the caches found in ``werkzeug.contrib.cache`` so a
+    ``RedisCache`` or ``MemcachedCache`` can be used wherever Flask-Security
+    accepts a cache.
+
+    :param threshold: The maximum number of items to store
+    :param default_timeout: The number of seconds an item is kept when no
+                            timeout is given. ``0`` keeps items forever.
+    """
+
+    def __init__(self, threshold=500, default_timeout=300):
+        self._items = OrderedDict()
+        self._lock = Lock()
+        self.threshold = threshold
+        self.default_timeout = default_timeout
+
+    def _get_expiry(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        return time.time() + timeout if timeout else 0
+
+    def _store(self, key, expires, value):
+        self._items[key] = (expires, value)
+        while len(self._items) > self.threshold:
+            self._items.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._items.pop(key)
+            except KeyError:
+                return None
+            if expires and expires <= time.time():
+                return None
+            self._items[key] = (expires, value)
+            return value
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._items.pop(key, None)
+            self._store(key, self._get_expiry(timeout), value)
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if key in self._items:
+                expires = self._items[key][0]
+                if not expires or expires > time.time():
+                    return False
+                del self._items[key]
+            self._store(key, self._get_expiry(timeout), value)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._items.pop(key, None) is not None
+
+    def inc(self, key, delta=1):
+        with self._lock:
+            expires, value = self._items.pop(key, (0, None))
+            if expires and expires <= time.time():
+                expires, value = 0, None
+            if value is None:
+                expires = self._get_expiry(None)
+            value = (value or 0) + delta
+            self._store(key, expires, value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+        return True
+
+    def __len__(self):
+        return len(self._items)
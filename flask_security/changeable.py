@@ -10,11 +10,12 @@
     :license: MIT, see LICENSE for more details.
 """
 
-from flask import current_app as app
+from flask import current_app as app, session
 from werkzeug.local import LocalProxy
 
 from .signals import password_changed
-from .utils import send_mail, encrypt_password, config_value
+from .utils import send_mail, encrypt_password, config_value, \
+    invalidate_token_cache, _store_session_snapshot
 
 
 # Convenient references
@@ -41,5 +42,9 @@ def change_user_password(user, password):
     """
     user.password = encrypt_password(password)
     _datastore.put(user)
+    invalidate_token_cache(user)
+    if _security.lazy_user and str(session.get('user_id')) == str(user.id):
+        # keep the session the password was changed in
+        _store_session_snapshot(user)
     send_password_changed_notice(user)
     password_changed.send(user, app=app._get_current_object())
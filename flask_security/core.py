@@ -9,17 +9,34 @@
     :license: MIT, see LICENSE for more details.
 """
 
-from flask import current_app, render_template
+import time
+
+from flask import current_app, render_template, request, jsonify, Response, \
+    session
 from flask.ext.login import AnonymousUserMixin, UserMixin as BaseUserMixin, \
     LoginManager, current_user
 from flask.ext.principal import Principal, RoleNeed, UserNeed, Identity, \
     identity_loaded
-from itsdangerous import URLSafeTimedSerializer
+from itsdangerous import URLSafeTimedSerializer, TimestampSigner
 from passlib.context import CryptContext
-from werkzeug.datastructures import ImmutableList
+from werkzeug.datastructures import ImmutableList, ImmutableDict
 from werkzeug.local import LocalProxy
 
-from .utils import config_value as cv, get_config, md5, url_for_security, string_types
+from .cache import LRUCache
+from .hashing import HashingExecutor, HashingPoolFull
+from .mail import MailDispatcher
+from .metrics import MetricsCollector, MeteredUserDatastore, record_cache, \
+    timer, start_request, end_request
+from .revocation import MemoryRevocationStore, RevocationList
+from .session import SessionSerializer, CompactCookieSessionInterface, \
+    MemorySessionStore, ServerSessionInterface
+from .throttling import LoginThrottle, LoginThrottled
+from .trackable import LoginTracker
+from .utils import config_value as cv, get_config, md5, url_for_security, \
+    string_types, get_role_names, compile_mail_templates, get_message, \
+    is_token_revoked, get_within_delta, _get_user_snapshot, \
+    _store_session_snapshot, _get_cached_role_version, _SESSION_USER_KEY, \
+    _ROLE_NAMES_ATTR
 from .views import create_blueprint
 from .forms import LoginForm, ConfirmRegisterForm, RegisterForm, \
     ForgotPasswordForm, ChangePasswordForm, ResetPasswordForm, \
@@ -58,6 +75,7 @@ _default_config = {
     'CHANGE_PASSWORD_TEMPLATE': 'security/change_password.html',
     'SEND_CONFIRMATION_TEMPLATE': 'security/send_confirmation.html',
     'SEND_LOGIN_TEMPLATE': 'security/send_login.html',
+    'LOGIN_THROTTLED_TEMPLATE': 'security/login_throttled.html',
     'CONFIRMABLE': False,
     'REGISTERABLE': False,
     'RECOVERABLE': False,
@@ -74,6 +92,7 @@ _default_config = {
     'EMAIL_SENDER': 'no-reply@localhost',
     'TOKEN_AUTHENTICATION_KEY': 'auth_token',
     'TOKEN_AUTHENTICATION_HEADER': 'Authentication-Token',
+    'TOKEN_AUTHENTICATION_JSON': False,
     'CONFIRM_SALT': 'confirm-salt',
     'RESET_SALT': 'reset-salt',
     'LOGIN_SALT': 'login-salt',
@@ -87,7 +106,40 @@ _default_config = {
     'EMAIL_SUBJECT_PASSWORD_NOTICE': 'Your password has been reset',
     'EMAIL_SUBJECT_PASSWORD_CHANGE_NOTICE': 'Your password has been changed',
     'EMAIL_SUBJECT_PASSWORD_RESET': 'Password reset instructions',
-    'USER_IDENTITY_ATTRIBUTES': ['email']
+    'USER_IDENTITY_ATTRIBUTES': ['email'],
+    'HTTP_AUTH_CACHE_SIZE': 0,
+    'HTTP_AUTH_CACHE_TIMEOUT': 60,
+    'TOKEN_MAX_AGE': None,
+    'TOKEN_CACHE_SIZE': 0,
+    'TOKEN_CACHE_TIMEOUT': 300,
+    'ROLE_CACHE_SIZE': 0,
+    'ROLE_CACHE_TIMEOUT': 300,
+    'ASYNC_MAIL': False,
+    'ASYNC_MAIL_WORKERS': 1,
+    'ASYNC_MAIL_QUEUE_SIZE': 1000,
+    'ASYNC_MAIL_BATCH_SIZE': 50,
+    'ASYNC_MAIL_RETRIES': 3,
+    'EMAIL_PRERENDER': False,
+    'TRACKABLE_WRITE_BEHIND': False,
+    'TRACKABLE_BATCH_SIZE': 500,
+    'TRACKABLE_MAX_STALENESS': 5,
+    'HASHING_WORKERS': 0,
+    'HASHING_QUEUE_SIZE': 100,
+    'METRICS': False,
+    'LOGIN_THROTTLE': False,
+    'LOGIN_THROTTLE_IP_LIMIT': 50,
+    'LOGIN_THROTTLE_IDENTITY_LIMIT': 10,
+    'LOGIN_THROTTLE_WINDOW': 300,
+    'LOGIN_THROTTLE_CACHE_SIZE': 10000,
+    'TOKEN_REVOCATION': False,
+    'TOKEN_REVOCATION_CAPACITY': 100000,
+    'TOKEN_REVOCATION_ERROR_RATE': 0.001,
+    'TOKEN_REVOCATION_REFRESH': 1,
+    'LAZY_USER': False,
+    'LAZY_USER_TTL': 300,
+    'SESSION_FORMAT': 'default',
+    'SERVER_SESSION': False,
+    'SERVER_SESSION_SWEEP_INTERVAL': 60
 }
 
 #: Default Flask-Security messages
@@ -117,6 +169,7 @@ _default_messages = {
     'PASSWORD_NOT_SET': ('No password is set for this user', 'error'),
     'PASSWORD_INVALID_LENGTH': ('Password must be at least 6 characters', 'error'),
     'USER_DOES_NOT_EXIST': ('Specified user does not exist', 'error'),
+    'ROLE_DOES_NOT_EXIST': ('Role %(role)s does not exist', 'error'),
     'INVALID_PASSWORD': ('Invalid password', 'error'),
     'PASSWORDLESS_LOGIN_SUCCESSFUL': ('You have successfuly logged in.', 'success'),
     'PASSWORD_RESET': ('You successfully reset your password and you have been logged in automatically.', 'success'),
@@ -124,6 +177,8 @@ _default_messages = {
     'PASSWORD_CHANGE': ('You successfully changed your password.', 'success'),
     'LOGIN': ('Please log in to access this page.', 'info'),
     'REFRESH': ('Please reauthenticate to access this page.', 'info'),
+    'HASHING_POOL_FULL': ('The server is busy, please try again shortly.', 'error'),
+    'LOGIN_THROTTLED': ('Too many login attempts. Please try again in %(retry_after)s seconds.', 'error'),
 }
 
 _allowed_password_hash_schemes = [
@@ -150,32 +205,119 @@ _default_forms = {
 
 
 def _user_loader(user_id):
-    return _security.datastore.find_user(id=user_id)
+    if not _security.lazy_user:
+        return _security.datastore.find_user(id=user_id)
+    snapshot = _security.session_serializer.loads(session.get(_SESSION_USER_KEY))
+    if snapshot is not None and str(snapshot['id']) != str(user_id):
+        snapshot = None
+    if snapshot is not None and snapshot['expires'] > time.time() and \
+            _is_role_version_current(snapshot):
+        if 'roles' in snapshot:
+            snapshot = dict(snapshot, roles=frozenset(snapshot['roles']))
+        return _CachedUser(snapshot)
+    user = _security.datastore.find_user(id=user_id)
+    if user is None:
+        return None
+    if snapshot is not None and \
+            not md5(user.password).startswith(snapshot['fingerprint']):
+        # the password changed since the snapshot was taken
+        return None
+    _store_session_snapshot(user)
+    return user
+
+
+def _is_role_version_current(snapshot):
+    if _security.role_cache is None:
+        return True
+    # a version missing from the cache, for example after an eviction or in
+    # another process, is seeded from the snapshot instead of refreshing it
+    seed = snapshot.get('role_version')
+    return _get_cached_role_version(snapshot['id'], seed) == seed
 
 
 def _token_loader(token):
+    with timer('token_loader'):
+        return _load_token_user(token)
+
+
+def _load_token_user(token):
     try:
-        data = _security.remember_token_serializer.loads(token)
+        data, issued_at = _security.remember_token_serializer.loads(
+            token, max_age=_security.token_max_age, return_timestamp=True)
+        if is_token_revoked(token, data[0], issued_at):
+            return AnonymousUser()
+        cache = _security.token_cache
+        if cache is not None:
+            snapshot = cache.get(data[0])
+            hit = snapshot is not None and snapshot['fingerprint'] == data[1]
+            record_cache('token', hit)
+            if hit:
+                if not snapshot['active']:
+                    return AnonymousUser()
+                return _CachedUser(snapshot)
         user = _security.datastore.find_user(id=data[0])
-        if user and md5(user.password) == data[1]:
+        if user and md5(user.password) == data[1] and user.is_active():
+            if cache is not None:
+                cache.set(data[0], _get_user_snapshot(user))
             return user
     except:
         pass
     return AnonymousUser()
 
 
+def _get_role_names(user):
+    if isinstance(user, AnonymousUser):
+        return user.roles
+    if isinstance(user, _CachedUser) and _security.role_cache is None and \
+            'roles' in user._snapshot:
+        return user._snapshot['roles']
+    return get_role_names(user)
+
+
+def _get_role_name(role):
+    if isinstance(role, string_types):
+        return role
+    return role.name
+
+
 def _identity_loader():
     if not isinstance(current_user._get_current_object(), AnonymousUser):
         identity = Identity(current_user.id)
         return identity
 
 
+def _on_hashing_pool_full(error):
+    message = get_message('HASHING_POOL_FULL')[0]
+    if request.json:
+        response = jsonify(dict(meta=dict(code=503),
+                                response=dict(errors=dict(password=[message]))))
+        response.status_code = 503
+    else:
+        response = Response(message, 503)
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+def _on_login_throttled(error):
+    message = get_message('LOGIN_THROTTLED', retry_after=error.retry_after)[0]
+    if request.json:
+        response = jsonify(dict(meta=dict(code=429),
+                                response=dict(errors=dict(email=[message]))))
+    else:
+        response = _security.render_template(cv('LOGIN_THROTTLED_TEMPLATE'),
+                                             message=message)
+        response = current_app.make_response(response)
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
 def _on_identity_loaded(sender, identity):
     if hasattr(current_user, 'id'):
         identity.provides.add(UserNeed(current_user.id))
 
-    for role in current_user.roles:
-        identity.provides.add(RoleNeed(role.name))
+    for role_name in _get_role_names(current_user._get_current_object()):
+        identity.provides.add(RoleNeed(role_name))
 
     identity.user = current_user
 
@@ -212,18 +354,161 @@ def _get_pwd_context(app):
     return CryptContext(schemes=_allowed_password_hash_schemes, default=pw_hash)
 
 
+class _KeyedSigner(TimestampSigner):
+    """A timestamp signer that derives its key once instead of on every
+    signature."""
+
+    def __init__(self, *args, **kwargs):
+        super(_KeyedSigner, self).__init__(*args, **kwargs)
+        self._key = super(_KeyedSigner, self).derive_key()
+
+    def derive_key(self, *args, **kwargs):
+        return self._key
+
+
+class _Serializer(URLSafeTimedSerializer):
+    """A serializer that reuses a single signer for its own salt."""
+
+    default_signer = _KeyedSigner
+
+    def __init__(self, *args, **kwargs):
+        super(_Serializer, self).__init__(*args, **kwargs)
+        self._signer = super(_Serializer, self).make_signer()
+
+    def make_signer(self, salt=None):
+        if salt is None or salt == self.salt:
+            return self._signer
+        return super(_Serializer, self).make_signer(salt)
+
+
 def _get_serializer(app, name):
     secret_key = app.config.get('SECRET_KEY')
     salt = app.config.get('SECURITY_%s_SALT' % name.upper())
-    return URLSafeTimedSerializer(secret_key=secret_key, salt=salt)
+    return _Serializer(secret_key=secret_key, salt=salt)
+
+
+def _get_session_serializer(app, serializer, role_cache):
+    if serializer is not None:
+        return serializer
+    session_format = cv('SESSION_FORMAT', app=app)
+    if session_format == 'default':
+        return SessionSerializer()
+    if session_format == 'compact':
+        if role_cache is None:
+            # compact sessions leave the role names to the role cache
+            raise ValueError("The 'compact' session format requires a role "
+                             "cache. Set SECURITY_ROLE_CACHE_SIZE or pass a "
+                             "role_cache")
+        return SessionSerializer()
+    raise ValueError('Invalid session format %r. Allowed values are '
+                     "'default' and 'compact'" % session_format)
+
+
+def _get_session_interface(app, store):
+    if not cv('SERVER_SESSION', app=app):
+        return None
+    if store is None:
+        store = MemorySessionStore()
+    return ServerSessionInterface(
+        store, sweep_interval=cv('SERVER_SESSION_SWEEP_INTERVAL', app=app))
+
+
+def _get_max_ages(app):
+    rv = {}
+    for key in ('LOGIN', 'CONFIRM_EMAIL', 'RESET_PASSWORD'):
+        td = get_within_delta(key + '_WITHIN', app)
+        rv[key] = td.seconds + td.days * 24 * 3600
+    return rv
+
+
+def _get_cache(app, name):
+    size = cv('%s_CACHE_SIZE' % name, app=app)
+    if not size:
+        return None
+    return LRUCache(threshold=size,
+                    default_timeout=cv('%s_CACHE_TIMEOUT' % name, app=app))
+
+
+def _get_mail_dispatcher(app):
+    if not cv('ASYNC_MAIL', app=app):
+        return None
+    return MailDispatcher(app,
+                          workers=cv('ASYNC_MAIL_WORKERS', app=app),
+                          queue_size=cv('ASYNC_MAIL_QUEUE_SIZE', app=app),
+                          batch_size=cv('ASYNC_MAIL_BATCH_SIZE', app=app),
+                          retries=cv('ASYNC_MAIL_RETRIES', app=app))
+
+
+def _get_login_tracker(app):
+    if not (cv('TRACKABLE', app=app) and cv('TRACKABLE_WRITE_BEHIND', app=app)):
+        return None
+    return LoginTracker(app,
+                        batch_size=cv('TRACKABLE_BATCH_SIZE', app=app),
+                        max_staleness=cv('TRACKABLE_MAX_STALENESS', app=app))
+
+
+def _get_hashing_executor(app):
+    workers = cv('HASHING_WORKERS', app=app)
+    if not workers:
+        return None
+    return HashingExecutor(workers, queue_size=cv('HASHING_QUEUE_SIZE', app=app))
+
+
+def _get_login_throttle(app, cache):
+    if not cv('LOGIN_THROTTLE', app=app):
+        return None
+    if cache is None:
+        cache = LRUCache(threshold=cv('LOGIN_THROTTLE_CACHE_SIZE', app=app),
+                         default_timeout=0)
+    return LoginThrottle(cache,
+                         ip_limit=cv('LOGIN_THROTTLE_IP_LIMIT', app=app),
+                         identity_limit=cv('LOGIN_THROTTLE_IDENTITY_LIMIT', app=app),
+                         window=cv('LOGIN_THROTTLE_WINDOW', app=app))
+
+
+def _get_revocation_list(app, store, max_ages):
+    if not cv('TOKEN_REVOCATION', app=app):
+        return None
+    # revocations are kept until every token they can revoke has expired
+    max_age = cv('TOKEN_MAX_AGE', app=app)
+    if max_age is not None:
+        max_age = max([max_age] + list(max_ages.values()))
+    return RevocationList(
+        store if store is not None else MemoryRevocationStore(),
+        capacity=cv('TOKEN_REVOCATION_CAPACITY', app=app),
+        error_rate=cv('TOKEN_REVOCATION_ERROR_RATE', app=app),
+        refresh_interval=cv('TOKEN_REVOCATION_REFRESH', app=app),
+        max_age=max_age)
+
+
+def _get_metrics_collector(app, collector, hashing_executor):
+    if collector is None and cv('METRICS', app=app):
+        collector = MetricsCollector()
+    if collector is not None and hashing_executor is not None:
+        collector.register_gauges('hashing', lambda: hashing_executor.metrics)
+    return collector
 
 
 def _get_state(app, datastore, **kwargs):
     for key, value in get_config(app).items():
         kwargs[key.lower()] = value
 
+    if kwargs.get('token_cache') is None:
+        kwargs['token_cache'] = _get_cache(app, 'TOKEN')
+
+    if kwargs.get('role_cache') is None:
+        kwargs['role_cache'] = _get_cache(app, 'ROLE')
+
+    hashing_executor = _get_hashing_executor(app)
+    max_ages = _get_max_ages(app)
+    collector = _get_metrics_collector(
+        app, kwargs.get('metrics_collector'), hashing_executor)
+    if collector is not None:
+        datastore = MeteredUserDatastore(datastore, collector)
+
     kwargs.update(dict(
         app=app,
+        config=ImmutableDict(get_config(app)),
         datastore=datastore,
         login_manager=_get_login_manager(app),
         principal=_get_principal(app),
@@ -232,7 +517,21 @@ def _get_state(app, datastore, **kwargs):
         login_serializer=_get_serializer(app, 'login'),
         reset_serializer=_get_serializer(app, 'reset'),
         confirm_serializer=_get_serializer(app, 'confirm'),
+        max_ages=max_ages,
+        session_serializer=_get_session_serializer(
+            app, kwargs.get('session_serializer'), kwargs['role_cache']),
+        session_interface=_get_session_interface(app, kwargs.get('session_store')),
+        http_auth_cache=_get_cache(app, 'HTTP_AUTH'),
+        mail_dispatcher=_get_mail_dispatcher(app),
+        login_tracker=_get_login_tracker(app),
+        hashing_executor=hashing_executor,
+        metrics_collector=collector,
+        login_throttler=_get_login_throttle(app, kwargs.get('throttle_cache')),
+        revocation_list=_get_revocation_list(
+            app, kwargs.get('revocation_store'), max_ages),
         _context_processors={},
+        _compiled_mail={},
+        _prerendered_mail={},
         _send_mail_task=None
     ))
 
@@ -257,6 +556,9 @@ class RoleMixin(object):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def __hash__(self):
+        return hash(self.name)
+
 
 class UserMixin(BaseUserMixin):
     """Mixin for `User` model definitions"""
@@ -274,10 +576,63 @@ class UserMixin(BaseUserMixin):
         """Returns `True` if the user identifies with the specified role.
 
         :param role: A role name or `Role` instance"""
-        if isinstance(role, string_types):
-            return role in (role.name for role in self.roles)
-        else:
-            return role in self.roles
+        return _get_role_name(role) in self._get_role_names()
+
+    def has_any_role(self, *roles):
+        """Returns `True` if the user identifies with at least one of the
+        specified roles.
+
+        :param roles: Role names or `Role` instances"""
+        return not self._get_role_names().isdisjoint(map(_get_role_name, roles))
+
+    def has_all_roles(self, *roles):
+        """Returns `True` if the user identifies with all of the specified
+        roles.
+
+        :param roles: Role names or `Role` instances"""
+        return self._get_role_names().issuperset(map(_get_role_name, roles))
+
+    def _get_role_names(self):
+        # kept on the instance, which is loaded once per request, until the
+        # datastore changes the user's roles
+        names = self.__dict__.get(_ROLE_NAMES_ATTR)
+        if names is None:
+            names = frozenset(role.name for role in self.roles)
+            self.__dict__[_ROLE_NAMES_ATTR] = names
+        return names
+
+
+class _CachedUser(BaseUserMixin):
+    """Stands in for a user that was authorized from the token cache. The
+    user is loaded from the datastore the first time an attribute that is not
+    part of the cached snapshot is accessed.
+    """
+
+    def __init__(self, snapshot):
+        self.__dict__.update(_snapshot=snapshot, _user=None, id=snapshot['id'])
+
+    def is_active(self):
+        return self._snapshot['active']
+
+    def has_role(self, role):
+        return _get_role_name(role) in _get_role_names(self)
+
+    def has_any_role(self, *roles):
+        return not _get_role_names(self).isdisjoint(map(_get_role_name, roles))
+
+    def has_all_roles(self, *roles):
+        return _get_role_names(self).issuperset(map(_get_role_name, roles))
+
+    def _get_user(self):
+        if self._user is None:
+            self.__dict__['_user'] = _security.datastore.find_user(id=self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        return getattr(self._get_user(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_user(), name, value)
 
 
 class AnonymousUser(AnonymousUserMixin):
@@ -290,6 +645,14 @@ class AnonymousUser(AnonymousUserMixin):
         """Returns `False`"""
         return False
 
+    def has_any_role(self, *args):
+        """Returns `False`"""
+        return False
+
+    def has_all_roles(self, *args):
+        """Returns `False`"""
+        return False
+
 
 class _SecurityState(object):
 
@@ -297,6 +660,17 @@ class _SecurityState(object):
         for key, value in kwargs.items():
             setattr(self, key.lower(), value)
 
+    def refresh_config(self):
+        """Rebuilds the snapshot of the ``SECURITY_`` configuration values.
+        Call this after changing configuration values at runtime. Values that
+        are consumed during initialization, such as URLs, salts and the
+        password hash scheme, are not affected.
+        """
+        self.config = ImmutableDict(get_config(self.app))
+        for key, value in self.config.items():
+            setattr(self, key.lower(), value)
+        self.max_ages = _get_max_ages(self.app)
+
     def _add_ctx_processor(self, endpoint, fn):
         group = self._context_processors.setdefault(endpoint, [])
         fn not in group and group.append(fn)
@@ -356,13 +730,48 @@ class Security(object):
                  login_form=None, confirm_register_form=None,
                  register_form=None, forgot_password_form=None,
                  reset_password_form=None, change_password_form=None,
-                 send_confirmation_form=None, passwordless_login_form=None):
+                 send_confirmation_form=None, passwordless_login_form=None,
+                 token_cache=None, metrics_collector=None, throttle_cache=None,
+                 revocation_store=None, session_serializer=None,
+                 session_store=None, role_cache=None):
         """Initializes the Flask-Security extension for the specified
         application and datastore implentation.
 
         :param app: The application.
         :param datastore: An instance of a user datastore.
         :param register_blueprint: to register the Security blueprint or not.
+        :param token_cache: An optional cache for authentication token
+                            snapshots. Defaults to an in-process cache when
+                            ``SECURITY_TOKEN_CACHE_SIZE`` is set.
+        :param metrics_collector: An optional
+                                  :class:`~flask_security.metrics.MetricsCollector`.
+                                  Defaults to an in-memory collector when
+                                  ``SECURITY_METRICS`` is enabled.
+        :param throttle_cache: An optional cache for the login throttling
+                               counters. Defaults to an in-process cache
+                               when ``SECURITY_LOGIN_THROTTLE`` is enabled.
+        :param revocation_store: An optional store for revoked tokens, such
+                                 as a
+                                 :class:`~flask_security.revocation.SQLRevocationStore`
+                                 shared by several processes. Defaults to
+                                 an in-process store when
+                                 ``SECURITY_TOKEN_REVOCATION`` is enabled.
+        :param session_serializer: An optional
+                                   :class:`~flask_security.session.SessionSerializer`
+                                   for the session snapshot of the logged in
+                                   user. Defaults to a
+                                   :class:`~flask_security.session.SessionSerializer`.
+        :param session_store: An optional store for server-side sessions,
+                              such as a
+                              :class:`~flask_security.session.SQLSessionStore`
+                              or a ``redis.StrictRedis`` client. Defaults to
+                              an in-process store when
+                              ``SECURITY_SERVER_SESSION`` is enabled.
+        :param role_cache: An optional cache for the role names and role
+                           versions of users, such as a ``RedisCache``
+                           shared by several processes. Defaults to an
+                           in-process cache when ``SECURITY_ROLE_CACHE_SIZE``
+                           is set.
         """
         datastore = datastore or self.datastore
 
@@ -382,14 +791,38 @@ class Security(object):
                            reset_password_form=reset_password_form,
                            change_password_form=change_password_form,
                            send_confirmation_form=send_confirmation_form,
-                           passwordless_login_form=passwordless_login_form)
+                           passwordless_login_form=passwordless_login_form,
+                           token_cache=token_cache,
+                           metrics_collector=metrics_collector,
+                           throttle_cache=throttle_cache,
+                           revocation_store=revocation_store,
+                           session_serializer=session_serializer,
+                           session_store=session_store,
+                           role_cache=role_cache)
 
         if register_blueprint:
             app.register_blueprint(create_blueprint(state, __name__))
             app.context_processor(_context_processor)
 
+        if state.hashing_executor is not None:
+            app.errorhandler(HashingPoolFull)(_on_hashing_pool_full)
+
+        if state.login_throttler is not None:
+            app.errorhandler(LoginThrottled)(_on_login_throttled)
+
+        if state.session_interface is not None:
+            app.session_interface = state.session_interface
+        elif state.session_format == 'compact':
+            app.session_interface = CompactCookieSessionInterface()
+
+        if state.metrics_collector is not None:
+            app.before_request(lambda: start_request(state.metrics_collector))
+            app.teardown_request(
+                lambda exc: end_request(state.metrics_collector))
+
         state.render_template = self.render_template
         app.extensions['security'] = state
+        app.before_first_request(lambda: compile_mail_templates(app))
 
         return state
 
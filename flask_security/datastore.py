@@ -9,7 +9,28 @@
     :license: MIT, see LICENSE for more details.
 """
 
-from .utils import get_identity_attributes, string_types
+import hashlib
+import threading
+
+from io import BytesIO
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from flask.ext.login import UserMixin as BaseUserMixin
+
+from .cache import LRUCache
+from .metrics import record_cache
+from .utils import get_identity_attributes, invalidate_role_cache, \
+    invalidate_token_cache, string_types, _forget_role_names
+
+
+def _chunks(items, size=500):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 
 class Datastore(object):
@@ -74,6 +95,51 @@ class UserDatastore(object):
             role = self.find_role(role)
         return user, role
 
+    def _prepare_role(self, role):
+        if isinstance(role, string_types):
+            role = self.find_role(role)
+        return role
+
+    def _get_user_ids(self, users):
+        ids, emails = set(), []
+        for user in users:
+            if isinstance(user, string_types):
+                emails.append(user)
+            else:
+                # the roles of the user are about to change
+                _forget_role_names(user)
+                ids.add(user.id)
+        for chunk in _chunks(emails):
+            ids.update(self._find_user_ids(chunk))
+        return ids
+
+    def _find_user_ids(self, emails):
+        raise NotImplementedError
+
+    def find_existing_emails(self, emails):
+        """Returns the set of the given email addresses that belong to
+        users, looked up with one query per chunk of addresses.
+
+        :param emails: The email addresses to look up
+        """
+        rv = set()
+        for chunk in _chunks(set(emails)):
+            rv.update(self._find_user_emails(chunk))
+        return rv
+
+    def _find_user_emails(self, emails):
+        raise NotImplementedError
+
+    def _roles_changed(self, user_ids):
+        for user_id in user_ids:
+            invalidate_role_cache(user_id)
+
+    def _detach_user(self, user):
+        return user
+
+    def _attach_user(self, user):
+        return user
+
     def _prepare_create_user_args(self, **kwargs):
         kwargs.setdefault('active', True)
         roles = kwargs.get('roles', [])
@@ -84,14 +150,54 @@ class UserDatastore(object):
         kwargs['roles'] = roles
         return kwargs
 
+    def _prepare_create_users_args(self, users):
+        roles = {}
+        for kwargs in users:
+            kwargs = dict(kwargs)
+            kwargs.setdefault('active', True)
+            names = [role.name if isinstance(role, self.role_model) else role
+                     for role in kwargs.get('roles', [])]
+            for name in names:
+                if name not in roles:
+                    roles[name] = self.find_role(name)
+            kwargs['roles'] = [roles[name] for name in names]
+            yield kwargs
+
     def get_user(self, id_or_email):
         """Returns a user matching the specified ID or email address"""
         raise NotImplementedError
 
+    def _select_identity_match(self, users, identifier):
+        # several users may match on different attributes, the first
+        # configured identity attribute takes precedence
+        value = identifier.lower()
+        for attr in get_identity_attributes():
+            for user in users:
+                if (getattr(user, attr, None) or '').lower() == value:
+                    return user
+
     def find_user(self, *args, **kwargs):
         """Returns a user matching the provided parameters."""
         raise NotImplementedError
 
+    def find_users(self, **kwargs):
+        """Returns a list of the users matching the provided parameters
+        with their roles loaded."""
+        raise NotImplementedError
+
+    def find_users_by_id(self, ids):
+        """Returns a dictionary of the users with the specified IDs, keyed by
+        the string form of their IDs. IDs without a user are left out.
+
+        :param ids: The IDs of the users
+        """
+        rv = {}
+        for user_id in set(ids):
+            user = self.find_user(id=user_id)
+            if user is not None:
+                rv[str(user.id)] = user
+        return rv
+
     def find_role(self, *args, **kwargs):
         """Returns a role matching the provided name."""
         raise NotImplementedError
@@ -106,6 +212,7 @@ class UserDatastore(object):
         if role not in user.roles:
             user.roles.append(role)
             self.put(user)
+            invalidate_role_cache(user)
             return True
         return False
 
@@ -120,11 +227,68 @@ class UserDatastore(object):
         if role in user.roles:
             rv = True
             user.roles.remove(role)
+            invalidate_role_cache(user)
         return rv
 
+    def add_role_to_users(self, users, role):
+        """Adds a role to many users. Returns the number of users the role
+        was added to.
+
+        :param users: The users, or their email addresses, to manipulate
+        :param role: The role to add to the users
+        """
+        role = self._prepare_role(role)
+        return len([u for u in users if self.add_role_to_user(u, role)])
+
+    def remove_role_from_users(self, users, role):
+        """Removes a role from many users. Returns the number of users the
+        role was removed from.
+
+        :param users: The users, or their email addresses, to manipulate
+        :param role: The role to remove from the users
+        """
+        role = self._prepare_role(role)
+        return len([u for u in users if self.remove_role_from_user(u, role)])
+
+    def set_user_roles(self, users, roles):
+        """Replaces the roles of many users with the given roles.
+
+        :param users: The users, or their email addresses, to manipulate
+        :param roles: The roles, or their names, the users should have
+        """
+        roles = [self._prepare_role(role) for role in roles]
+        for user in users:
+            user, _ = self._prepare_role_modify_args(user, None)
+            for role in list(user.roles):
+                if role not in roles:
+                    self.remove_role_from_user(user, role)
+            for role in roles:
+                self.add_role_to_user(user, role)
+
+    def update_login_tracking(self, updates):
+        """Writes login tracking updates and commits them. Each update is a
+        dictionary with the ``id`` of a user, the new values of the
+        ``last_login_at``, ``current_login_at``, ``last_login_ip`` and
+        ``current_login_ip`` fields and the number of logins to add to
+        ``login_count``.
+
+        :param updates: A sequence of login tracking updates
+        """
+        for update in updates:
+            update = dict(update)
+            user = self.find_user(id=update.pop('id'))
+            if user is None:
+                continue
+            update['login_count'] += user.login_count or 0
+            for key, value in update.items():
+                setattr(user, key, value)
+            self.put(user)
+        self.commit()
+
     def toggle_active(self, user):
         """Toggles a user's active status. Always returns True."""
         user.active = not user.active
+        invalidate_token_cache(user)
         return True
 
     def deactivate_user(self, user):
@@ -134,6 +298,7 @@ class UserDatastore(object):
         """
         if user.active:
             user.active = False
+            invalidate_token_cache(user)
             return True
         return False
 
@@ -144,6 +309,7 @@ class UserDatastore(object):
         """
         if not user.active:
             user.active = True
+            invalidate_token_cache(user)
             return True
         return False
 
@@ -166,30 +332,118 @@ class UserDatastore(object):
         user = self.user_model(**kwargs)
         return self.put(user)
 
+    def create_users(self, users):
+        """Creates and returns new users from a sequence of parameter
+        dictionaries. Roles are looked up once per name and the users are
+        added in bulk where the backend supports it. Passwords are stored as
+        given, use :func:`~flask_security.utils.encrypt_passwords` to encrypt
+        them first.
+
+        :param users: A sequence of dictionaries of user parameters
+        """
+        return [self.put(self.user_model(**kwargs))
+                for kwargs in self._prepare_create_users_args(users)]
+
     def delete_user(self, user):
         """Delete the specified user
 
         :param user: The user to delete
         """
         self.delete(user)
+        invalidate_token_cache(user)
 
 
 class SQLAlchemyUserDatastore(SQLAlchemyDatastore, UserDatastore):
     """A SQLAlchemy datastore implementation for Flask-Security that assumes the
     use of the Flask-SQLAlchemy extension.
+
+    :param role_loading: How the roles of the users returned by the user
+                         queries are loaded. One of ``'joined'``,
+                         ``'subquery'`` or ``'selectin'`` to load them
+                         together with the users. Defaults to the loader
+                         strategy of the ``roles`` relationship.
     """
-    def __init__(self, db, user_model, role_model):
+
+    #: The role loading strategies and the names of their loader options
+    role_loaders = {
+        'joined': 'joinedload',
+        'subquery': 'subqueryload',
+        'selectin': 'selectinload',
+    }
+
+    def __init__(self, db, user_model, role_model, role_loading=None):
+        import sqlalchemy.orm
+
         SQLAlchemyDatastore.__init__(self, db)
         UserDatastore.__init__(self, user_model, role_model)
+        # resolve the loader options once, selectinload needs SQLAlchemy 1.2
+        self._role_loaders = dict(
+            (name, getattr(sqlalchemy.orm, option))
+            for name, option in self.role_loaders.items()
+            if hasattr(sqlalchemy.orm, option))
+        if role_loading is not None and role_loading not in self._role_loaders:
+            if role_loading in self.role_loaders:
+                raise ValueError('The %s role loading strategy needs a newer '
+                                 'SQLAlchemy (selectin needs SQLAlchemy 1.2)'
+                                 % role_loading)
+            raise ValueError('Unknown role loading strategy: %s' % role_loading)
+        self.role_loading = role_loading
+        # load the roles of all users with a second query by default
+        self._find_users_role_loading = \
+            'selectin' if 'selectin' in self._role_loaders else 'subquery'
+
+    def _get_user_query(self, role_loading=None):
+        query = self.user_model.query
+        role_loading = role_loading or self.role_loading
+        if role_loading is not None:
+            loader = self._role_loaders[role_loading]
+            query = query.options(loader(self.user_model.roles))
+        return query
 
     def get_user(self, identifier):
         if self._is_numeric(identifier):
-            return self.user_model.query.get(identifier)
-        for attr in get_identity_attributes():
-            query = getattr(self.user_model, attr).ilike(identifier)
-            rv = self.user_model.query.filter(query).first()
-            if rv is not None:
-                return rv
+            return self._get_user_query().get(identifier)
+        value = identifier.lower()
+        query = self.db.or_(*[
+            self.db.func.lower(getattr(self.user_model, attr)) == value
+            for attr in get_identity_attributes()])
+        users = self._get_user_query().filter(query).all()
+        return self._select_identity_match(users, identifier)
+
+    def get_identity_indexes(self):
+        """Returns the functional ``lower(column)`` indexes used by
+        :meth:`get_user` to look up users by their identity attributes.
+        """
+        table = self.user_model.__table__
+        return [self.db.Index('ix_%s_%s_lower' % (table.name, attr),
+                              self.db.func.lower(table.c[attr]))
+                for attr in get_identity_attributes()]
+
+    def create_identity_indexes(self):
+        """Creates the indexes returned by :meth:`get_identity_indexes`
+        that do not exist yet. Returns the created indexes.
+        """
+        from sqlalchemy.exc import DBAPIError
+
+        rv = []
+        for index in self.get_identity_indexes():
+            # not every dialect reflects expression indexes
+            try:
+                index.create(bind=self.db.engine)
+            except DBAPIError as e:
+                if 'already exists' not in str(e.orig):
+                    raise
+            else:
+                rv.append(index)
+        return rv
+
+    def _detach_user(self, user):
+        # load the roles so that they are cached along with the user
+        user.roles
+        return user
+
+    def _attach_user(self, user):
+        return self.db.session.merge(user, load=False)
 
     def _is_numeric(self, value):
         try:
@@ -199,11 +453,128 @@ class SQLAlchemyUserDatastore(SQLAlchemyDatastore, UserDatastore):
         return True
 
     def find_user(self, **kwargs):
-        return self.user_model.query.filter_by(**kwargs).first()
+        return self._get_user_query().filter_by(**kwargs).first()
+
+    def find_users(self, **kwargs):
+        role_loading = self.role_loading or self._find_users_role_loading
+        return self._get_user_query(role_loading).filter_by(**kwargs).all()
 
     def find_role(self, role):
         return self.role_model.query.filter_by(name=role).first()
 
+    def find_users_by_id(self, ids):
+        rv = {}
+        for chunk in _chunks(set(ids)):
+            query = self._get_user_query().filter(self.user_model.id.in_(chunk))
+            for user in query:
+                rv[str(user.id)] = user
+        return rv
+
+    def create_users(self, users):
+        users = [self.user_model(**kwargs)
+                 for kwargs in self._prepare_create_users_args(users)]
+        self.db.session.add_all(users)
+        return users
+
+    def update_login_tracking(self, updates):
+        from sqlalchemy import bindparam
+
+        table = self.user_model.__table__
+        fields = ('last_login_at', 'current_login_at',
+                  'last_login_ip', 'current_login_ip')
+        values = dict((field, bindparam('_' + field)) for field in fields)
+        values['login_count'] = self.db.func.coalesce(table.c.login_count, 0) + \
+            bindparam('_login_count')
+        query = table.update().where(table.c.id == bindparam('_id')).values(**values)
+        rows = [dict(('_' + key, value) for key, value in update.items())
+                for update in updates]
+        with self.db.engine.begin() as connection:
+            for chunk in _chunks(rows):
+                connection.execute(query, chunk)
+
+    def _find_user_ids(self, emails):
+        query = self.db.session.query(self.user_model.id) \
+            .filter(self.user_model.email.in_(emails))
+        return [row[0] for row in query]
+
+    def _find_user_emails(self, emails):
+        query = self.db.session.query(self.user_model.email) \
+            .filter(self.user_model.email.in_(emails))
+        return [row[0] for row in query]
+
+    def _get_role_link(self):
+        prop = self.user_model.roles.property
+        if prop.secondary is None:
+            return None
+        return (prop.secondary, prop.synchronize_pairs[0][1],
+                prop.secondary_synchronize_pairs[0][1])
+
+    def _roles_changed(self, user_ids, roles=()):
+        session = self.db.session
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, self.user_model) and obj.id in user_ids:
+                session.expire(obj, ['roles'])
+                _forget_role_names(obj)
+        for role in roles:
+            session.expire(role)
+        super(SQLAlchemyUserDatastore, self)._roles_changed(user_ids)
+
+    def add_role_to_users(self, users, role):
+        link = self._get_role_link()
+        if link is None:
+            return super(SQLAlchemyUserDatastore, self) \
+                .add_role_to_users(users, role)
+        table, user_column, role_column = link
+        self.db.session.flush()
+        role = self._prepare_role(role)
+        user_ids = self._get_user_ids(users)
+        for chunk in _chunks(user_ids):
+            query = table.select() \
+                .where(role_column == role.id).where(user_column.in_(chunk))
+            for row in self.db.session.execute(query):
+                user_ids.discard(row[user_column])
+        if user_ids:
+            self.db.session.execute(table.insert(), [
+                {user_column.name: user_id, role_column.name: role.id}
+                for user_id in user_ids])
+            self._roles_changed(user_ids, [role])
+        return len(user_ids)
+
+    def remove_role_from_users(self, users, role):
+        link = self._get_role_link()
+        if link is None:
+            return super(SQLAlchemyUserDatastore, self) \
+                .remove_role_from_users(users, role)
+        table, user_column, role_column = link
+        self.db.session.flush()
+        role = self._prepare_role(role)
+        user_ids, rv = self._get_user_ids(users), 0
+        for chunk in _chunks(user_ids):
+            query = table.delete() \
+                .where(role_column == role.id).where(user_column.in_(chunk))
+            rv += self.db.session.execute(query).rowcount
+        if rv:
+            self._roles_changed(user_ids, [role])
+        return rv
+
+    def set_user_roles(self, users, roles):
+        link = self._get_role_link()
+        if link is None:
+            return super(SQLAlchemyUserDatastore, self) \
+                .set_user_roles(users, roles)
+        table, user_column, role_column = link
+        self.db.session.flush()
+        roles = [self._prepare_role(role) for role in roles]
+        user_ids = self._get_user_ids(users)
+        for chunk in _chunks(user_ids):
+            self.db.session.execute(
+                table.delete().where(user_column.in_(chunk)))
+        rows = [{user_column.name: user_id, role_column.name: role.id}
+                for user_id in user_ids for role in roles]
+        if rows:
+            self.db.session.execute(table.insert(), rows)
+        self._roles_changed(user_ids, roles)
+
 
 class MongoEngineUserDatastore(MongoEngineDatastore, UserDatastore):
     """A MongoEngine datastore implementation for Flask-Security that assumes
@@ -219,12 +590,15 @@ class MongoEngineUserDatastore(MongoEngineDatastore, UserDatastore):
             return self.user_model.objects(id=identifier).first()
         except ValidationError:
             pass
-        for attr in get_identity_attributes():
-            query_key = '%s__iexact' % attr
-            query = {query_key: identifier}
-            rv = self.user_model.objects(**query).first()
-            if rv is not None:
-                return rv
+        try:
+            from mongoengine.queryset import Q, QCombination
+        except ImportError:
+            from mongoengine.queryset.visitor import Q, QCombination
+
+        queries = [Q(**{'%s__iexact' % attr: identifier})
+                   for attr in get_identity_attributes()]
+        users = self.user_model.objects(QCombination(QCombination.OR, queries))
+        return self._select_identity_match(list(users), identifier)
 
     def find_user(self, **kwargs):
         try:
@@ -240,9 +614,82 @@ class MongoEngineUserDatastore(MongoEngineDatastore, UserDatastore):
         except ValidationError:
             return None
 
+    def find_users(self, **kwargs):
+        return list(self.user_model.objects(**kwargs).select_related())
+
+    def find_users_by_id(self, ids):
+        from mongoengine.errors import ValidationError
+
+        rv = {}
+        for chunk in _chunks(set(ids)):
+            try:
+                users = list(self.user_model.objects(id__in=chunk))
+            except ValidationError:
+                # a malformed ID fails the whole query
+                users = [self.find_user(id=user_id) for user_id in chunk]
+            for user in users:
+                if user is not None:
+                    rv[str(user.id)] = user
+        return rv
+
     def find_role(self, role):
         return self.role_model.objects(name=role).first()
 
+    def create_users(self, users):
+        users = [self.user_model(**kwargs)
+                 for kwargs in self._prepare_create_users_args(users)]
+        if users:
+            self.user_model.objects.insert(users)
+        return users
+
+    def _find_user_ids(self, emails):
+        return self.user_model.objects(email__in=emails).scalar('id')
+
+    def _find_user_emails(self, emails):
+        return self.user_model.objects(email__in=emails).scalar('email')
+
+    def update_login_tracking(self, updates):
+        for update in updates:
+            update = dict(update)
+            query = self.user_model.objects(id=update.pop('id'))
+            count = update.pop('login_count')
+            query.update_one(inc__login_count=count,
+                             **dict(('set__' + k, v) for k, v in update.items()))
+
+    def add_role_to_users(self, users, role):
+        users = list(users)
+        role = self._prepare_role(role)
+        user_ids = self._get_user_ids(users)
+        rv = self.user_model.objects(id__in=list(user_ids), roles__ne=role) \
+            .update(add_to_set__roles=role)
+        for user in users:
+            if not isinstance(user, string_types) and role not in user.roles:
+                user.roles.append(role)
+        self._roles_changed(user_ids)
+        return rv
+
+    def remove_role_from_users(self, users, role):
+        users = list(users)
+        role = self._prepare_role(role)
+        user_ids = self._get_user_ids(users)
+        rv = self.user_model.objects(id__in=list(user_ids), roles=role) \
+            .update(pull__roles=role)
+        for user in users:
+            if not isinstance(user, string_types) and role in user.roles:
+                user.roles.remove(role)
+        self._roles_changed(user_ids)
+        return rv
+
+    def set_user_roles(self, users, roles):
+        users = list(users)
+        roles = [self._prepare_role(role) for role in roles]
+        user_ids = self._get_user_ids(users)
+        self.user_model.objects(id__in=list(user_ids)).update(set__roles=roles)
+        for user in users:
+            if not isinstance(user, string_types):
+                user.roles = list(roles)
+        self._roles_changed(user_ids)
+
     def add_role_to_user(self, user, role):
         rv = super(MongoEngineUserDatastore, self).add_role_to_user(user, role)
         if rv:
@@ -269,12 +716,15 @@ class PeeweeUserDatastore(PeeweeDatastore, UserDatastore):
         except ValueError:
             pass
 
+        from peewee import fn
+
+        value = identifier.lower()
+        query = None
         for attr in get_identity_attributes():
-            column = getattr(self.user_model, attr)
-            try:
-                return self.user_model.get(column ** identifier)
-            except self.user_model.DoesNotExist:
-                pass
+            clause = fn.Lower(getattr(self.user_model, attr)) == value
+            query = clause if query is None else query | clause
+        users = self.user_model.select().where(query)
+        return self._select_identity_match(list(users), identifier)
 
     def find_user(self, **kwargs):
         try:
@@ -282,6 +732,26 @@ class PeeweeUserDatastore(PeeweeDatastore, UserDatastore):
         except self.user_model.DoesNotExist:
             return None
 
+    def find_users(self, **kwargs):
+        users = list(self.user_model.filter(**kwargs))
+        links = dict((user.id, []) for user in users)
+        for chunk in _chunks(links):
+            query = self.UserRole.select(self.UserRole, self.role_model) \
+                .join(self.role_model).where(self.UserRole.user << chunk)
+            for link in query:
+                links[link.user_id].append(link)
+        for user in users:
+            # the reverse relation is a non-data descriptor
+            user.__dict__['roles'] = links[user.id]
+        return users
+
+    def find_users_by_id(self, ids):
+        rv = {}
+        for chunk in _chunks(set(ids)):
+            for user in self.user_model.select().where(self.user_model.id << chunk):
+                rv[str(user.id)] = user
+        return rv
+
     def find_role(self, role):
         try:
             return self.role_model.filter(name=role).get()
@@ -297,6 +767,65 @@ class PeeweeUserDatastore(PeeweeDatastore, UserDatastore):
             self.add_role_to_user(user, role)
         return user
 
+    def create_users(self, users):
+        rv, links = [], []
+        for kwargs in self._prepare_create_users_args(users):
+            roles = kwargs.pop('roles')
+            user = self.put(self.user_model(**kwargs))
+            links.extend(dict(user=user.id, role=role.id)
+                         for role in roles if role is not None)
+            rv.append(user)
+        for chunk in _chunks(links):
+            self.UserRole.insert_many(chunk).execute()
+        return rv
+
+    def _find_user_ids(self, emails):
+        query = self.user_model.select(self.user_model.id) \
+            .where(self.user_model.email << emails)
+        return [user.id for user in query]
+
+    def _find_user_emails(self, emails):
+        query = self.user_model.select(self.user_model.email) \
+            .where(self.user_model.email << emails)
+        return [user.email for user in query]
+
+    def add_role_to_users(self, users, role):
+        users = list(users)
+        role = self._prepare_role(role)
+        user_ids = self._get_user_ids(users)
+        for chunk in _chunks(user_ids):
+            query = self.UserRole.select(self.UserRole.user) \
+                .where(self.UserRole.role == role.id, self.UserRole.user << chunk)
+            user_ids.difference_update(row[0] for row in query.tuples())
+        for chunk in _chunks(user_ids):
+            self.UserRole.insert_many(
+                [dict(user=user_id, role=role.id) for user_id in chunk]).execute()
+        self._roles_changed(user_ids)
+        return len(user_ids)
+
+    def remove_role_from_users(self, users, role):
+        users = list(users)
+        role = self._prepare_role(role)
+        user_ids, rv = self._get_user_ids(users), 0
+        for chunk in _chunks(user_ids):
+            rv += self.UserRole.delete().where(
+                self.UserRole.role == role.id,
+                self.UserRole.user << chunk).execute()
+        self._roles_changed(user_ids)
+        return rv
+
+    def set_user_roles(self, users, roles):
+        users = list(users)
+        roles = [self._prepare_role(role) for role in roles]
+        user_ids = self._get_user_ids(users)
+        for chunk in _chunks(user_ids):
+            self.UserRole.delete().where(self.UserRole.user << chunk).execute()
+        links = [dict(user=user_id, role=role.id)
+                 for user_id in user_ids for role in roles]
+        for chunk in _chunks(links):
+            self.UserRole.insert_many(chunk).execute()
+        self._roles_changed(user_ids)
+
     def add_role_to_user(self, user, role):
         """Adds a role tp a user
 
@@ -310,6 +839,7 @@ class PeeweeUserDatastore(PeeweeDatastore, UserDatastore):
             return False
         else:
             self.UserRole.create(user=user.id, role=role.id)
+            invalidate_role_cache(user)
             return True
 
     def remove_role_from_user(self, user, role):
@@ -325,6 +855,234 @@ class PeeweeUserDatastore(PeeweeDatastore, UserDatastore):
             query = self.UserRole.delete().where(
                 self.UserRole.user == user, self.UserRole.role == role)
             query.execute()
+            invalidate_role_cache(user)
             return True
         else:
             return False
+
+
+class CachedUserDatastore(object):
+    """Caches the users returned by another user datastore's `find_user` and
+    `get_user` methods. Users are cached by ID and by their identity
+    attributes and are removed from the cache whenever they are changed
+    through this datastore. Every other attribute and method is provided by
+    the wrapped datastore::
+
+        datastore = CachedUserDatastore(SQLAlchemyUserDatastore(db, User, Role))
+        security = Security(app, datastore)
+
+    Users are stored pickled so each lookup returns a separate copy. With
+    several processes use a shared cache such as
+    ``werkzeug.contrib.cache.RedisCache`` so that changes made by one process
+    are seen by the others.
+
+    :param datastore: The user datastore to wrap
+    :param cache: A cache implementing the ``werkzeug.contrib.cache``
+                  interface. Defaults to a
+                  :class:`~flask_security.cache.LRUCache`
+    :param timeout: The number of seconds users are cached for. Defaults to
+                    the default timeout of the cache
+    :param key_prefix: A prefix for the cache keys
+    """
+
+    def __init__(self, datastore, cache=None, timeout=None, key_prefix='user:'):
+        self.datastore = datastore
+        self.cache = cache if cache is not None else LRUCache(1000)
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.datastore, name)
+
+    def _get_id_key(self, user_id):
+        return '%sid:%s' % (self.key_prefix, user_id)
+
+    def _get_alias_key(self, kind, value):
+        value = value.encode('utf-8') if not isinstance(value, bytes) else value
+        return '%s%s:%s' % (self.key_prefix, kind, hashlib.sha1(value).hexdigest())
+
+    def _get_user_keys(self, user):
+        keys = []
+        if getattr(user, 'id', None) is not None:
+            keys.append(self._get_id_key(user.id))
+        for attr in get_identity_attributes():
+            value = getattr(user, attr, None)
+            if value:
+                keys.append(self._get_alias_key('find:' + attr, value))
+                keys.append(self._get_alias_key('get', value.lower()))
+        return keys
+
+    def _get_models(self):
+        return {'user': self.datastore.user_model,
+                'role': self.datastore.role_model}
+
+    def _dumps(self, user):
+        # the models are pickled by reference so that they do not have to be
+        # importable by name
+        models = dict((v, k) for k, v in self._get_models().items())
+        f = BytesIO()
+        pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = lambda obj: \
+            models.get(obj) if isinstance(obj, type) else None
+        pickler.dump(user)
+        return f.getvalue()
+
+    def _loads(self, data):
+        unpickler = pickle.Unpickler(BytesIO(data))
+        unpickler.persistent_load = self._get_models().get
+        return unpickler.load()
+
+    def _load(self, user_id):
+        data = self.cache.get(self._get_id_key(user_id))
+        record_cache('user', data is not None)
+        if data is not None:
+            return self.datastore._attach_user(self._loads(data))
+
+    def _load_alias(self, key, matches):
+        user_id = self.cache.get(key)
+        if user_id is None:
+            record_cache('user', False)
+        else:
+            user = self._load(user_id)
+            if user is not None and matches(user):
+                return user
+
+    def _store(self, user, *aliases):
+        data = self._dumps(self.datastore._detach_user(user))
+        self.cache.set(self._get_id_key(user.id), data, timeout=self.timeout)
+        for key in aliases:
+            self.cache.set(key, str(user.id), timeout=self.timeout)
+        return user
+
+    def _changed(self, keys):
+        self._invalidate(keys)
+        # invalidate again on commit in case the old row was read and cached
+        # before the change was committed
+        self._local.__dict__.setdefault('pending', []).extend(keys)
+
+    def _invalidate(self, keys):
+        for key in keys:
+            self.cache.delete(key)
+
+    def invalidate_user(self, user):
+        """Removes the specified user from the cache.
+
+        :param user: The user, or the ID of the user, to remove
+        """
+        if self._is_user(user):
+            self._invalidate(self._get_user_keys(user))
+        else:
+            self.cache.delete(self._get_id_key(user))
+
+    def find_user(self, **kwargs):
+        if len(kwargs) != 1:
+            return self.datastore.find_user(**kwargs)
+        (attr, value), = kwargs.items()
+        if attr == 'id':
+            user = self._load(value)
+            if user is None:
+                user = self.datastore.find_user(**kwargs)
+                if user is not None:
+                    self._store(user)
+            return user
+        if attr not in get_identity_attributes() or \
+                not isinstance(value, string_types):
+            return self.datastore.find_user(**kwargs)
+        key = self._get_alias_key('find:' + attr, value)
+        user = self._load_alias(key, lambda u: getattr(u, attr, None) == value)
+        if user is None:
+            user = self.datastore.find_user(**kwargs)
+            if user is not None:
+                self._store(user, key)
+        return user
+
+    def get_user(self, identifier):
+        if not isinstance(identifier, string_types):
+            return self.find_user(id=identifier)
+        key = self._get_alias_key('get', identifier.lower())
+        user = self._load_alias(key, lambda u: self.datastore._select_identity_match(
+            [u], identifier) is not None)
+        if user is None:
+            user = self.datastore.get_user(identifier)
+            if user is not None:
+                self._store(user, key)
+        return user
+
+    def _is_user(self, model):
+        # current_user is a proxy and may stand in for the user model
+        model = getattr(model, '_get_current_object', lambda: model)()
+        return isinstance(model, (self.datastore.user_model, BaseUserMixin))
+
+    def commit(self):
+        self.datastore.commit()
+        self._invalidate(self._local.__dict__.pop('pending', []))
+
+    def put(self, model):
+        rv = self.datastore.put(model)
+        if self._is_user(model):
+            self._changed(self._get_user_keys(model))
+        return rv
+
+    def delete(self, model):
+        if self._is_user(model):
+            self._changed(self._get_user_keys(model))
+        self.datastore.delete(model)
+
+    def delete_user(self, user):
+        self.delete(user)
+        invalidate_token_cache(user)
+
+    def create_user(self, **kwargs):
+        user = self.datastore.create_user(**kwargs)
+        self._changed(self._get_user_keys(user))
+        return user
+
+    def create_users(self, users):
+        users = self.datastore.create_users(users)
+        for user in users:
+            self._changed(self._get_user_keys(user))
+        return users
+
+    def _modify_user(self, method, user, *args):
+        if isinstance(user, string_types):
+            user = self.datastore.find_user(email=user)
+        rv = method(user, *args)
+        self._changed(self._get_user_keys(user))
+        return rv
+
+    def toggle_active(self, user):
+        return self._modify_user(self.datastore.toggle_active, user)
+
+    def deactivate_user(self, user):
+        return self._modify_user(self.datastore.deactivate_user, user)
+
+    def activate_user(self, user):
+        return self._modify_user(self.datastore.activate_user, user)
+
+    def add_role_to_user(self, user, role):
+        return self._modify_user(self.datastore.add_role_to_user, user, role)
+
+    def remove_role_from_user(self, user, role):
+        return self._modify_user(self.datastore.remove_role_from_user, user, role)
+
+    def _modify_users(self, method, users, *args):
+        users = list(users)
+        user_ids = self.datastore._get_user_ids(users)
+        rv = method(users, *args)
+        self._changed([self._get_id_key(user_id) for user_id in user_ids])
+        return rv
+
+    def update_login_tracking(self, updates):
+        updates = list(updates)
+        self.datastore.update_login_tracking(updates)
+        self._invalidate([self._get_id_key(update['id']) for update in updates])
+
+    def add_role_to_users(self, users, role):
+        return self._modify_users(self.datastore.add_role_to_users, users, role)
+
+    def remove_role_from_users(self, users, role):
+        return self._modify_users(self.datastore.remove_role_from_users, users, role)
+
+    def set_user_roles(self, users, roles):
+        return self._modify_users(self.datastore.set_user_roles, users, roles)
@@ -9,15 +9,19 @@
     :license: MIT, see LICENSE for more details.
 """
 
+import hashlib
+import hmac
+
 from collections import namedtuple
 from functools import wraps
 
-from flask import current_app, Response, request, redirect, _request_ctx_stack
+from flask import current_app, Response, request, redirect, g, \
+    _request_ctx_stack
 from flask.ext.login import current_user, login_required
-from flask.ext.principal import RoleNeed, Permission, Identity, identity_changed
+from flask.ext.principal import RoleNeed, Identity, identity_changed
 from werkzeug.local import LocalProxy
 
-from . import utils
+from . import metrics, utils
 
 
 # Convenient references
@@ -46,13 +50,36 @@ def _get_unauthorized_view():
     return redirect(cv or request.referrer or '/')
 
 
+def _get_identity_provides():
+    identity = getattr(g, 'identity', None)
+    return identity.provides if identity is not None else frozenset()
+
+
 def _check_token():
+    with metrics.timer('check_token'):
+        return _verify_token()
+
+
+def _has_token():
+    if _security.token_authentication_header in request.headers or \
+            _security.token_authentication_key in request.args:
+        return True
+    return _security.token_authentication_json and \
+        request.mimetype == 'application/json'
+
+
+def _verify_token():
+    if not _has_token():
+        return False
+
     header_key = _security.token_authentication_header
     args_key = _security.token_authentication_key
     header_token = request.headers.get(header_key, None)
     token = request.args.get(args_key, header_token)
-    if request.get_json(silent=True):
-        token = request.json.get(args_key, token)
+    if _security.token_authentication_json:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            token = data.get(args_key, token)
 
     user = _security.login_manager.token_callback(token)
 
@@ -65,17 +92,58 @@ def _check_token():
     return False
 
 
+def _get_http_auth_cache_key(auth, user):
+    secret_key = current_app.config['SECRET_KEY']
+    if isinstance(secret_key, utils.text_type):
+        secret_key = secret_key.encode('utf-8')
+    msg = u'\0'.join([auth.username, auth.password, user.password])
+    return hmac.new(secret_key, msg.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def _verify_http_auth(auth, user):
+    cache = _security.http_auth_cache
+    cacheable = cache is not None and auth.password and user.password \
+        and user.is_active()
+
+    if cacheable:
+        hit = cache.get(_get_http_auth_cache_key(auth, user)) == str(user.id)
+        metrics.record_cache('http_auth', hit)
+        if hit:
+            return True
+
+    if not utils.verify_and_update_password(auth.password, user):
+        return False
+
+    _security.datastore.commit()
+    if cacheable:
+        cache.set(_get_http_auth_cache_key(auth, user), str(user.id))
+    return True
+
+
 def _check_http_auth():
+    with metrics.timer('check_http_auth'):
+        return _verify_http_auth_request()
+
+
+def _has_http_auth():
+    return request.headers.get('Authorization', '')[:6].lower() == 'basic '
+
+
+def _verify_http_auth_request():
+    if not _has_http_auth():
+        return False
+
     auth = request.authorization or BasicAuth(username=None, password=None)
+    utils.check_login_throttle(auth.username)
     user = _security.datastore.find_user(email=auth.username)
 
-    if user and utils.verify_and_update_password(auth.password, user):
-        _security.datastore.commit()
+    if user and _verify_http_auth(auth, user):
         app = current_app._get_current_object()
         _request_ctx_stack.top.user = user
         identity_changed.send(app, identity=Identity(user.id))
         return True
 
+    utils.record_failed_login(auth.username)
     return False
 
 
@@ -116,6 +184,16 @@ def auth_token_required(fn):
     return decorated
 
 
+#: The authentication mechanisms of :func:`auth_required`. Each is a tuple
+#: of a cheap check whether the request carries its credentials and the
+#: check of those credentials
+_login_mechanisms = {
+    'token': (_has_token, _check_token),
+    'basic': (_has_http_auth, _check_http_auth),
+    'session': (lambda: True, lambda: current_user.is_authenticated())
+}
+
+
 def auth_required(*auth_methods):
     """
     Decorator that protects enpoints through multiple mechanisms
@@ -128,18 +206,14 @@ def auth_required(*auth_methods):
 
     :param auth_methods: Specified mechanisms.
     """
-    login_mechanisms = {
-        'token': lambda: _check_token(),
-        'basic': lambda: _check_http_auth(),
-        'session': lambda: current_user.is_authenticated()
-    }
+    mechanisms = [_login_mechanisms[method] for method in auth_methods
+                  if method in _login_mechanisms]
 
     def wrapper(fn):
         @wraps(fn)
         def decorated_view(*args, **kwargs):
-            mechanisms = [login_mechanisms.get(method) for method in auth_methods]
-            for mechanism in mechanisms:
-                if mechanism and mechanism():
+            for present, check in mechanisms:
+                if present() and check():
                     return fn(*args, **kwargs)
             return _get_unauthorized_response()
         return decorated_view
@@ -160,13 +234,13 @@ def roles_required(*roles):
 
     :param args: The required roles.
     """
+    needs = frozenset(RoleNeed(role) for role in roles)
+
     def wrapper(fn):
         @wraps(fn)
         def decorated_view(*args, **kwargs):
-            perms = [Permission(RoleNeed(role)) for role in roles]
-            for perm in perms:
-                if not perm.can():
-                    return _get_unauthorized_view()
+            if not needs.issubset(_get_identity_provides()):
+                return _get_unauthorized_view()
             return fn(*args, **kwargs)
         return decorated_view
     return wrapper
@@ -186,11 +260,12 @@ def roles_accepted(*roles):
 
     :param args: The possible roles.
     """
+    needs = frozenset(RoleNeed(role) for role in roles)
+
     def wrapper(fn):
         @wraps(fn)
         def decorated_view(*args, **kwargs):
-            perm = Permission(*[RoleNeed(role) for role in roles])
-            if perm.can():
+            if not needs or not needs.isdisjoint(_get_identity_provides()):
                 return fn(*args, **kwargs)
             return _get_unauthorized_view()
         return decorated_view
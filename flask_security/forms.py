@@ -23,7 +23,9 @@ from flask_login import current_user
 from werkzeug.local import LocalProxy
 
 from .confirmable import requires_confirmation
-from .utils import verify_and_update_password, get_message, config_value
+from .metrics import timer
+from .utils import verify_and_update_password, get_message, config_value, \
+    check_login_throttle, record_failed_login
 
 # Convenient reference
 _datastore = LocalProxy(lambda: current_app.extensions['security'].datastore)
@@ -212,6 +214,10 @@ class LoginForm(Form, NextFormMixin):
         self.remember.default = config_value('DEFAULT_REMEMBER_ME')
 
     def validate(self):
+        with timer('login_form'):
+            return self._validate()
+
+    def _validate(self):
         if not super(LoginForm, self).validate():
             return False
 
@@ -223,16 +229,18 @@ class LoginForm(Form, NextFormMixin):
             self.password.errors.append(get_message('PASSWORD_NOT_PROVIDED')[0])
             return False
 
-
+        check_login_throttle(self.email.data)
         self.user = _datastore.get_user(self.email.data)
 
         if self.user is None:
+            record_failed_login(self.email.data)
             self.email.errors.append(get_message('USER_DOES_NOT_EXIST')[0])
             return False
         if not self.user.password:
             self.password.errors.append(get_message('PASSWORD_NOT_SET')[0])
             return False
         if not verify_and_update_password(self.password.data, self.user):
+            record_failed_login(self.email.data)
             self.password.errors.append(get_message('INVALID_PASSWORD')[0])
             return False
         if requires_confirmation(self.user):
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.security.hashing
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Flask-Security hashing module
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import functools
+import os
+import threading
+import time
+
+from passlib.context import CryptContext
+
+try:
+    from concurrent.futures import Future, ProcessPoolExecutor, \
+        ThreadPoolExecutor
+except ImportError:  # pragma: no cover
+    Future = ProcessPoolExecutor = ThreadPoolExecutor = None
+
+
+#: Password contexts of the worker processes, keyed by their configuration
+_contexts = {}
+
+#: The number of threads of the shared pool used by :func:`run_in_thread`
+THREAD_POOL_SIZE = 4
+
+_thread_pool = None
+_thread_pool_pid = None
+_thread_pool_lock = threading.Lock()
+
+
+class HashingPoolFull(Exception):
+    """Raised when the hashing executor has no room for more work."""
+
+
+def _run(config, method, args):
+    started = time.time()
+    context = _contexts.get(config)
+    if context is None:
+        context = _contexts[config] = CryptContext.from_string(config)
+    rv = getattr(context, method)(*args)
+    return rv, started, time.time()
+
+
+def run_in_future(fn, *args):
+    """Calls a function and returns a completed `Future` of its result.
+
+    :param fn: The function to call
+    :param args: The arguments of the function
+    """
+    if Future is None:  # pragma: no cover
+        raise RuntimeError('Futures require the futures package on Python 2')
+    rv = Future()
+    try:
+        rv.set_result(fn(*args))
+    except Exception as e:
+        rv.set_exception(e)
+    return rv
+
+
+def run_in_thread(fn, *args):
+    """Calls a function in a thread of a pool shared by the process and
+    returns a `Future` of its result. Most passlib backends release the GIL
+    while hashing.
+
+    :param fn: The function to call
+    :param args: The arguments of the function
+    """
+    global _thread_pool, _thread_pool_pid
+    if ThreadPoolExecutor is None:  # pragma: no cover
+        raise RuntimeError('Futures require the futures package on Python 2')
+    if _thread_pool_pid != os.getpid():
+        with _thread_pool_lock:
+            if _thread_pool_pid != os.getpid():
+                _thread_pool = ThreadPoolExecutor(THREAD_POOL_SIZE)
+                _thread_pool_pid = os.getpid()
+    return _thread_pool.submit(fn, *args)
+
+
+class HashingExecutor(object):
+    """Runs the password hashing of a `CryptContext` in a pool of worker
+    processes so that it neither holds the GIL nor ties up request threads.
+    Work is rejected with :class:`HashingPoolFull` once every worker is busy
+    and `queue_size` jobs are waiting.
+
+    The `metrics` dictionary counts the ``hashed`` and ``rejected`` jobs and
+    sums the seconds jobs spent waiting in the queue (``queue_wait``) and
+    hashing (``hash_time``).
+
+    :param workers: The number of worker processes
+    :param queue_size: The number of jobs allowed to wait for a worker
+    """
+
+    def __init__(self, workers=1, queue_size=100):
+        if ProcessPoolExecutor is None:
+            raise RuntimeError('The hashing executor requires the futures '
+                               'package on Python 2')
+        self.workers = workers
+        self.queue_size = queue_size
+        self.metrics = dict(hashed=0, rejected=0, queue_wait=0.0, hash_time=0.0)
+        self._executor = None
+        self._pid = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ProcessPoolExecutor(self.workers)
+                    self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, context, method, *args):
+        """Calls a method of a `CryptContext` in a worker process and
+        returns a `Future` of its result.
+
+        :param context: The `CryptContext` to use
+        :param method: The name of the method, for example ``encrypt``
+        :param args: The arguments of the method
+        """
+        with self._lock:
+            if self._pending >= self.workers + self.queue_size:
+                self.metrics['rejected'] += 1
+                raise HashingPoolFull()
+            self._pending += 1
+        rv, submitted = Future(), time.time()
+        try:
+            future = self._get_executor().submit(
+                _run, context.to_string(), method, args)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        future.add_done_callback(functools.partial(self._done, rv, submitted))
+        return rv
+
+    def run(self, context, method, *args):
+        """Like :meth:`submit` but waits for and returns the result."""
+        return self.submit(context, method, *args).result()
+
+    def _done(self, rv, submitted, future):
+        with self._lock:
+            self._pending -= 1
+        error = future.exception()
+        if error is not None:
+            rv.set_exception(error)
+            return
+        result, started, finished = future.result()
+        with self._lock:
+            self.metrics['hashed'] += 1
+            self.metrics['queue_wait'] += max(started - submitted, 0)
+            self.metrics['hash_time'] += finished - started
+        rv.set_result(result)
+
+    def shutdown(self):
+        """Stops the worker processes."""
+        if self._pid == os.getpid():
+            self._executor.shutdown()
+        self._executor, self._pid = None, None
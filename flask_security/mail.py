@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.security.mail
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Flask-Security mail module
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+
+
+logger = logging.getLogger(__name__)
+
+_stop = object()
+
+
+def smtp_transport(app, messages):
+    """Sends the messages over a single connection of the application's
+    Flask-Mail extension. Delivered messages are removed from the list so
+    that only the remaining ones are retried after a failure.
+
+    :param app: The application
+    :param messages: A list of `flask_mail.Message` instances
+    """
+    mail = app.extensions.get('mail')
+    with mail.connect() as connection:
+        while messages:
+            connection.send(messages[0])
+            messages.pop(0)
+
+
+class MailDispatcher(object):
+    """Sends emails from background worker threads so that requests do not
+    wait on the mail server. Queued messages are grouped into batches that
+    are delivered over a single connection.
+
+    :param app: The application
+    :param transport: A callable that delivers a list of messages. Defaults
+                      to :func:`smtp_transport`
+    :param queue_size: The maximum number of queued messages. When the queue
+                       is full for longer than `queue_timeout` seconds the
+                       message is sent by the calling thread instead
+    :param batch_size: The maximum number of messages sent per connection
+    :param retries: The number of times a failed batch is retried
+    :param retry_delay: The number of seconds to wait before the first retry.
+                        The delay doubles with every retry
+    :param workers: The number of worker threads
+    :param queue_timeout: The number of seconds to wait for room in the queue
+    """
+
+    def __init__(self, app, transport=None, queue_size=1000, batch_size=50,
+                 retries=3, retry_delay=1, workers=1, queue_timeout=1):
+        self.app = app
+        self.transport = transport or smtp_transport
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self._queue = Queue(queue_size)
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.shutdown)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._threads = []
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def send(self, msg):
+        """Queues a message for delivery.
+
+        :param msg: A `flask_mail.Message` instance
+        """
+        self._ensure_started()
+        try:
+            self._queue.put(msg, timeout=self.queue_timeout)
+        except Full:
+            logger.warning('Mail queue is full, sending message synchronously')
+            self._deliver([msg])
+
+    def flush(self):
+        """Blocks until every queued message has been handled."""
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def shutdown(self):
+        """Delivers all queued messages and stops the worker threads."""
+        if self._pid != os.getpid():
+            return
+        self.flush()
+        for _ in self._threads:
+            self._queue.put(_stop)
+        for thread in self._threads:
+            thread.join()
+        self._threads, self._pid = [], None
+
+    def _run(self):
+        while True:
+            msg = self._queue.get()
+            if msg is _stop:
+                self._queue.task_done()
+                return
+            batch = [msg]
+            while len(batch) < self.batch_size:
+                try:
+                    msg = self._queue.get_nowait()
+                except Empty:
+                    break
+                if msg is _stop:
+                    self._queue.put(_stop)
+                    self._queue.task_done()
+                    break
+                batch.append(msg)
+            try:
+                self._deliver(batch)
+            finally:
+                for _ in range(len(batch)):
+                    self._queue.task_done()
+
+    def _deliver(self, messages):
+        pending = list(messages)
+        for attempt in range(self.retries + 1):
+            try:
+                with self.app.app_context():
+                    self.transport(self.app, pending)
+                return
+            except Exception:
+                if attempt == self.retries:
+                    logger.exception('Failed to send %d message(s)', len(pending))
+                    return
+                time.sleep(self.retry_delay * 2 ** attempt)
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.security.metrics
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Flask-Security metrics module
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import bisect
+import functools
+import socket
+import threading
+
+from timeit import default_timer
+
+from flask import current_app, g, has_app_context
+
+
+#: The upper bounds in seconds of the default latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0)
+
+#: The upper bounds of the default buckets of histograms of counts
+DEFAULT_COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 10, 20, 50, 100)
+
+
+class _Timer(object):
+
+    __slots__ = ('collector', 'name', 'started')
+
+    def __init__(self, collector, name):
+        self.collector = collector
+        self.name = name
+
+    def __enter__(self):
+        self.started = default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.collector.observe(self.name, default_timer() - self.started)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+class MetricsCollector(object):
+    """Collects latency histograms and counters in memory. Latencies are
+    observed with :meth:`timer` or :meth:`observe` and events are counted
+    with :meth:`incr`. The collected metrics can be exported in the
+    Prometheus text format with :meth:`to_prometheus`.
+
+    Flask-Security reports the latency of the ``check_token``,
+    ``check_http_auth``, ``token_loader``, ``login_form``, ``hash`` and
+    ``send_mail`` stages and of every ``datastore.<method>`` call. It counts
+    ``requests``, ``datastore_calls`` and the ``<name>_cache_hits`` and
+    ``<name>_cache_misses`` of the ``token``, ``http_auth``, ``role`` and
+    ``user`` caches, and observes the ``datastore_calls_per_request`` with
+    :meth:`observe_count`.
+
+    :param buckets: The upper bounds in seconds of the histogram buckets
+    :param prefix: The prefix of the exported metric names
+    :param count_buckets: The upper bounds of the buckets of the histograms
+                          of counts
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='flask_security',
+                 count_buckets=DEFAULT_COUNT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.count_buckets = tuple(sorted(count_buckets))
+        self.prefix = prefix
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def timer(self, name):
+        """Returns a context manager that observes the time spent in its
+        block.
+
+        :param name: The name of the histogram
+        """
+        return _Timer(self, name)
+
+    def observe(self, name, seconds):
+        """Adds a latency to a histogram.
+
+        :param name: The name of the histogram
+        :param seconds: The latency in seconds
+        """
+        self._observe(name, seconds, self.buckets, 'seconds')
+
+    def observe_count(self, name, value):
+        """Adds a value to a histogram of counts, for example of the
+        number of datastore calls of a request.
+
+        :param name: The name of the histogram
+        :param value: The value to add
+        """
+        self._observe(name, value, self.count_buckets, None)
+
+    def _observe(self, name, value, buckets, unit):
+        index = bisect.bisect_left(buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = \
+                    [[0] * (len(buckets) + 1), 0, 0, buckets, unit]
+            histogram[0][index] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def incr(self, name, value=1):
+        """Increments a counter.
+
+        :param name: The name of the counter
+        :param value: The amount to increment the counter by
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def register_gauges(self, name, fn):
+        """Registers a function returning a dictionary of numbers that are
+        exported as gauges named ``<name>_<key>``, for example the `metrics`
+        of a :class:`~flask_security.hashing.HashingExecutor`.
+
+        :param name: The prefix of the gauge names
+        :param fn: The function returning the values
+        """
+        self._gauges[name] = fn
+
+    def snapshot(self):
+        """Returns a dictionary of the collected ``histograms``, ``counters``
+        and ``gauges``. Each histogram is a dictionary of its ``buckets``, its
+        cumulative bucket ``counts``, its ``count``, the ``sum`` of its values
+        and their ``unit``, which is ``None`` for histograms of counts.
+        """
+        with self._lock:
+            histograms = dict((name, [list(h[0])] + h[1:])
+                              for name, h in self._histograms.items())
+            counters = dict(self._counters)
+        rv = dict(histograms={}, counters=counters, gauges={})
+        for name, (counts, count, total, buckets, unit) in histograms.items():
+            cumulative = []
+            for value in counts:
+                cumulative.append(value + (cumulative[-1] if cumulative else 0))
+            rv['histograms'][name] = dict(buckets=buckets, counts=cumulative,
+                                          count=count, sum=total, unit=unit)
+        for name, fn in self._gauges.items():
+            for key, value in fn().items():
+                rv['gauges']['%s_%s' % (name, key)] = value
+        return rv
+
+    def _get_name(self, name):
+        return ('%s_%s' % (self.prefix, name)).replace('.', '_')
+
+    def to_prometheus(self):
+        """Returns the collected metrics in the Prometheus text format."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            name = self._get_name(name)
+            if histogram['unit'] is not None:
+                name += '_' + histogram['unit']
+            lines.append('# TYPE %s histogram' % name)
+            bounds = ['%g' % b for b in histogram['buckets']] + ['+Inf']
+            for bound, count in zip(bounds, histogram['counts']):
+                lines.append('%s_bucket{le="%s"} %d' % (name, bound, count))
+            lines.append('%s_sum %r' % (name, histogram['sum']))
+            lines.append('%s_count %d' % (name, histogram['count']))
+        for name, value in sorted(snapshot['counters'].items()):
+            name = self._get_name(name) + '_total'
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %r' % (name, value))
+        for name, value in sorted(snapshot['gauges'].items()):
+            name = self._get_name(name)
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %r' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdCollector(MetricsCollector):
+    """A :class:`MetricsCollector` that additionally sends every observation
+    to a StatsD server over UDP. Latencies are sent as timers in
+    milliseconds and counters as counts. Send errors are ignored.
+
+    :param host: The host of the StatsD server
+    :param port: The port of the StatsD server
+    :param kwargs: The arguments of :class:`MetricsCollector`
+    """
+
+    def __init__(self, host='localhost', port=8125, **kwargs):
+        super(StatsdCollector, self).__init__(**kwargs)
+        self.address = (host, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def _send(self, data):
+        try:
+            self._socket.sendto(data.encode('utf-8'), self.address)
+        except (socket.error, UnicodeError):
+            pass
+
+    def observe(self, name, seconds):
+        super(StatsdCollector, self).observe(name, seconds)
+        self._send('%s.%s:%.3f|ms' % (self.prefix, name, seconds * 1000))
+
+    def observe_count(self, name, value):
+        super(StatsdCollector, self).observe_count(name, value)
+        self._send('%s.%s:%d|h' % (self.prefix, name, value))
+
+    def incr(self, name, value=1):
+        super(StatsdCollector, self).incr(name, value)
+        self._send('%s.%s:%d|c' % (self.prefix, name, value))
+
+
+class MeteredUserDatastore(object):
+    """Wraps a user datastore to time and count the calls of its public
+    methods, in total and per request. It is installed automatically when
+    metrics are enabled.
+
+    :param datastore: The user datastore to wrap
+    :param collector: The :class:`MetricsCollector` to report to
+    """
+
+    def __init__(self, datastore, collector):
+        self.datastore = datastore
+        self.collector = collector
+
+    def __getattr__(self, name):
+        rv = getattr(self.datastore, name)
+        if name.startswith('_') or not callable(rv) or isinstance(rv, type):
+            return rv
+
+        @functools.wraps(rv)
+        def wrapper(*args, **kwargs):
+            self.collector.incr('datastore_calls')
+            if has_app_context():
+                g._security_datastore_calls = \
+                    getattr(g, '_security_datastore_calls', 0) + 1
+            with self.collector.timer('datastore.' + name):
+                return rv(*args, **kwargs)
+        # later lookups find the wrapper without calling __getattr__
+        setattr(self, name, wrapper)
+        return wrapper
+
+
+def start_request(collector):
+    """Counts a request and resets its count of datastore calls.
+
+    :param collector: The :class:`MetricsCollector` to report to
+    """
+    collector.incr('requests')
+    g._security_datastore_calls = 0
+
+
+def end_request(collector):
+    """Observes the number of datastore calls of a request.
+
+    :param collector: The :class:`MetricsCollector` to report to
+    """
+    calls = getattr(g, '_security_datastore_calls', None)
+    if calls is not None:
+        collector.observe_count('datastore_calls_per_request', calls)
+        del g._security_datastore_calls
+
+
+def get_collector():
+    """Returns the :class:`MetricsCollector` of the current application, or
+    ``None`` when metrics are disabled or there is no application context.
+    """
+    if not current_app:
+        return None
+    state = current_app.extensions.get('security')
+    return getattr(state, 'metrics_collector', None)
+
+
+def timer(name):
+    """Returns a context manager timing its block with the current
+    application's collector. It does nothing when metrics are disabled.
+
+    :param name: The name of the histogram
+    """
+    collector = get_collector()
+    if collector is None:
+        return _null_timer
+    return collector.timer(name)
+
+
+def incr(name, value=1):
+    """Increments a counter of the current application's collector. It does
+    nothing when metrics are disabled.
+
+    :param name: The name of the counter
+    :param value: The amount to increment the counter by
+    """
+    collector = get_collector()
+    if collector is not None:
+        collector.incr(name, value)
+
+
+def record_cache(name, hit):
+    """Counts a hit or miss of one of Flask-Security's caches.
+
+    :param name: The name of the cache
+    :param hit: Whether the lookup was a hit
+    """
+    collector = get_collector()
+    if collector is not None:
+        collector.incr('%s_cache_%s' % (name, 'hits' if hit else 'misses'))
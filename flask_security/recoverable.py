@@ -14,7 +14,7 @@ from werkzeug.local import LocalProxy
 
 from .signals import password_reset, reset_password_instructions_sent
 from .utils import send_mail, md5, encrypt_password, url_for_security, \
-    get_token_status, config_value
+    get_token_status, config_value, invalidate_token_cache
 
 
 # Convenient references
@@ -77,5 +77,6 @@ def update_password(user, password):
     """
     user.password = encrypt_password(password)
     _datastore.put(user)
+    invalidate_token_cache(user)
     send_password_reset_notice(user)
     password_reset.send(app._get_current_object(), user=user)
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.security.revocation
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Flask-Security token revocation module
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import hashlib
+import math
+import struct
+import threading
+import time
+
+
+def get_token_id(token):
+    """Returns the ID under which a token is revoked.
+
+    :param token: The token
+    """
+    if not isinstance(token, bytes):
+        token = token.encode('utf-8')
+    return hashlib.sha1(token).hexdigest()
+
+
+class BloomFilter(object):
+    """A set of strings that answers membership queries in constant time and
+    space with a bounded rate of false positives and no false negatives.
+
+    :param capacity: The number of items the filter is sized for
+    :param error_rate: The rate of false positives at `capacity` items
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.001):
+        bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.size = max(int(math.ceil(bits)), 8)
+        self.hashes = max(int(round(self.size / float(capacity) * math.log(2))), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _get_positions(self, item):
+        if not isinstance(item, bytes):
+            item = item.encode('utf-8')
+        h1, h2 = struct.unpack('>QQ', hashlib.md5(item).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._get_positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        bits = self._bits
+        for position in self._get_positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class MemoryRevocationStore(object):
+    """Keeps revocations in process memory. Entries are never evicted, only
+    removed by :meth:`compact` once they expire, but they are lost when the
+    process exits and are not shared between processes. Use a
+    :class:`SQLRevocationStore` for that.
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._tokens = {}
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def append(self, kind, key, value, expires):
+        """Adds a revocation and returns its version.
+
+        :param kind: ``'t'`` for a token or ``'u'`` for a user cutoff
+        :param key: The token ID or user ID
+        :param value: The cutoff of a user, ``0`` for a token
+        :param expires: The time the revocation expires at, or ``None``
+        """
+        with self._lock:
+            self._version += 1
+            self._entries.append((self._version, kind, key, value, expires))
+            if kind == 't':
+                self._tokens[key] = expires
+            return self._version
+
+    def read(self, version):
+        """Returns the ``(kind, key, value)`` tuples of the unexpired
+        revocations added after a version, and the latest version.
+
+        :param version: The version to read from
+        """
+        now = time.time()
+        with self._lock:
+            entries = [(kind, key, value)
+                       for v, kind, key, value, expires in self._entries
+                       if v > version and (expires is None or expires > now)]
+            return entries, self._version
+
+    def has_token(self, token_id):
+        """Returns ``True`` if an unexpired revocation of a token exists.
+
+        :param token_id: The ID of the token
+        """
+        expires = self._tokens.get(token_id, 0)
+        return expires is None or expires > time.time()
+
+    def compact(self):
+        """Removes the expired revocations."""
+        now = time.time()
+        with self._lock:
+            self._entries = [entry for entry in self._entries
+                             if entry[4] is None or entry[4] > now]
+            self._tokens = dict((key, expires) for key, expires in self._tokens.items()
+                                if expires is None or expires > now)
+
+
+class SQLRevocationStore(object):
+    """Keeps revocations in a SQL table, which is created if it does not
+    exist, so that they survive restarts and are shared by every process.
+    Requires SQLAlchemy. The store shares the connection pool of the engine
+    it is given or creates a pooled engine for a database URL.
+
+    Versions are assigned when rows are inserted but rows become visible
+    when they are committed, which may happen out of order. Each read
+    therefore also covers the `reread_window` versions below the given one;
+    reapplying a revocation has no effect.
+
+    :param bind: An SQLAlchemy engine or a database URL
+    :param table_name: The name of the revocations table
+    :param reread_window: The number of versions below the last read one
+                          that are read again
+    :param engine_options: The arguments of ``sqlalchemy.create_engine``
+                           when `bind` is a URL
+    """
+
+    def __init__(self, bind, table_name='security_revocations',
+                 reread_window=100, **engine_options):
+        import sqlalchemy as sa
+
+        self.reread_window = reread_window
+
+        if isinstance(bind, sa.engine.Engine):
+            self.engine = bind
+        else:
+            self.engine = sa.create_engine(bind, **engine_options)
+        self.table = sa.Table(
+            table_name, sa.MetaData(),
+            sa.Column('version', sa.Integer, primary_key=True),
+            sa.Column('kind', sa.String(1), nullable=False),
+            sa.Column('key', sa.String(128), nullable=False, index=True),
+            sa.Column('value', sa.BigInteger, nullable=False),
+            sa.Column('expires', sa.Float, index=True),
+            # never reuse the versions of compacted rows
+            sqlite_autoincrement=True)
+        self.table.create(self.engine, checkfirst=True)
+
+    def _unexpired(self):
+        import sqlalchemy as sa
+
+        column = self.table.c.expires
+        return sa.or_(column == None, column > time.time())  # noqa
+
+    def append(self, kind, key, value, expires):
+        with self.engine.begin() as conn:
+            rv = conn.execute(self.table.insert().values(
+                kind=kind, key=key, value=value, expires=expires))
+            return rv.inserted_primary_key[0]
+
+    def read(self, version):
+        import sqlalchemy as sa
+
+        table = self.table
+        query = sa.select([table.c.version, table.c.kind, table.c.key,
+                           table.c.value]) \
+            .where(sa.and_(table.c.version > version - self.reread_window,
+                           self._unexpired())) \
+            .order_by(table.c.version)
+        with self.engine.connect() as conn:
+            rows = conn.execute(query).fetchall()
+        # only versions that were actually read count as seen
+        latest = max([row[0] for row in rows] + [version])
+        return [tuple(row[1:]) for row in rows], latest
+
+    def has_token(self, token_id):
+        import sqlalchemy as sa
+
+        table = self.table
+        query = sa.select([table.c.version]).where(sa.and_(
+            table.c.kind == 't', table.c.key == token_id, self._unexpired()))
+        with self.engine.connect() as conn:
+            return conn.execute(query).first() is not None
+
+    def compact(self):
+        table = self.table
+        with self.engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.expires <= time.time()))
+
+
+class RevocationList(object):
+    """Keeps track of revoked tokens. Tokens are revoked individually with
+    :meth:`revoke` or for a user with :meth:`revoke_user`, which revokes
+    every token issued to the user so far.
+
+    Revocations are kept in a store such as a :class:`MemoryRevocationStore`
+    or a :class:`SQLRevocationStore`. Each process reads the revocations
+    added since its last read at most every `refresh_interval` seconds into
+    an in-memory bloom filter of the revoked token IDs and a dictionary of
+    the per-user cutoffs, so checking a token that was not revoked does not
+    touch the store. Revocations expire after `max_age` seconds, when the
+    tokens they revoke have expired too, and are removed from the store and
+    the in-memory filter every `compact_interval` seconds.
+
+    :param store: The store to keep the revocations in
+    :param capacity: The number of revoked tokens the bloom filter is sized
+                     for
+    :param error_rate: The rate of bloom filter false positives, each of
+                       which costs a store lookup
+    :param refresh_interval: The number of seconds between reads of the
+                             store
+    :param max_age: The number of seconds after which revoked tokens have
+                    expired, or ``None`` if tokens do not expire
+    :param compact_interval: The number of seconds between removals of
+                             expired revocations
+    """
+
+    def __init__(self, store, capacity=100000, error_rate=0.001,
+                 refresh_interval=1, max_age=None, compact_interval=3600):
+        self.store = store
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.compact_interval = compact_interval
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._cutoffs = {}
+        self._version = 0
+        self._refreshed = 0
+        self._compacted = time.time()
+        self._lock = threading.Lock()
+
+    def _get_expiry(self):
+        return None if self.max_age is None else time.time() + self.max_age
+
+    def _apply(self, kind, key, value):
+        if kind == 't':
+            self._bloom.add(key)
+        else:
+            self._cutoffs[key] = max(value, self._cutoffs.get(key, 0))
+
+    def refresh(self):
+        """Applies the revocations made by other processes."""
+        with self._lock:
+            now = time.time()
+            self._refreshed = now
+            if self.max_age is not None and \
+                    now - self._compacted >= self.compact_interval:
+                # rebuild the in-memory state without the expired entries
+                self._compacted = now
+                self.store.compact()
+                self._bloom = BloomFilter(self.capacity, self.error_rate)
+                self._cutoffs, self._version = {}, 0
+            entries, self._version = self.store.read(self._version)
+            for kind, key, value in entries:
+                self._apply(kind, key, value)
+
+    def revoke(self, token):
+        """Revokes a token.
+
+        :param token: The token to revoke
+        """
+        token_id = get_token_id(token)
+        self.store.append('t', token_id, 0, self._get_expiry())
+        with self._lock:
+            self._apply('t', token_id, 0)
+
+    def revoke_user(self, user_id):
+        """Revokes every token issued to a user until now. Tokens issued
+        within the current second are revoked as well.
+
+        :param user_id: The ID of the user
+        """
+        user_id, cutoff = str(user_id), int(time.time())
+        self.store.append('u', user_id, cutoff, self._get_expiry())
+        with self._lock:
+            self._apply('u', user_id, cutoff)
+
+    def is_revoked(self, token, user_id, issued_at):
+        """Returns ``True`` if a token was revoked.
+
+        :param token: The token to check
+        :param user_id: The ID of the user the token was issued to
+        :param issued_at: The time the token was issued at, in seconds since
+                          the epoch
+        """
+        if time.time() - self._refreshed >= self.refresh_interval:
+            self.refresh()
+        cutoff = self._cutoffs.get(str(user_id))
+        if cutoff is not None and issued_at <= cutoff:
+            return True
+        token_id = get_token_id(token)
+        if token_id not in self._bloom:
+            return False
+        return self.store.has_token(token_id)
@@ -15,13 +15,22 @@ try:
 except ImportError:
     import json
 
+import csv
+import io
+import multiprocessing
 import re
+import time
+
+from itertools import islice
 
 from flask import current_app
 from flask.ext.script import Command, Option
+from werkzeug.datastructures import MultiDict
 from werkzeug.local import LocalProxy
 
-from .utils import encrypt_password
+from .forms import Form, EmailFormMixin, NewPasswordFormMixin
+from .utils import encrypt_password, encrypt_passwords, get_message, \
+    string_types, PY3
 
 
 _datastore = LocalProxy(lambda: current_app.extensions['security'].datastore)
@@ -31,6 +40,12 @@ def pprint(obj):
     print(json.dumps(obj, sort_keys=True, indent=4))
 
 
+def parse_active(value):
+    # sanitize active input
+    ai = re.sub(r'\s', '', str(value))
+    return ai.lower() in ['', 'y', 'yes', '1', 'active']
+
+
 def commit(fn):
     def wrapper(*args, **kwargs):
         fn(*args, **kwargs)
@@ -49,12 +64,9 @@ class CreateUserCommand(Command):
 
     @commit
     def run(self, **kwargs):
-        # sanitize active input
-        ai = re.sub(r'\s', '', str(kwargs['active']))
-        kwargs['active'] = ai.lower() in ['', 'y', 'yes', '1', 'active']
+        kwargs['active'] = parse_active(kwargs['active'])
 
         from flask_security.forms import ConfirmRegisterForm
-        from werkzeug.datastructures import MultiDict
 
         form = ConfirmRegisterForm(MultiDict(kwargs), csrf_enabled=False)
 
@@ -69,6 +81,112 @@ class CreateUserCommand(Command):
             pprint(form.errors)
 
 
+class ImportUserForm(Form, EmailFormMixin, NewPasswordFormMixin):
+    pass
+
+
+class ImportUsersCommand(Command):
+    """Import users from a CSV or JSON lines file"""
+
+    option_list = (
+        Option('-f', '--file', dest='path'),
+        Option('-t', '--format', dest='fmt', default=None,
+               choices=['csv', 'jsonl']),
+        Option('-b', '--batch-size', dest='batch_size', type=int, default=1000),
+        Option('-p', '--processes', dest='processes', type=int, default=None),
+    )
+
+    def run(self, path, fmt=None, batch_size=1000, processes=None):
+        fmt = fmt or ('csv' if path.endswith('.csv') else 'jsonl')
+        processes = processes or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        seen, roles, created, failed = set(), {}, 0, 0
+        started = time.time()
+
+        try:
+            with self.open(path) as f:
+                rows = enumerate(self.read_rows(f, fmt), 1)
+                while True:
+                    batch = list(islice(rows, batch_size))
+                    if not batch:
+                        break
+                    users = []
+                    results = self.validate([row for line, row in batch],
+                                            seen, roles)
+                    for (line, row), errors in zip(batch, results):
+                        if errors:
+                            failed += 1
+                            print('Error importing row %d' % line)
+                            pprint(errors)
+                        else:
+                            row['roles'] = [roles[name] for name in row['roles']]
+                            users.append(row)
+                    passwords = encrypt_passwords(
+                        [user['password'] for user in users], pool=pool)
+                    for user, password in zip(users, passwords):
+                        user['password'] = password
+                    _datastore.create_users(users)
+                    _datastore.commit()
+                    created += len(users)
+                    elapsed = time.time() - started
+                    print('%d users imported, %d errors, %.1f users/s' %
+                          (created, failed, created / elapsed if elapsed else 0))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def open(self, path):
+        if PY3:
+            return io.open(path, encoding='utf-8', newline='')
+        return open(path, 'rb')
+
+    def read_rows(self, f, fmt):
+        if fmt == 'csv':
+            for row in csv.DictReader(f):
+                yield self.prepare(dict((k, v) for k, v in row.items() if v))
+        else:
+            for line in f:
+                if line.strip():
+                    yield self.prepare(json.loads(line))
+
+    def prepare(self, row):
+        if 'active' in row and not isinstance(row['active'], bool):
+            row['active'] = parse_active(row['active'])
+        roles = row.get('roles', [])
+        if isinstance(roles, string_types):
+            roles = [r.strip() for r in roles.split(',') if r.strip()]
+        row['roles'] = roles
+        return row
+
+    def validate(self, rows, seen, roles):
+        emails = [row['email'] for row in rows if row.get('email')]
+        existing = set(email.lower() for email in
+                       _datastore.find_existing_emails(emails))
+        rv = []
+        for row in rows:
+            data = dict((key, row[key]) for key in ('email', 'password')
+                        if row.get(key))
+            form = ImportUserForm(MultiDict(data), csrf_enabled=False)
+            form.validate()
+            errors = dict(form.errors)
+            email = row.get('email')
+            if 'email' not in errors:
+                if email.lower() in seen or email.lower() in existing:
+                    errors['email'] = [get_message('EMAIL_ALREADY_ASSOCIATED',
+                                                   email=email)[0]]
+                else:
+                    seen.add(email.lower())
+            for name in row['roles']:
+                if name not in roles:
+                    roles[name] = _datastore.find_role(name)
+                if roles[name] is None:
+                    errors.setdefault('roles', []).append(
+                        get_message('ROLE_DOES_NOT_EXIST', role=name)[0])
+            rv.append(errors)
+        return rv
+
+
 class CreateRoleCommand(Command):
     """Create a role"""
 
@@ -108,6 +226,84 @@ class RemoveRoleCommand(_RoleCommand):
         print("Role '%s' removed from user '%s' successfully" % (role_name, user_identifier))
 
 
+def read_batches(path, size):
+    with open(path) as f:
+        lines = (line.strip() for line in f)
+        users = (line for line in lines if line)
+        while True:
+            batch = list(islice(users, size))
+            if not batch:
+                break
+            yield batch
+
+
+def find_roles(names):
+    roles = []
+    for name in names:
+        role = _datastore.find_role(name)
+        if role is None:
+            print(get_message('ROLE_DOES_NOT_EXIST', role=name)[0])
+            return None
+        roles.append(role)
+    return roles
+
+
+class _BulkRoleCommand(Command):
+    option_list = (
+        Option('-f', '--file', dest='path'),
+        Option('-r', '--role', dest='role_name'),
+        Option('-b', '--batch-size', dest='batch_size', type=int, default=1000),
+    )
+
+
+class AddRoleToUsersCommand(_BulkRoleCommand):
+    """Add a role to the users listed in a file"""
+
+    def run(self, path, role_name, batch_size=1000):
+        roles = find_roles([role_name])
+        if roles is None:
+            return
+        count = 0
+        for batch in read_batches(path, batch_size):
+            count += _datastore.add_role_to_users(batch, roles[0])
+            _datastore.commit()
+        print("Role '%s' added to %d users successfully" % (role_name, count))
+
+
+class RemoveRoleFromUsersCommand(_BulkRoleCommand):
+    """Remove a role from the users listed in a file"""
+
+    def run(self, path, role_name, batch_size=1000):
+        roles = find_roles([role_name])
+        if roles is None:
+            return
+        count = 0
+        for batch in read_batches(path, batch_size):
+            count += _datastore.remove_role_from_users(batch, roles[0])
+            _datastore.commit()
+        print("Role '%s' removed from %d users successfully" % (role_name, count))
+
+
+class SetUserRolesCommand(Command):
+    """Replace the roles of the users listed in a file"""
+
+    option_list = (
+        Option('-f', '--file', dest='path'),
+        Option('-r', '--roles', dest='role_names', default=''),
+        Option('-b', '--batch-size', dest='batch_size', type=int, default=1000),
+    )
+
+    def run(self, path, role_names, batch_size=1000):
+        roles = find_roles([name.strip() for name in role_names.split(',')
+                            if name.strip()])
+        if roles is None:
+            return
+        for batch in read_batches(path, batch_size):
+            _datastore.set_user_roles(batch, roles)
+            _datastore.commit()
+        print("Roles of the listed users set to '%s' successfully" % role_names)
+
+
 class _ToggleActiveCommand(Command):
     option_list = (
         Option('-u', '--user', dest='user_identifier'),
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.security.session
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Flask-Security session module
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import base64
+import binascii
+import os
+import struct
+import threading
+import time
+
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, \
+    SessionMixin, session_json_serializer, total_seconds
+from werkzeug.datastructures import CallbackDict
+
+from .utils import string_types, text_type, _SESSION_GENERATION_KEY, \
+    _SESSION_USER_KEY
+
+
+class SessionSerializer(object):
+    """Encodes the snapshot of the logged in user that is kept in the session
+    when ``SECURITY_LAZY_USER`` is enabled. The snapshot is a dictionary of
+    the user's ``id``, ``active`` flag, password ``fingerprint``,
+    ``role_version``, ``expires`` time and optionally ``roles``.
+
+    This serializer stores the snapshot as it is. Subclass it and pass an
+    instance as the `session_serializer` of
+    :meth:`~flask_security.core.Security.init_app` to store it differently.
+    """
+
+    def dumps(self, snapshot):
+        """Returns the session value of a snapshot.
+
+        :param snapshot: The snapshot to encode
+        """
+        return snapshot
+
+    def loads(self, data):
+        """Returns the snapshot stored in a session value, or ``None`` if the
+        value is missing or invalid.
+
+        :param data: The session value
+        """
+        return data if isinstance(data, dict) else None
+
+
+class CompactCookieSerializer(object):
+    """Serializes cookie sessions for :class:`CompactCookieSessionInterface`.
+    A session that only holds Flask-Login's ``user_id``, ``_fresh`` and
+    ``_id`` keys and the user snapshot is packed into a short binary string.
+    The snapshot's role names are left out and are read from the role cache
+    instead, and only the first eight bytes of its password fingerprint are
+    kept. Any other session is stored as JSON.
+    """
+
+    _marker = b'\x00'
+    _header = struct.Struct('>BB')
+    _snapshot = struct.Struct('>Id8s')
+    _snapshot_keys = frozenset(['id', 'active', 'fingerprint', 'role_version',
+                                'expires', 'roles'])
+    _fresh = 1
+    _has_fresh = 2
+    _has_user = 4
+    _has_snapshot = 8
+    _active = 16
+    _int_id = 32
+
+    def _pack(self, data):
+        if not set(data) <= set(['user_id', '_fresh', '_id', _SESSION_USER_KEY]):
+            return None
+        flags, parts = 0, []
+        if '_fresh' in data:
+            flags |= self._has_fresh | (self._fresh if data['_fresh'] else 0)
+        identifier = binascii.unhexlify(data.get('_id', '').encode('ascii'))
+        if '_id' in data and (not identifier or len(identifier) > 255 or
+                              binascii.hexlify(identifier).decode('ascii') !=
+                              data['_id']):
+            return None
+        parts.append(identifier)
+        user_id = data.get('user_id')
+        if user_id is not None:
+            if not isinstance(user_id, string_types) or not user_id:
+                return None
+            flags |= self._has_user
+        snapshot = data.get(_SESSION_USER_KEY)
+        if snapshot is not None:
+            if not isinstance(snapshot, dict) or user_id is None or \
+                    not set(snapshot) <= self._snapshot_keys or \
+                    text_type(snapshot['id']) != user_id or \
+                    not 0 <= snapshot['expires'] < 2 ** 32:
+                return None
+            flags |= self._has_snapshot
+            if snapshot['active']:
+                flags |= self._active
+            if isinstance(snapshot['id'], int) and \
+                    not isinstance(snapshot['id'], bool):
+                flags |= self._int_id
+            parts.append(self._snapshot.pack(
+                int(snapshot['expires']), snapshot.get('role_version') or 0.0,
+                binascii.unhexlify(snapshot['fingerprint'][:16].encode('ascii'))))
+        if user_id is not None:
+            parts.append(user_id.encode('utf-8'))
+        return self._marker + self._header.pack(flags, len(identifier)) + \
+            b''.join(parts)
+
+    def dumps(self, data):
+        try:
+            rv = self._pack(data)
+        except (AttributeError, KeyError, TypeError, ValueError, UnicodeError,
+                struct.error):
+            rv = None
+        if rv is None:
+            rv = session_json_serializer.dumps(data).encode('utf-8')
+        return rv
+
+    def _unpack(self, payload):
+        flags, length = self._header.unpack(payload[:self._header.size])
+        offset = self._header.size + length
+        rv = {}
+        if length:
+            identifier = payload[self._header.size:offset]
+            rv['_id'] = binascii.hexlify(identifier).decode('ascii')
+        if flags & self._has_fresh:
+            rv['_fresh'] = bool(flags & self._fresh)
+        if flags & self._has_snapshot:
+            expires, role_version, fingerprint = self._snapshot.unpack(
+                payload[offset:offset + self._snapshot.size])
+            offset += self._snapshot.size
+            rv[_SESSION_USER_KEY] = dict(
+                active=bool(flags & self._active), expires=expires,
+                fingerprint=binascii.hexlify(fingerprint).decode('ascii'),
+                role_version=role_version or None)
+        if flags & self._has_user:
+            rv['user_id'] = payload[offset:].decode('utf-8')
+            if flags & self._has_snapshot:
+                user_id = rv['user_id']
+                rv[_SESSION_USER_KEY]['id'] = \
+                    int(user_id) if flags & self._int_id else user_id
+        return rv
+
+    def loads(self, payload):
+        if payload[:1] == self._marker:
+            return self._unpack(payload[1:])
+        return session_json_serializer.loads(payload.decode('utf-8'))
+
+
+class CompactCookieSessionInterface(SecureCookieSessionInterface):
+    """Stores the Flask session in a signed cookie like Flask's default
+    interface, but packs the keys of a logged in user into a short binary
+    string with :class:`CompactCookieSerializer`. Flask-Security installs it
+    when ``SECURITY_SESSION_FORMAT`` is ``compact``.
+    """
+
+    serializer = CompactCookieSerializer()
+
+
+class MemorySessionStore(object):
+    """Keeps server-side sessions in process memory. It implements the
+    subset of the Redis client interface that :class:`ServerSessionInterface`
+    uses. Sessions are lost when the process exits and are not shared
+    between processes.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+            return None
+        return entry[0]
+
+    def setex(self, key, timeout, value):
+        self._data[key] = (value, time.time() + timeout)
+
+    def delete(self, *keys):
+        for key in keys:
+            self._data.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            value = int(self.get(key) or 0) + 1
+            self._data[key] = (str(value).encode('ascii'), None)
+        return value
+
+    def sweep(self):
+        """Removes the expired sessions and returns their number."""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (value, expires) in list(self._data.items())
+                       if expires is not None and expires <= now]
+            for key in expired:
+                self._data.pop(key, None)
+        return len(expired)
+
+
+class SQLSessionStore(object):
+    """Keeps server-side sessions in a SQL table, which is created if it does
+    not exist. Requires SQLAlchemy. The store shares the connection pool of
+    the engine it is given, for example the ``engine`` of a Flask-SQLAlchemy
+    database, or creates a pooled engine for a database URL.
+
+    :param bind: An SQLAlchemy engine or a database URL
+    :param table_name: The name of the sessions table
+    :param engine_options: The arguments of ``sqlalchemy.create_engine``
+                           when `bind` is a URL, for example ``pool_size``
+    """
+
+    def __init__(self, bind, table_name='security_sessions', **engine_options):
+        import sqlalchemy as sa
+
+        if isinstance(bind, sa.engine.Engine):
+            self.engine = bind
+        else:
+            self.engine = sa.create_engine(bind, **engine_options)
+        self.table = sa.Table(
+            table_name, sa.MetaData(),
+            sa.Column('key', sa.String(128), primary_key=True),
+            sa.Column('value', sa.LargeBinary),
+            sa.Column('counter', sa.Integer),
+            sa.Column('expires', sa.Float, index=True))
+        self.table.create(self.engine, checkfirst=True)
+
+    def get(self, key):
+        import sqlalchemy as sa
+
+        table = self.table
+        query = sa.select([table.c.value, table.c.counter]).where(sa.and_(
+            table.c.key == key,
+            sa.or_(table.c.expires == None, table.c.expires > time.time())))  # noqa
+        with self.engine.connect() as conn:
+            row = conn.execute(query).first()
+        if row is None:
+            return None
+        if row[0] is None:
+            return str(row[1]).encode('ascii')
+        return bytes(row[0])
+
+    def _set(self, conn, key, value, expires):
+        table = self.table
+        rv = conn.execute(table.update().where(table.c.key == key).values(
+            value=value, expires=expires))
+        if not rv.rowcount:
+            conn.execute(table.insert().values(key=key, value=value, expires=expires))
+
+    def setex(self, key, timeout, value):
+        with self.engine.begin() as conn:
+            self._set(conn, key, value, time.time() + timeout)
+
+    def delete(self, *keys):
+        if keys:
+            with self.engine.begin() as conn:
+                conn.execute(self.table.delete().where(self.table.c.key.in_(keys)))
+
+    def incr(self, key):
+        """Increments a counter with a single ``UPDATE`` statement. A missing
+        counter is inserted, and the update is retried if another process
+        inserted it first."""
+        import sqlalchemy as sa
+
+        table = self.table
+        update = table.update().where(table.c.key == key) \
+            .values(counter=table.c.counter + 1)
+        query = sa.select([table.c.counter]).where(table.c.key == key)
+        while True:
+            with self.engine.begin() as conn:
+                if conn.execute(update).rowcount:
+                    return conn.execute(query).scalar()
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(table.insert().values(key=key, counter=1))
+                return 1
+            except sa.exc.IntegrityError:
+                pass
+
+    def sweep(self):
+        """Removes the expired sessions with a single statement and returns
+        their number."""
+        table = self.table
+        with self.engine.begin() as conn:
+            return conn.execute(table.delete().where(
+                table.c.expires <= time.time())).rowcount
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """A session whose data is kept in a session store. The cookie only
+    holds its random ID."""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class ServerSessionInterface(SessionInterface):
+    """Stores the Flask session in a session store instead of the session
+    cookie. Flask-Security installs it when ``SECURITY_SERVER_SESSION`` is
+    enabled.
+
+    The store needs the ``get``, ``setex``, ``delete`` and ``incr`` methods
+    of a Redis client, so a ``redis.StrictRedis`` instance can be used as
+    is. Stores with a ``sweep`` method, like :class:`MemorySessionStore` and
+    :class:`SQLSessionStore`, have their expired sessions removed every
+    `sweep_interval` seconds.
+
+    Each user has a session generation that is saved in their sessions at
+    login. :meth:`revoke_user` bumps it, which ends all of the user's
+    sessions the next time they are used.
+
+    :param store: The session store
+    :param key_prefix: A prefix for the store keys
+    :param sweep_interval: The number of seconds between sweeps of expired
+                           sessions
+    """
+
+    serializer = session_json_serializer
+
+    def __init__(self, store, key_prefix='session:', sweep_interval=60):
+        self.store = store
+        self.key_prefix = key_prefix
+        self.sweep_interval = sweep_interval
+        self._swept = time.time()
+
+    def _generate_sid(self):
+        return base64.urlsafe_b64encode(os.urandom(24)).decode('ascii')
+
+    def _get_generation_key(self, user_id):
+        return '%sgeneration:%s' % (self.key_prefix, user_id)
+
+    def get_generation(self, user_id):
+        """Returns the current session generation of a user.
+
+        :param user_id: The ID of the user
+        """
+        return int(self.store.get(self._get_generation_key(user_id)) or 0)
+
+    def revoke_user(self, user_id):
+        """Ends every session of a user.
+
+        :param user_id: The ID of the user
+        """
+        self.store.incr(self._get_generation_key(user_id))
+
+    def regenerate(self, session):
+        """Moves a session to a new ID, for example when a user logs in or
+        out, so that a previously known ID can not be used to take it over.
+
+        :param session: The session to move
+        """
+        if session.sid is not None and not session.new:
+            self.store.delete(self.key_prefix + session.sid)
+        session.sid = self._generate_sid()
+        session.new = session.modified = True
+
+    def _is_current(self, data):
+        user_id = data.get('user_id')
+        return user_id is None or \
+            data.get(_SESSION_GENERATION_KEY) == self.get_generation(user_id)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid and len(sid) <= 64:
+            data = self.store.get(self.key_prefix + sid)
+            if data is not None:
+                data = self.serializer.loads(data.decode('utf-8'))
+                if self._is_current(data):
+                    return ServerSession(data, sid=sid)
+                self.store.delete(self.key_prefix + sid)
+        return ServerSession(sid=self._generate_sid(), new=True)
+
+    def _sweep(self):
+        sweep = getattr(self.store, 'sweep', None)
+        if sweep is not None and time.time() - self._swept >= self.sweep_interval:
+            self._swept = time.time()
+            sweep()
+
+    def save_session(self, app, session, response):
+        self._sweep()
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                if not session.new:
+                    self.store.delete(self.key_prefix + session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+        if not session.modified and not session.permanent:
+            return
+        if 'user_id' in session and _SESSION_GENERATION_KEY not in session:
+            # logged in without login_user, for example from a remember cookie
+            session[_SESSION_GENERATION_KEY] = self.get_generation(session['user_id'])
+        timeout = int(total_seconds(app.permanent_session_lifetime))
+        data = self.serializer.dumps(dict(session)).encode('utf-8')
+        self.store.setex(self.key_prefix + session.sid, timeout, data)
+        response.set_cookie(app.session_cookie_name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app))
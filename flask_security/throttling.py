@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.security.throttling
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Flask-Security login throttling module
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import hashlib
+import math
+import time
+
+
+class LoginThrottled(Exception):
+    """Raised when a login attempt exceeds a rate limit.
+
+    :param retry_after: The number of seconds after which the attempt may be
+                        retried
+    """
+
+    def __init__(self, retry_after):
+        super(LoginThrottled, self).__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class LoginThrottle(object):
+    """Limits the failed login attempts per remote address and per identity
+    over a sliding window. Attempts are counted in fixed windows and the
+    count of the previous window is weighted by how much of it still
+    overlaps the sliding window.
+
+    The counters are kept in a cache implementing the ``add``, ``get`` and
+    ``inc`` methods of the ``werkzeug.contrib.cache`` interface, such as a
+    :class:`~flask_security.cache.LRUCache` or a ``RedisCache`` shared by
+    several processes.
+
+    :param cache: The cache to keep the counters in
+    :param ip_limit: The number of attempts allowed per remote address.
+                     ``0`` disables the limit
+    :param identity_limit: The number of attempts allowed per identity.
+                           ``0`` disables the limit
+    :param window: The length of the sliding window in seconds
+    :param key_prefix: A prefix for the cache keys
+    """
+
+    def __init__(self, cache, ip_limit=50, identity_limit=10, window=300,
+                 key_prefix='throttle:'):
+        self.cache = cache
+        self.ip_limit = ip_limit
+        self.identity_limit = identity_limit
+        self.window = window
+        self.key_prefix = key_prefix
+
+    def _get_keys(self, remote_addr, identity):
+        if self.ip_limit and remote_addr:
+            yield 'ip:%s' % remote_addr, self.ip_limit
+        if self.identity_limit and identity:
+            identity = identity.strip().lower().encode('utf-8')
+            yield 'id:%s' % hashlib.sha1(identity).hexdigest(), self.identity_limit
+
+    def _get_count(self, key, index, now):
+        current = self.cache.get('%s%s:%d' % (self.key_prefix, key, index)) or 0
+        previous = self.cache.get('%s%s:%d' % (self.key_prefix, key, index - 1)) or 0
+        overlap = 1 - (now % self.window) / float(self.window)
+        return previous * overlap + current
+
+    def check(self, remote_addr, identity=None):
+        """Raises :class:`LoginThrottled` if a login attempt would exceed a
+        limit.
+
+        :param remote_addr: The address the attempt is made from
+        :param identity: The identity, for example the email address, the
+                         attempt is made for
+        """
+        now = time.time()
+        index = int(now // self.window)
+        for key, limit in self._get_keys(remote_addr, identity):
+            if self._get_count(key, index, now) >= limit:
+                raise LoginThrottled(int(math.ceil(self.window - now % self.window)))
+
+    def hit(self, remote_addr, identity=None):
+        """Counts a failed login attempt.
+
+        :param remote_addr: The address the attempt was made from
+        :param identity: The identity the attempt was made for
+        """
+        index = int(time.time() // self.window)
+        for key, limit in self._get_keys(remote_addr, identity):
+            key = '%s%s:%d' % (self.key_prefix, key, index)
+            self.cache.add(key, 0, timeout=self.window * 2)
+            self.cache.inc(key)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.security.trackable
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Flask-Security trackable module
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+
+class LoginTracker(object):
+    """Collects login tracking updates in memory and writes them to the
+    datastore from a background thread. Repeated logins of the same user are
+    merged into a single update. Updates are written once `batch_size` users
+    are pending or the oldest pending update is `max_staleness` seconds old,
+    and when the process exits.
+
+    :param app: The application
+    :param batch_size: The number of pending users that triggers a write
+    :param max_staleness: The maximum number of seconds an update is pending
+    """
+
+    def __init__(self, app, batch_size=500, max_staleness=5):
+        self.app = app
+        self.batch_size = batch_size
+        self.max_staleness = max_staleness
+        self._pending = {}
+        self._oldest = None
+        self._stopping = False
+        self._thread = None
+        self._pid = None
+        self._cond = threading.Condition()
+        atexit.register(self.shutdown)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def track(self, user, remote_addr):
+        """Records a login of the specified user.
+
+        :param user: The user that logged in
+        :param remote_addr: The address the user logged in from
+        """
+        self._ensure_started()
+        now = datetime.utcnow()
+        with self._cond:
+            update = self._pending.get(user.id)
+            if update is None:
+                if not self._pending:
+                    self._oldest = time.time()
+                update = self._pending[user.id] = dict(
+                    id=user.id,
+                    last_login_at=user.current_login_at or now,
+                    last_login_ip=user.current_login_ip or remote_addr,
+                    login_count=0)
+            else:
+                update['last_login_at'] = update['current_login_at']
+                update['last_login_ip'] = update['current_login_ip']
+            update['current_login_at'] = now
+            update['current_login_ip'] = remote_addr
+            update['login_count'] += 1
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def flush(self):
+        """Writes all pending updates to the datastore."""
+        with self._cond:
+            updates, self._pending, self._oldest = self._pending, {}, None
+        if not updates:
+            return
+        try:
+            with self.app.app_context():
+                datastore = self.app.extensions['security'].datastore
+                datastore.update_login_tracking(list(updates.values()))
+        except Exception:
+            logger.exception('Failed to write %d login update(s)', len(updates))
+            self._restore(updates)
+
+    def _restore(self, updates):
+        with self._cond:
+            for user_id, update in updates.items():
+                newer = self._pending.get(user_id)
+                if newer is None:
+                    self._pending[user_id] = update
+                    continue
+                newer['last_login_at'] = update['current_login_at']
+                newer['last_login_ip'] = update['current_login_ip']
+                newer['login_count'] += update['login_count']
+            if self._pending and self._oldest is None:
+                self._oldest = time.time()
+
+    def shutdown(self):
+        """Writes all pending updates and stops the background thread."""
+        if self._pid == os.getpid():
+            with self._cond:
+                self._stopping = True
+                self._cond.notify()
+            self._thread.join()
+            self._thread, self._pid = None, None
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    if len(self._pending) >= self.batch_size:
+                        break
+                    if self._pending:
+                        remaining = self._oldest + self.max_staleness - time.time()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+                if self._stopping:
+                    return
+            self.flush()
@@ -11,22 +11,32 @@
 
 import base64
 import blinker
+import calendar
 import functools
 import hashlib
 import hmac
+import random
+import re
 import sys
+import time
 
 from contextlib import contextmanager
 from datetime import datetime, timedelta
 
-from flask import url_for, flash, current_app, request, session, render_template
+from flask import url_for, flash, current_app, request, session, \
+    has_app_context, template_rendered, _request_ctx_stack
 from flask.ext.login import login_user as _login_user, \
     logout_user as _logout_user
 from flask.ext.mail import Message
 from flask.ext.principal import Identity, AnonymousIdentity, identity_changed
 from itsdangerous import BadSignature, SignatureExpired
+from jinja2 import TemplateNotFound
+from markupsafe import escape
+from passlib.context import CryptContext
 from werkzeug.local import LocalProxy
 
+from .hashing import run_in_future, run_in_thread
+from .metrics import record_cache, timer
 from .signals import user_registered, user_confirmed, \
     confirm_instructions_sent, login_instructions_sent, \
     password_reset, password_changed, reset_password_instructions_sent
@@ -38,8 +48,30 @@ _datastore = LocalProxy(lambda: _security.datastore)
 
 _pwd_context = LocalProxy(lambda: _security.pwd_context)
 
+_missing = object()
+
+#: Password hashing contexts of pool worker processes, keyed by scheme
+_hash_contexts = {}
+
+_mail_field_re = re.compile(u'\x00([^\x00]*)\x00')
+
+#: Email templates sent by Flask-Security
+_mail_templates = ('welcome', 'confirmation_instructions', 'login_instructions',
+                   'reset_instructions', 'reset_notice', 'change_notice')
+
 PY3 = sys.version_info[0] == 3
 
+#: The session key of the user snapshot kept when ``SECURITY_LAZY_USER`` is
+#: enabled
+_SESSION_USER_KEY = '_security_user'
+
+#: The session key of the logged in user's session generation when
+#: ``SECURITY_SERVER_SESSION`` is enabled
+_SESSION_GENERATION_KEY = '_security_generation'
+
+#: The attribute the role names of a loaded user are kept in
+_ROLE_NAMES_ATTR = '_security_role_names'
+
 if PY3:
     string_types = str,
     text_type = str
@@ -61,7 +93,17 @@ def login_user(user, remember=None):
     if not _login_user(user, remember):
         return False
 
-    if _security.trackable:
+    if _security.session_interface is not None:
+        interface = _security.session_interface
+        interface.regenerate(session._get_current_object())
+        session[_SESSION_GENERATION_KEY] = interface.get_generation(user.id)
+
+    if _security.lazy_user:
+        _store_session_snapshot(user)
+
+    if _security.login_tracker is not None:
+        _security.login_tracker.track(user, request.remote_addr or 'untrackable')
+    elif _security.trackable:
         old_current_login, new_current_login = user.current_login_at, datetime.utcnow()
         remote_addr = request.remote_addr or 'untrackable'
         old_current_ip, new_current_ip = user.current_login_ip, remote_addr
@@ -79,16 +121,72 @@ def login_user(user, remember=None):
     return True
 
 
+def _get_user_snapshot(user):
+    return dict(id=user.id, active=user.is_active(),
+                fingerprint=md5(user.password),
+                roles=frozenset(role.name for role in user.roles))
+
+
+def get_session_snapshot(user):
+    """Returns the snapshot of the specified user that is kept in the
+    session when ``SECURITY_LAZY_USER`` is enabled. The snapshot expires
+    after roughly ``SECURITY_LAZY_USER_TTL`` seconds; the expiry is spread
+    over the last tenth of that time so that sessions started together do
+    not all reload their users at once.
+
+    :param user: The user to take the snapshot of
+    """
+    ttl = config_value('LAZY_USER_TTL')
+    snapshot = _get_user_snapshot(user)
+    snapshot.update(roles=sorted(snapshot['roles']),
+                    role_version=get_role_version(user),
+                    expires=int(time.time() + ttl * random.uniform(0.9, 1.0)))
+    return snapshot
+
+
+def _store_session_snapshot(user):
+    session[_SESSION_USER_KEY] = \
+        _security.session_serializer.dumps(get_session_snapshot(user))
+
+
 def logout_user():
     """Logs out the current. This will also clean up the remember me cookie if it exists."""
 
-    for key in ('identity.name', 'identity.auth_type'):
+    for key in ('identity.name', 'identity.auth_type', _SESSION_USER_KEY,
+                _SESSION_GENERATION_KEY):
         session.pop(key, None)
+    if _security.session_interface is not None:
+        _security.session_interface.regenerate(session._get_current_object())
     identity_changed.send(current_app._get_current_object(),
                           identity=AnonymousIdentity())
     _logout_user()
 
 
+def check_login_throttle(identity=None):
+    """Raises :class:`~flask_security.throttling.LoginThrottled` if too
+    many logins from the current request's address or for the specified
+    identity failed recently. Does nothing when ``SECURITY_LOGIN_THROTTLE``
+    is disabled.
+
+    :param identity: The identity the attempt is made for, for example an
+                     email address
+    """
+    throttle = _security.login_throttler
+    if throttle is not None:
+        throttle.check(request.remote_addr, identity)
+
+
+def record_failed_login(identity=None):
+    """Counts a failed login from the current request's address for the
+    specified identity. See :func:`check_login_throttle`.
+
+    :param identity: The identity the attempt was made for
+    """
+    throttle = _security.login_throttler
+    if throttle is not None:
+        throttle.hit(request.remote_addr, identity)
+
+
 def get_hmac(password):
     """Returns a Base64 encoded HMAC+SHA512 of the password signed with the salt specified
     by ``SECURITY_PASSWORD_SALT``.
@@ -114,7 +212,7 @@ def verify_password(password, password_hash):
     if _security.password_hash != 'plaintext':
         password = get_hmac(password)
 
-    return _pwd_context.verify(password, password_hash)
+    return _hash('verify', password, password_hash)
 
 
 def verify_and_update_password(password, user):
@@ -127,7 +225,7 @@ def verify_and_update_password(password, user):
 
     if _security.password_hash != 'plaintext':
         password = get_hmac(password)
-    verified, new_password = _pwd_context.verify_and_update(password, user.password)
+    verified, new_password = _hash('verify_and_update', password, user.password)
     if verified and new_password:
         user.password = new_password
         _datastore.put(user)
@@ -142,7 +240,174 @@ def encrypt_password(password):
     if _security.password_hash == 'plaintext':
         return password
     signed = get_hmac(password).decode('ascii')
-    return _pwd_context.encrypt(signed)
+    return _hash('encrypt', signed)
+
+
+def verify_password_async(password, password_hash):
+    """Like :func:`verify_password` but returns a
+    `concurrent.futures.Future` of the result. The password is verified by
+    the hashing workers when ``SECURITY_HASHING_WORKERS`` is set and in a
+    thread pool shared by the process otherwise. Use ``asyncio.wrap_future`` to await the
+    result from a coroutine.
+
+    :param password: A plaintext password to verify
+    :param password_hash: The expected hash value of the password
+    """
+    if _security.password_hash != 'plaintext':
+        password = get_hmac(password)
+    return _submit_hash('verify', password, password_hash)
+
+
+def encrypt_password_async(password):
+    """Like :func:`encrypt_password` but returns a
+    `concurrent.futures.Future` of the encrypted password. See
+    :func:`verify_password_async`.
+
+    :param password: The plaintext password to encrypt
+    """
+    if _security.password_hash == 'plaintext':
+        return run_in_future(lambda: password)
+    signed = get_hmac(password).decode('ascii')
+    return _submit_hash('encrypt', signed)
+
+
+def _submit_hash(method, *args):
+    executor = _security.hashing_executor
+    if executor is None:
+        return run_in_thread(getattr(_pwd_context, method), *args)
+    return executor.submit(_security.pwd_context, method, *args)
+
+
+def _hash(method, *args):
+    executor = _security.hashing_executor
+    with timer('hash'):
+        if executor is None:
+            return getattr(_pwd_context, method)(*args)
+        return executor.run(_security.pwd_context, method, *args)
+
+
+def encrypt_passwords(passwords, pool=None, chunksize=100):
+    """Encrypts a sequence of plaintext passwords using the configured
+    encryption options. Returns the encrypted passwords in the same order.
+
+    :param passwords: The plaintext passwords to encrypt
+    :param pool: An optional `multiprocessing.Pool` to spread the hashing
+                 across processes
+    :param chunksize: The number of passwords sent to a process at a time
+    """
+    passwords = list(passwords)
+    if _security.password_hash == 'plaintext':
+        return passwords
+    work = [(_security.password_hash, get_hmac(password).decode('ascii'))
+            for password in passwords]
+    if pool is None:
+        return [_pwd_context.encrypt(signed) for _, signed in work]
+    return pool.map(_encrypt_signed_password, work, chunksize)
+
+
+def _encrypt_signed_password(args):
+    scheme, signed = args
+    context = _hash_contexts.get(scheme)
+    if context is None:
+        context = _hash_contexts[scheme] = CryptContext(schemes=[scheme])
+    return context.encrypt(signed)
+
+
+def invalidate_token_cache(user):
+    """Removes the specified user from the authentication token cache so
+    that their tokens are checked against the datastore on the next request.
+    Call this after changing a user's password or active status outside of
+    Flask-Security.
+
+    :param user: The user, or the ID of the user, whose cached snapshot
+                 should be removed
+    """
+    if not has_app_context() or 'security' not in current_app.extensions:
+        return
+    if _security.token_cache is not None:
+        _security.token_cache.delete(str(getattr(user, 'id', user)))
+
+
+def get_role_names(user):
+    """Returns a frozenset of the names of the roles the specified user has.
+    The names are read from the role cache when it is enabled.
+
+    :param user: The user to inspect
+    """
+    return _get_role_cache_entry(user)[1]
+
+
+def get_role_version(user):
+    """Returns the version of the specified user's cached roles. The version
+    is incremented in the role cache whenever the user's roles are changed
+    through the datastore. Returns ``None`` if the role cache is disabled.
+
+    :param user: The user to inspect
+    """
+    return _get_role_cache_entry(user)[0]
+
+
+def _get_role_cache_entry(user):
+    cache = _security.role_cache
+    if cache is None:
+        return None, _load_role_names(user)
+    user_id = str(user.id)
+    names = cache.get('roles:' + user_id)
+    record_cache('role', names is not None)
+    if names is None:
+        names = _load_role_names(user)
+        cache.set('roles:' + user_id, names)
+    return _get_cached_role_version(user_id), names
+
+
+def _get_cached_role_version(user_id, seed=None):
+    """Returns the role version of a user from the role cache. A missing
+    version is seeded with `seed` or, to stay ahead of versions that were
+    evicted, with the current time in milliseconds.
+    """
+    cache, key = _security.role_cache, 'version:%s' % user_id
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(seed or time.time() * 1000), timeout=0)
+        version = cache.get(key)
+    return version
+
+
+def _load_role_names(user):
+    get_role_names = getattr(user, '_get_role_names', None)
+    if get_role_names is not None:
+        return get_role_names()
+    return frozenset(role.name for role in user.roles)
+
+
+def _forget_role_names(user):
+    if not hasattr(user, 'id'):
+        # only the current user may be loaded when just the ID is known
+        ctx = _request_ctx_stack.top
+        loaded = getattr(ctx, 'user', None)
+        if str(getattr(loaded, 'id', None)) != str(user):
+            return
+        user = loaded
+    getattr(user, '__dict__', {}).pop(_ROLE_NAMES_ATTR, None)
+
+
+def invalidate_role_cache(user):
+    """Removes the cached roles of the specified user and increments their
+    version. The datastore calls this whenever it changes a user's
+    roles. Call it yourself after changing roles outside of Flask-Security.
+
+    :param user: The user, or the ID of the user, whose roles changed
+    """
+    _forget_role_names(user)
+    if not has_app_context() or 'security' not in current_app.extensions:
+        return
+    cache = _security.role_cache
+    if cache is not None:
+        user_id = str(getattr(user, 'id', user))
+        _get_cached_role_version(user_id)
+        cache.inc('version:' + user_id)
+        cache.delete('roles:' + user_id)
+    invalidate_token_cache(user)
 
 
 def md5(data):
@@ -238,16 +503,36 @@ def get_message(key, **kwargs):
 def config_value(key, app=None, default=None):
     """Get a Flask-Security configuration value.
 
+    Values are read from the configuration snapshot taken when the extension
+    was initialized. When the application is in testing mode changes made to
+    ``app.config`` afterwards are detected and the snapshot is refreshed.
+
     :param key: The configuration key without the prefix `SECURITY_`
     :param app: An optional specific application to inspect. Defaults to Flask's
                 `current_app`
     :param default: An optional default value if the value is not set
     """
     app = app or current_app
-    return get_config(app).get(key.upper(), default)
+    key = key.upper()
+    state = app.extensions.get('security')
+    if state is None:
+        return get_config(app).get(key, default)
+    if app.testing and state.config.get(key, _missing) != \
+            app.config.get('SECURITY_' + key, _missing):
+        state.refresh_config()
+    return state.config.get(key, default)
 
 
 def get_max_age(key, app=None):
+    app = app or current_app
+    state = app.extensions.get('security')
+    if state is not None:
+        if app.testing:
+            # refreshes the snapshot after configuration changes
+            config_value(key + '_WITHIN', app=app)
+        max_age = state.max_ages.get(key)
+        if max_age is not None:
+            return max_age
     td = get_within_delta(key + '_WITHIN', app)
     return td.seconds + td.days * 24 * 3600
 
@@ -281,23 +566,120 @@ def send_mail(subject, recipient, template, **context):
     :param context: The context to render the template with
     """
 
+    fields = [key for key in context if key != 'security']
     context.setdefault('security', _security)
     context.update(_security._run_ctx_processor('mail'))
 
-    msg = Message(subject,
-                  sender=_security.email_sender,
-                  recipients=[recipient])
+    with timer('send_mail'):
+        msg = Message(subject,
+                      sender=_security.email_sender,
+                      recipients=[recipient])
 
-    ctx = ('security/email', template)
-    msg.body = render_template('%s/%s.txt' % ctx, **context)
-    msg.html = render_template('%s/%s.html' % ctx, **context)
+        msg.body, msg.html = render_mail(template, context, fields)
 
-    if _security._send_mail_task:
-        _security._send_mail_task(msg)
-        return
+        if _security._send_mail_task:
+            _security._send_mail_task(msg)
+            return
+
+        if _security.mail_dispatcher is not None:
+            _security.mail_dispatcher.send(msg)
+            return
+
+        mail = current_app.extensions.get('mail')
+        mail.send(msg)
+
+
+def render_mail(template, context, fields=()):
+    """Renders the text and HTML bodies of an email. When
+    ``SECURITY_EMAIL_PRERENDER`` is enabled the templates are rendered once
+    with placeholders for the context values named in `fields` and those
+    values are substituted for every following email.
+
+    :param template: The name of the email template
+    :param context: The context to render the template with
+    :param fields: The names of the context values that differ per email
+    """
+    app = current_app._get_current_object()
+    if _security.email_prerender:
+        key = (template, frozenset(fields))
+        prerendered = _security._prerendered_mail.get(key)
+        if prerendered is None:
+            placeholders = dict((f, _MailField(f)) for f in fields)
+            prerendered = _render_mail(app, template, dict(context, **placeholders))
+        if prerendered:
+            try:
+                rv = tuple(_substitute_mail_fields(body, context, escape_values)
+                           for body, escape_values in zip(prerendered, (False, True)))
+            except (KeyError, AttributeError):
+                prerendered = False
+        _security._prerendered_mail[key] = prerendered
+        if prerendered:
+            return rv
+    return _render_mail(app, template, context)
+
+
+def compile_mail_templates(app=None):
+    """Compiles the email templates ahead of the first email being sent.
+
+    :param app: An optional specific application. Defaults to Flask's
+                `current_app`
+    """
+    app = app or current_app._get_current_object()
+    for template in _mail_templates:
+        try:
+            _get_mail_templates(app, template)
+        except TemplateNotFound:
+            pass
+
+
+def _get_mail_templates(app, template):
+    templates = app.extensions['security']._compiled_mail
+    rv = templates.get(template)
+    if rv is None:
+        rv = tuple(app.jinja_env.get_template('security/email/%s.%s' % (template, ext))
+                   for ext in ('txt', 'html'))
+        if not app.debug:
+            templates[template] = rv
+    return rv
+
+
+def _render_mail(app, template, context):
+    app.update_template_context(context)
+    rv = []
+    for compiled in _get_mail_templates(app, template):
+        rv.append(compiled.render(context))
+        template_rendered.send(app, template=compiled, context=context)
+    return tuple(rv)
+
+
+def _substitute_mail_fields(body, context, escape_values):
+    def substitute(match):
+        path = match.group(1).split('.')
+        value = context[path[0]]
+        for attr in path[1:]:
+            value = getattr(value, attr)
+        return escape(value) if escape_values else text_type(value)
+    return _mail_field_re.sub(substitute, body)
+
+
+class _MailField(object):
+    """Renders as a placeholder for a per-email context value."""
 
-    mail = current_app.extensions.get('mail')
-    mail.send(msg)
+    def __init__(self, path):
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _MailField('%s.%s' % (self._path, name))
+
+    def __str__(self):
+        return u'\x00%s\x00' % self._path
+
+    __unicode__ = __str__
+
+    def __html__(self):
+        return text_type(self)
 
 
 def get_token_status(token, serializer, max_age=None):
@@ -309,13 +691,40 @@ def get_token_status(token, serializer, max_age=None):
     :param max_age: The name of the max age config option. Can be on of
                     the following: ``CONFIRM_EMAIL``, ``LOGIN``, ``RESET_PASSWORD``
     """
+    return get_token_statuses([token], serializer, max_age)[0]
+
+
+def get_token_statuses(tokens, serializer, max_age=None):
+    """Get the statuses of several tokens of the same kind. The users the
+    tokens refer to are looked up at once. Returns a list of the expired
+    status, invalid status and user of each token in the order of `tokens`.
+
+    :param tokens: The tokens to check
+    :param serializer: The name of the seriailzer. See
+                       :func:`get_token_status`
+    :param max_age: The name of the max age config option. See
+                    :func:`get_token_status`
+    """
     serializer = getattr(_security, serializer + '_serializer')
     max_age = get_max_age(max_age)
-    user, data = None, None
-    expired, invalid = False, False
+    loaded = [_load_token(serializer, token, max_age) for token in tokens]
+    users = _datastore.find_users_by_id(
+        data[0] for data, expired, invalid in loaded if data)
+
+    rv = []
+    for data, expired, invalid in loaded:
+        user = users.get(str(data[0])) if data else None
+        rv.append((expired and (user is not None), invalid, user))
+    return rv
+
 
+def _load_token(serializer, token, max_age):
+    data, expired, invalid = None, False, False
     try:
-        data = serializer.loads(token, max_age=max_age)
+        data, issued_at = serializer.loads(token, max_age=max_age,
+                                           return_timestamp=True)
+        if is_token_revoked(token, data[0], issued_at):
+            data, invalid = None, True
     except SignatureExpired:
         d, data = serializer.loads_unsafe(token)
         expired = True
@@ -325,12 +734,53 @@ def get_token_status(token, serializer, max_age=None):
         invalid = True
     except ValueError:
         invalid = True
+    return data, expired, invalid
+
+
+def revoke_token(token):
+    """Revokes an authentication, confirmation, reset password or login
+    token. Requires ``SECURITY_TOKEN_REVOCATION`` to be enabled.
+
+    :param token: The token to revoke
+    """
+    _security.revocation_list.revoke(token)
+
 
-    if data:
-        user = _datastore.find_user(id=data[0])
+def revoke_user_tokens(user):
+    """Revokes every token issued to the specified user until now.
+    Requires ``SECURITY_TOKEN_REVOCATION`` to be enabled.
+
+    :param user: The user, or the ID of the user, whose tokens to revoke
+    """
+    _security.revocation_list.revoke_user(getattr(user, 'id', user))
 
-    expired = expired and (user is not None)
-    return expired, invalid, user
+
+def revoke_user_sessions(user):
+    """Ends every session of the specified user, which logs them out
+    everywhere. Their tokens and remember cookies are revoked as well when
+    ``SECURITY_TOKEN_REVOCATION`` is enabled. Requires
+    ``SECURITY_SERVER_SESSION`` to be enabled.
+
+    :param user: The user, or the ID of the user, whose sessions to end
+    """
+    _security.session_interface.revoke_user(getattr(user, 'id', user))
+    if _security.revocation_list is not None:
+        revoke_user_tokens(user)
+
+
+def is_token_revoked(token, user_id, issued_at):
+    """Returns ``True`` if the specified token was revoked. Always returns
+    ``False`` when ``SECURITY_TOKEN_REVOCATION`` is disabled.
+
+    :param token: The token to check
+    :param user_id: The ID of the user the token was issued to
+    :param issued_at: The `datetime` the token was issued at
+    """
+    revocation_list = _security.revocation_list
+    if revocation_list is None:
+        return False
+    issued_at = calendar.timegm(issued_at.utctimetuple())
+    return revocation_list.is_revoked(token, user_id, issued_at)
 
 
 def get_identity_attributes(app=None):
@@ -16,8 +16,25 @@ Resources
 
 """
 
+import sys
+
 from setuptools import setup
 
+install_requires = [
+    'Flask>=0.10.1',
+    'Flask-Login>=0.2.9',
+    'Flask-Mail>=0.9.0',
+    'Flask-Principal>=0.4.0',
+    'Flask-WTF>=0.9.3',
+    'passlib>=1.6.2',
+]
+
+if sys.version_info < (3,):
+    install_requires.append('futures')
+
+if sys.version_info < (2, 7):
+    install_requires.append('ordereddict')
+
 setup(
     name='Flask-Security',
     version='1.7.1',
@@ -33,14 +50,7 @@ setup(
     zip_safe=False,
     include_package_data=True,
     platforms='any',
-    install_requires=[
-        'Flask>=0.10.1',
-        'Flask-Login>=0.2.9',
-        'Flask-Mail>=0.9.0',
-        'Flask-Principal>=0.4.0',
-        'Flask-WTF>=0.9.3',
-        'passlib>=1.6.2',
-    ],
+    install_requires=install_requires,
     test_suite='nose.collector',
     tests_require=[
         'nose',
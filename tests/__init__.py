@@ -75,6 +75,12 @@ class SecurityTest(TestCase):
 
         return self.assertFalse(member in container)
 
+    def assertIsNone(self, obj, msg=None):
+        if hasattr(TestCase, 'assertIsNone'):
+            return TestCase.assertIsNone(self, obj, msg)
+
+        return self.assertTrue(obj is None)
+
     def assertIsNotNone(self, obj, msg=None):
         if hasattr(TestCase, 'assertIsNotNone'):
             return TestCase.assertIsNotNone(self, obj, msg)
@@ -876,3 +876,1513 @@ class AdditionalUserIdentityAttributes(SecurityTest):
     def test_authenticate(self):
         r = self.authenticate(email='matt')
         self.assertIn(b'Hello matt@lp.com', r.data)
+
+    def test_get_user_uses_single_query(self):
+        from sqlalchemy import event
+        self._get('/')
+        ds = self.app.security.datastore
+        statements = []
+
+        def count(*args):
+            statements.append(args)
+
+        with self.app.test_request_context():
+            ds.create_user(email='dave', username='other', password='password')
+            ds.commit()
+            event.listen(ds.db.engine, 'before_cursor_execute', count)
+            try:
+                self.assertEqual('joe@lp.com', ds.get_user('JOE').email)
+                self.assertEqual(1, len(statements))
+                self.assertIsNone(ds.get_user('nobody'))
+                self.assertEqual(2, len(statements))
+                self.assertEqual('dave', ds.get_user('Dave').email)
+            finally:
+                event.remove(ds.db.engine, 'before_cursor_execute', count)
+
+    def test_create_identity_indexes(self):
+        self._get('/')
+        ds = self.app.security.datastore
+        with self.app.test_request_context():
+            created = ds.create_identity_indexes()
+            self.assertEqual(['ix_user_email_lower', 'ix_user_username_lower'],
+                             [index.name for index in created])
+            self.assertEqual([], ds.create_identity_indexes())
+
+
+class ConfigSnapshotTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_FLASH_MESSAGES': True,
+    }
+
+    def test_config_value_reads_snapshot(self):
+        from flask_security.utils import config_value
+        self.app.testing = False
+        self.app.config['SECURITY_FLASH_MESSAGES'] = False
+        with self.app.app_context():
+            self.assertTrue(config_value('FLASH_MESSAGES'))
+            self.app.security.refresh_config()
+            self.assertFalse(config_value('FLASH_MESSAGES'))
+            self.assertFalse(self.app.security.flash_messages)
+
+    def test_config_changes_detected_when_testing(self):
+        from flask_security.utils import config_value
+        self.app.config['SECURITY_FLASH_MESSAGES'] = False
+        with self.app.app_context():
+            self.assertFalse(config_value('FLASH_MESSAGES'))
+
+    def test_login_after_refresh(self):
+        self.app.config['SECURITY_DEFAULT_REMEMBER_ME'] = True
+        self.app.security.refresh_config()
+        r = self.authenticate(follow_redirects=True)
+        self.assertIn(b'Hello matt@lp.com', r.data)
+        auth = base64.b64encode(b"matt@lp.com:password").decode('utf-8')
+        r = self._get('/http', headers={'Authorization': 'basic %s' % auth})
+        self.assertIn(b'HTTP Authentication', r.data)
+
+
+class HttpAuthCacheTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_PASSWORD_HASH': 'bcrypt',
+        'SECURITY_PASSWORD_SALT': 'so-salty',
+        'SECURITY_HTTP_AUTH_CACHE_SIZE': 10,
+        'USER_COUNT': 2
+    }
+
+    def setUp(self):
+        super(HttpAuthCacheTests, self).setUp()
+        from flask_security import decorators
+        self.verifications = 0
+        verify = decorators.utils.verify_and_update_password
+
+        def counting_verify(*args, **kwargs):
+            self.verifications += 1
+            return verify(*args, **kwargs)
+
+        decorators.utils.verify_and_update_password = counting_verify
+        self.addCleanup(setattr, decorators.utils,
+                        'verify_and_update_password', verify)
+
+    def _http_get(self, credentials):
+        auth = base64.b64encode(credentials).decode('utf-8')
+        return self._get('/http', headers={'Authorization': 'Basic %s' % auth})
+
+    def test_repeated_credentials_skip_verification(self):
+        for _ in range(3):
+            r = self._http_get(b"joe@lp.com:password")
+            self.assertIn(b'HTTP Authentication', r.data)
+        self.assertEqual(1, self.verifications)
+
+    def test_bad_password_is_not_cached(self):
+        self._http_get(b"joe@lp.com:password")
+        r = self._http_get(b"joe@lp.com:bogus")
+        self.assertEqual(401, r.status_code)
+        self.assertEqual(2, self.verifications)
+
+    def test_password_change_invalidates_cache(self):
+        from flask_security.utils import encrypt_password
+        self._http_get(b"joe@lp.com:password")
+        with self.app.test_request_context():
+            ds = self.app.security.datastore
+            user = ds.find_user(email='joe@lp.com')
+            user.password = encrypt_password('newpassword')
+            ds.put(user)
+            ds.commit()
+        r = self._http_get(b"joe@lp.com:password")
+        self.assertEqual(401, r.status_code)
+        r = self._http_get(b"joe@lp.com:newpassword")
+        self.assertIn(b'HTTP Authentication', r.data)
+        self.assertEqual(3, self.verifications)
+
+    def test_deactivation_invalidates_cache(self):
+        self._http_get(b"joe@lp.com:password")
+        with self.app.test_request_context():
+            ds = self.app.security.datastore
+            ds.deactivate_user(ds.find_user(email='joe@lp.com'))
+            ds.commit()
+        self._http_get(b"joe@lp.com:password")
+        self.assertEqual(2, self.verifications)
+
+
+class TokenCacheTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_TOKEN_CACHE_SIZE': 10,
+        'SECURITY_CHANGEABLE': True,
+    }
+
+    def setUp(self):
+        super(TokenCacheTests, self).setUp()
+        self.lookups = 0
+        ds = self.app.security.datastore
+        find_user = ds.find_user
+
+        def counting_find_user(**kwargs):
+            self.lookups += 1
+            return find_user(**kwargs)
+
+        ds.find_user = counting_find_user
+
+    def _get_token(self):
+        r = self.json_authenticate()
+        return json.loads(r.data)['response']['user']['authentication_token']
+
+    def test_cached_token_skips_datastore(self):
+        from flask_security.decorators import _check_token
+        headers = {'Authentication-Token': self._get_token()}
+        with self.app.test_request_context('/token', headers=headers):
+            self.assertTrue(_check_token())
+        lookups = self.lookups
+        with self.app.test_request_context('/token', headers=headers):
+            self.assertTrue(_check_token())
+        self.assertEqual(lookups, self.lookups)
+
+    def test_cached_user_loads_from_datastore_on_demand(self):
+        from flask_security.core import _token_loader
+        token = self._get_token()
+        with self.app.test_request_context():
+            _token_loader(token)
+            user = _token_loader(token)
+            lookups = self.lookups
+            self.assertTrue(user.is_active())
+            self.assertEqual(lookups, self.lookups)
+            self.assertEqual('matt@lp.com', user.email)
+            self.assertEqual(lookups + 1, self.lookups)
+
+    def test_password_change_invalidates_cached_token(self):
+        token = self._get_token()
+        self._get('/token', headers={'Authentication-Token': token})
+        data = ('{"password": "password", "new_password": "newpassword", '
+                '"new_password_confirm": "newpassword"}')
+        self._post('/change', data=data, content_type='application/json',
+                   headers={'Authentication-Token': token})
+        r = self._get('/token', headers={'Authentication-Token': token})
+        self.assertEqual(401, r.status_code)
+
+    def test_deactivation_invalidates_cached_token(self):
+        token = self._get_token()
+        headers = {'Authentication-Token': token}
+        self.assertEqual(200, self._get('/token', headers=headers).status_code)
+        with self.app.test_request_context():
+            ds = self.app.security.datastore
+            ds.deactivate_user(ds.find_user(email='matt@lp.com'))
+            ds.commit()
+        self.assertEqual(401, self._get('/token', headers=headers).status_code)
+
+    def test_deletion_invalidates_cached_token(self):
+        token = self._get_token()
+        headers = {'Authentication-Token': token}
+        self.assertEqual(200, self._get('/token', headers=headers).status_code)
+        with self.app.test_request_context():
+            ds = self.app.security.datastore
+            ds.delete_user(ds.find_user(email='matt@lp.com'))
+            ds.commit()
+        self.assertEqual(401, self._get('/token', headers=headers).status_code)
+
+
+class TokenMaxAgeTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_TOKEN_MAX_AGE': 1,
+    }
+
+    def test_expired_token_is_rejected(self):
+        r = self.json_authenticate()
+        token = json.loads(r.data)['response']['user']['authentication_token']
+        r = self._get('/token', headers={'Authentication-Token': token})
+        self.assertIn(b'Token Authentication', r.data)
+        time.sleep(2)
+        r = self._get('/token', headers={'Authentication-Token': token})
+        self.assertEqual(401, r.status_code)
+
+
+class RoleCacheTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_ROLE_CACHE_SIZE': 10,
+    }
+
+    def test_role_names_are_cached(self):
+        from flask_security.utils import get_role_names
+        self.authenticate('joe@lp.com')
+        with self.app.test_request_context():
+            user = self.app.security.datastore.find_user(email='joe@lp.com')
+            self.assertEqual(frozenset(['editor']), get_role_names(user))
+            user.roles = []
+            self.assertEqual(frozenset(['editor']), get_role_names(user))
+
+    def test_datastore_role_changes_invalidate_cache(self):
+        from flask_security.utils import get_role_names, get_role_version
+        self.authenticate('joe@lp.com')
+        with self.app.test_request_context():
+            ds = self.app.security.datastore
+            user = ds.find_user(email='joe@lp.com')
+            version = get_role_version(user)
+            ds.add_role_to_user(user, 'admin')
+            self.assertEqual(frozenset(['admin', 'editor']), get_role_names(user))
+            self.assertNotEqual(version, get_role_version(user))
+            ds.remove_role_from_user(user, 'editor')
+            self.assertEqual(frozenset(['admin']), get_role_names(user))
+            ds.commit()
+        r = self._get('/admin')
+        self.assertIn(b'Admin Page', r.data)
+        r = self._get('/admin_and_editor', follow_redirects=True)
+        self.assertNotIn(b'Admin and Editor Page', r.data)
+        r = self._get('/admin_or_editor')
+        self.assertIn(b'Admin or Editor Page', r.data)
+
+
+class MailDispatcherTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_RECOVERABLE': True,
+        'SECURITY_ASYNC_MAIL': True,
+        'USER_COUNT': 1
+    }
+
+    def tearDown(self):
+        self.app.security.mail_dispatcher.shutdown()
+        super(MailDispatcherTests, self).tearDown()
+
+    def test_mail_is_sent_by_worker(self):
+        mail = self.app.extensions['mail']
+        with mail.record_messages() as outbox:
+            self._post('/reset', data=dict(email='matt@lp.com'))
+            self.app.security.mail_dispatcher.flush()
+        self.assertEqual(1, len(outbox))
+        self.assertEqual(['matt@lp.com'], outbox[0].recipients)
+
+    def test_mail_is_delivered_to_smtp_server(self):
+        try:
+            import asyncore
+            import smtpd
+        except ImportError:
+            return
+        import threading
+        received = []
+
+        class Server(smtpd.SMTPServer):
+            def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+                received.append(rcpttos)
+
+        server = Server(('127.0.0.1', 0), None)
+        thread = threading.Thread(target=asyncore.loop,
+                                  kwargs=dict(timeout=0.05))
+        thread.start()
+        try:
+            mail = self.app.extensions['mail']
+            mail.server, mail.port = server.socket.getsockname()
+            mail.suppress = False
+            self._post('/reset', data=dict(email='matt@lp.com'))
+            self.app.security.mail_dispatcher.flush()
+        finally:
+            server.close()
+            thread.join()
+        self.assertEqual([['matt@lp.com']], received)
+
+    def test_queued_messages_are_batched_and_retried(self):
+        import threading
+        from flask_security.mail import MailDispatcher
+        batches, attempts, release = [], [], threading.Event()
+
+        def transport(app, messages):
+            release.wait()
+            attempts.append(list(messages))
+            if len(attempts) == 2:
+                raise RuntimeError('Connection refused')
+            batches.append(list(messages))
+
+        dispatcher = MailDispatcher(self.app, transport=transport,
+                                    batch_size=10, retry_delay=0)
+        dispatcher.send('first')
+        time.sleep(0.1)
+        for msg in ('second', 'third'):
+            dispatcher.send(msg)
+        release.set()
+        dispatcher.shutdown()
+        self.assertEqual([['first'], ['second', 'third']], batches)
+        self.assertEqual(3, len(attempts))
+
+
+class EmailPrerenderTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_RECOVERABLE': True,
+        'SECURITY_EMAIL_PRERENDER': True,
+    }
+
+    def test_prerendered_emails_contain_per_user_values(self):
+        mail = self.app.extensions['mail']
+        with mail.record_messages() as outbox:
+            with capture_reset_password_requests() as requests:
+                for email in ('matt@lp.com', 'joe@lp.com'):
+                    self._post('/reset', data=dict(email=email))
+        self.assertEqual(2, len(outbox))
+        for msg, request in zip(outbox, requests):
+            self.assertIn(request['token'], msg.body)
+            self.assertIn(request['token'], msg.html)
+        self.assertNotIn(requests[0]['token'], outbox[1].html)
+        self.assertEqual(1, len(self.app.security._prerendered_mail))
+
+    def test_prerendered_values_are_escaped_in_html(self):
+        from flask_security.utils import render_mail
+
+        class User(object):
+            email = 'matt@lp.com'
+
+        link = 'http://localhost/login?a=1&b=<2>'
+        with self.app.test_request_context():
+            context = dict(user=User(), login_link=link,
+                           security=self.app.security)
+            for _ in range(2):
+                body, html = render_mail('login_instructions', dict(context),
+                                         ['user', 'login_link'])
+                self.assertIn(link, body)
+                self.assertIn('Welcome matt@lp.com', body)
+                self.assertIn('a=1&amp;b=&lt;2&gt;', html)
+
+
+class BulkCreateUsersTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_PASSWORD_HASH': 'sha256_crypt',
+        'SECURITY_PASSWORD_SALT': 'salty',
+        'USER_COUNT': 1
+    }
+
+    def test_create_users(self):
+        self._get('/')
+        ds = self.app.security.datastore
+        with self.app.test_request_context():
+            users = ds.create_users([
+                dict(email='bulk1@lp.com', password='password', roles=['admin']),
+                dict(email='bulk2@lp.com', password='password', active=False,
+                     roles=['admin', 'editor'])])
+            ds.commit()
+            self.assertEqual(2, len(users))
+            self.assertTrue(ds.find_user(email='bulk1@lp.com').has_role('admin'))
+            user = ds.find_user(email='bulk2@lp.com')
+            self.assertFalse(user.active)
+            self.assertTrue(user.has_role('editor'))
+
+    def test_encrypt_passwords_with_pool(self):
+        import multiprocessing
+        from flask_security.utils import encrypt_passwords, verify_password
+        pool = multiprocessing.Pool(2)
+        try:
+            with self.app.test_request_context():
+                hashes = encrypt_passwords(['password', 'secret'], pool=pool)
+                self.assertTrue(verify_password('password', hashes[0]))
+                self.assertTrue(verify_password('secret', hashes[1]))
+                self.assertFalse(verify_password('password', hashes[1]))
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_import_users_reports_invalid_rows(self):
+        import os
+        import tempfile
+        from flask_security.script import ImportUsersCommand
+        rows = [dict(email='import1@lp.com', password='password', roles='admin'),
+                dict(email='matt@lp.com', password='password'),
+                dict(email='import1@lp.com', password='password'),
+                dict(email='invalid', password='password'),
+                dict(email='import2@lp.com', password='short'),
+                dict(email='import3@lp.com', password='password',
+                     roles='admin,unknown'),
+                dict(email='import4@lp.com', password='password', active=False)]
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(json.dumps(row) for row in rows))
+        try:
+            self._get('/')
+            ds = self.app.security.datastore
+            with self.app.test_request_context():
+                command = ImportUsersCommand()
+                command.run(path, batch_size=2, processes=1)
+                self.assertTrue(ds.find_user(email='import1@lp.com').has_role('admin'))
+                self.assertFalse(ds.find_user(email='import4@lp.com').active)
+                for email in ('invalid', 'import2@lp.com', 'import3@lp.com'):
+                    self.assertEqual(None, ds.find_user(email=email))
+                errors = command.validate(
+                    [command.prepare(dict(row)) for row in rows[1:6]], set(), {})
+                self.assertEqual(['email'], list(errors[0]))
+                self.assertEqual(['email'], list(errors[1]))
+                self.assertEqual(['email'], list(errors[2]))
+                self.assertEqual(['password'], list(errors[3]))
+                self.assertEqual(['roles'], list(errors[4]))
+        finally:
+            os.remove(path)
+
+
+class BulkRoleTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_ROLE_CACHE_SIZE': 100
+    }
+
+    def setUp(self):
+        super(BulkRoleTests, self).setUp()
+        self._get('/')
+        self.ds = self.app.security.datastore
+
+    def role_names(self, email):
+        return sorted(r.name for r in self.ds.find_user(email=email).roles)
+
+    def test_add_role_to_users(self):
+        with self.app.test_request_context():
+            from flask_security.utils import get_role_names
+            matt = self.ds.find_user(email='matt@lp.com')
+            self.assertEqual(frozenset(['admin']), get_role_names(matt))
+            rv = self.ds.add_role_to_users([matt, 'jill@lp.com', 'dave@lp.com'],
+                                           'editor')
+            self.ds.commit()
+            self.assertEqual(2, rv)
+            self.assertEqual(['admin', 'editor'], self.role_names('matt@lp.com'))
+            self.assertEqual(['author', 'editor'], self.role_names('jill@lp.com'))
+            self.assertEqual(frozenset(['admin', 'editor']), get_role_names(matt))
+            self.assertEqual(0, self.ds.add_role_to_users([matt], 'editor'))
+
+    def test_remove_role_from_users(self):
+        with self.app.test_request_context():
+            rv = self.ds.remove_role_from_users(
+                ['matt@lp.com', 'joe@lp.com', 'jill@lp.com'], 'admin')
+            self.ds.commit()
+            self.assertEqual(1, rv)
+            self.assertEqual([], self.role_names('matt@lp.com'))
+            self.assertEqual(['admin', 'editor'], self.role_names('dave@lp.com'))
+
+    def test_set_user_roles(self):
+        with self.app.test_request_context():
+            self.ds.set_user_roles(['dave@lp.com', 'tiya@lp.com'],
+                                   ['author', 'editor'])
+            self.ds.commit()
+            self.assertEqual(['author', 'editor'], self.role_names('dave@lp.com'))
+            self.assertEqual(['author', 'editor'], self.role_names('tiya@lp.com'))
+            self.assertEqual(['admin'], self.role_names('matt@lp.com'))
+
+    def test_users_may_be_a_generator(self):
+        with self.app.test_request_context():
+            matt = self.ds.find_user(email='matt@lp.com')
+            users = (user for user in [matt, 'jill@lp.com'])
+            self.assertEqual(2, self.ds.add_role_to_users(users, 'editor'))
+            self.ds.commit()
+            self.assertEqual(['admin', 'editor'], self.role_names('matt@lp.com'))
+            self.assertIn('editor', [r.name for r in matt.roles])
+            users = (user for user in [matt, 'jill@lp.com'])
+            self.assertEqual(2, self.ds.remove_role_from_users(users, 'editor'))
+            self.ds.commit()
+            self.assertEqual(['author'], self.role_names('jill@lp.com'))
+            users = (user for user in [matt, 'jill@lp.com'])
+            self.ds.set_user_roles(users, ['editor'])
+            self.ds.commit()
+            self.assertEqual(['editor'], self.role_names('matt@lp.com'))
+            self.assertEqual(['editor'], self.role_names('jill@lp.com'))
+
+    def test_role_commands_reject_unknown_roles(self):
+        import os
+        import tempfile
+        from flask_security.script import AddRoleToUsersCommand, \
+            RemoveRoleFromUsersCommand, SetUserRolesCommand
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('matt@lp.com\njill@lp.com\n')
+        try:
+            with self.app.test_request_context():
+                AddRoleToUsersCommand().run(path, 'unknown')
+                RemoveRoleFromUsersCommand().run(path, 'unknown')
+                SetUserRolesCommand().run(path, 'editor,unknown')
+                self.assertEqual(['admin'], self.role_names('matt@lp.com'))
+                AddRoleToUsersCommand().run(path, 'editor')
+                self.assertEqual(['author', 'editor'], self.role_names('jill@lp.com'))
+        finally:
+            os.remove(path)
+
+
+class MongoEngineBulkRoleTests(BulkRoleTests):
+
+    def _create_app(self, auth_config, **kwargs):
+        from tests.test_app.mongoengine import create_app
+        return create_app(auth_config, **kwargs)
+
+
+class PeeweeBulkRoleTests(BulkRoleTests):
+
+    def _create_app(self, auth_config, **kwargs):
+        from tests.test_app.peewee_app import create_app
+        return create_app(auth_config, **kwargs)
+
+
+class UserCacheTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'USER_CACHE': True
+    }
+
+    def setUp(self):
+        super(UserCacheTests, self).setUp()
+        self.ds = self.app.security.datastore
+        self.lookups = []
+        find_user = self.ds.datastore.find_user
+
+        def counting_find_user(**kwargs):
+            self.lookups.append(kwargs)
+            return find_user(**kwargs)
+
+        self.ds.datastore.find_user = counting_find_user
+
+    def test_session_user_is_cached(self):
+        self.authenticate()
+        del self.lookups[:]
+        for _ in range(3):
+            r = self._get('/profile')
+            self.assertIn(b'Hello matt@lp.com', r.data)
+        self.assertEqual([], self.lookups)
+
+    def test_changes_invalidate_cached_user(self):
+        self.authenticate()
+        self._get('/profile')
+        with self.app.test_request_context():
+            user = self.ds.find_user(email='matt@lp.com')
+            user_id = user.id
+            self.ds.add_role_to_user(user, 'editor')
+            self.ds.commit()
+        r = self._get('/admin_and_editor')
+        self.assertIn(b'Admin and Editor Page', r.data)
+        with self.app.test_request_context():
+            self.ds.deactivate_user('matt@lp.com')
+            self.ds.commit()
+            self.assertFalse(self.ds.find_user(id=user_id).active)
+
+    def test_get_user_is_cached(self):
+        self._get('/')
+        with self.app.test_request_context():
+            self.assertEqual('matt@lp.com', self.ds.get_user('MATT@lp.com').email)
+            self.ds.datastore.get_user = lambda identifier: self.fail(identifier)
+            self.assertEqual('matt@lp.com', self.ds.get_user('matt@LP.com').email)
+            user = self.ds.find_user(id=1)
+            user.email = 'matt@example.com'
+            self.ds.put(user)
+            self.ds.commit()
+            self.ds.datastore.get_user = lambda identifier: None
+            self.assertIsNone(self.ds.get_user('matt@lp.com'))
+
+
+class TrackableWriteBehindTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_TRACKABLE': True,
+        'SECURITY_TRACKABLE_WRITE_BEHIND': True,
+        'SECURITY_TRACKABLE_MAX_STALENESS': 60,
+        'USER_COUNT': 2
+    }
+
+    def tearDown(self):
+        self.app.security.login_tracker.shutdown()
+        super(TrackableWriteBehindTests, self).tearDown()
+
+    def find_user(self, email):
+        with self.app.test_request_context():
+            return self.app.security.datastore.find_user(email=email)
+
+    def test_logins_are_written_in_batches(self):
+        for email in ('matt@lp.com', 'joe@lp.com', 'matt@lp.com'):
+            self.authenticate(email=email)
+            self.logout()
+        self.assertIsNone(self.find_user('matt@lp.com').login_count)
+
+        tracker = self.app.security.login_tracker
+        self.assertEqual(2, len(tracker._pending))
+        tracker.flush()
+
+        user = self.find_user('matt@lp.com')
+        self.assertEqual(2, user.login_count)
+        self.assertEqual('untrackable', user.last_login_ip)
+        self.assertEqual('untrackable', user.current_login_ip)
+        self.assertTrue(user.last_login_at < user.current_login_at)
+        self.assertEqual(1, self.find_user('joe@lp.com').login_count)
+
+        self.authenticate(email='matt@lp.com')
+        tracker.shutdown()
+        self.assertEqual(3, self.find_user('matt@lp.com').login_count)
+
+    def test_failed_writes_are_kept(self):
+        self.authenticate(email='matt@lp.com')
+        tracker = self.app.security.login_tracker
+        datastore = self.app.security.datastore
+        update_login_tracking = datastore.update_login_tracking
+
+        def fail(updates):
+            raise RuntimeError('Database unavailable')
+
+        datastore.update_login_tracking = fail
+        tracker.flush()
+        datastore.update_login_tracking = update_login_tracking
+        self.logout()
+        self.authenticate(email='matt@lp.com')
+        tracker.flush()
+        self.assertEqual(2, self.find_user('matt@lp.com').login_count)
+
+
+class HashingExecutorTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_PASSWORD_HASH': 'sha256_crypt',
+        'SECURITY_PASSWORD_SALT': 'salty',
+        'SECURITY_REGISTERABLE': True,
+        'SECURITY_HASHING_WORKERS': 1,
+        'SECURITY_HASHING_QUEUE_SIZE': 0,
+        'USER_COUNT': 1
+    }
+
+    def tearDown(self):
+        self.app.security.hashing_executor.shutdown()
+        super(HashingExecutorTests, self).tearDown()
+
+    def test_passwords_are_hashed_by_workers(self):
+        self._get('/')
+        executor = self.app.security.hashing_executor
+        hashed = executor.metrics['hashed']
+        data = dict(email='pool@lp.com', password='password',
+                    password_confirm='password')
+        self._post('/register', data=data)
+        self.logout()
+        r = self.authenticate(email='pool@lp.com')
+        self.assertIn(b'Hello pool@lp.com', r.data)
+        self.assertEqual(hashed + 2, executor.metrics['hashed'])
+        self.assertTrue(executor.metrics['hash_time'] > 0)
+
+    def test_saturated_pool_rejects_logins(self):
+        self._get('/')
+        executor = self.app.security.hashing_executor
+        executor._pending = 1
+        r = self.authenticate(follow_redirects=False)
+        self.assertEqual(503, r.status_code)
+        self.assertEqual('1', r.headers['Retry-After'])
+        r = self.json_authenticate()
+        self.assertEqual(503, r.status_code)
+        self.assertIn(b'busy', r.data)
+        self.assertEqual(2, executor.metrics['rejected'])
+
+
+class AsyncPasswordTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_PASSWORD_HASH': 'sha256_crypt',
+        'SECURITY_PASSWORD_SALT': 'salty',
+        'USER_COUNT': 1
+    }
+
+    def test_password_futures(self):
+        from flask_security.utils import encrypt_password_async, \
+            verify_password_async
+        with self.app.test_request_context():
+            password_hash = encrypt_password_async('password').result()
+            self.assertTrue(verify_password_async('password', password_hash).result())
+            self.assertFalse(verify_password_async('secret', password_hash).result())
+
+
+class ThreadedAsyncPasswordTests(AsyncPasswordTests):
+
+    def test_password_futures_run_in_threads(self):
+        import threading
+        from flask_security.utils import encrypt_password_async
+        threads = []
+        encrypt = self.app.security.pwd_context.encrypt
+
+        def recording_encrypt(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return encrypt(*args, **kwargs)
+
+        self.app.security.pwd_context.encrypt = recording_encrypt
+        try:
+            with self.app.test_request_context():
+                encrypt_password_async('password').result()
+        finally:
+            del self.app.security.pwd_context.encrypt
+        self.assertEqual(1, len(threads))
+        self.assertNotEqual(threading.current_thread(), threads[0])
+
+
+class HashingExecutorAsyncPasswordTests(AsyncPasswordTests):
+
+    AUTH_CONFIG = dict(AsyncPasswordTests.AUTH_CONFIG,
+                       SECURITY_HASHING_WORKERS=1)
+
+    def tearDown(self):
+        self.app.security.hashing_executor.shutdown()
+        super(HashingExecutorAsyncPasswordTests, self).tearDown()
+
+    def test_password_futures_run_in_workers(self):
+        from flask_security.utils import encrypt_password_async
+        executor = self.app.security.hashing_executor
+        with self.app.test_request_context():
+            future = encrypt_password_async('password')
+            self.assertTrue(future.result().startswith('$5$'))
+            self.assertEqual(1, executor.metrics['hashed'])
+
+
+class MetricsTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_METRICS': True,
+        'SECURITY_TOKEN_CACHE_SIZE': 100,
+        'USER_COUNT': 1
+    }
+
+    def test_login_stages_are_timed(self):
+        self._get('/')
+        self.authenticate()
+        collector = self.app.security.metrics_collector
+        snapshot = collector.snapshot()
+        for name in ('login_form', 'hash', 'datastore.get_user'):
+            self.assertEqual(1, snapshot['histograms'][name]['count'])
+        self.assertTrue(snapshot['counters']['datastore_calls'] >= 1)
+        self.assertTrue(snapshot['counters']['requests'] >= 2)
+
+    def test_token_cache_hits_are_counted(self):
+        data = dict(email='matt@lp.com', password='password')
+        r = self._post('/login', data=json.dumps(data),
+                       content_type='application/json')
+        token = json.loads(r.data)['response']['user']['authentication_token']
+        for _ in range(2):
+            self._get('/token', headers={'Authentication-Token': token})
+        counters = self.app.security.metrics_collector.snapshot()['counters']
+        self.assertEqual(1, counters['token_cache_misses'])
+        self.assertEqual(1, counters['token_cache_hits'])
+
+    def test_prometheus_export(self):
+        self._get('/')
+        self.authenticate()
+        text = self.app.security.metrics_collector.to_prometheus()
+        self.assertIn('# TYPE flask_security_hash_seconds histogram', text)
+        self.assertIn('flask_security_hash_seconds_bucket{le="+Inf"} 1', text)
+        self.assertIn('flask_security_hash_seconds_count 1', text)
+        self.assertIn('# TYPE flask_security_requests_total counter', text)
+
+    def test_datastore_calls_per_request(self):
+        self._get('/')
+        self.authenticate()
+        snapshot = self.app.security.metrics_collector.snapshot()
+        histogram = snapshot['histograms']['datastore_calls_per_request']
+        self.assertEqual(snapshot['counters']['requests'], histogram['count'])
+        self.assertTrue(histogram['sum'] >= 1)
+        # the index page makes no datastore calls
+        self.assertTrue(histogram['counts'][0] >= 1)
+        text = self.app.security.metrics_collector.to_prometheus()
+        self.assertIn('# TYPE flask_security_datastore_calls_per_request '
+                      'histogram', text)
+        self.assertIn('flask_security_datastore_calls_per_request_bucket'
+                      '{le="0"}', text)
+
+    def test_datastore_methods_are_wrapped_once(self):
+        ds = self.app.extensions['security'].datastore
+        self.assertTrue(ds.find_user is ds.find_user)
+
+
+
+class TokenAuthenticationJsonTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_TOKEN_AUTHENTICATION_JSON': True
+    }
+
+    def _get_token(self):
+        r = self.json_authenticate()
+        return json.loads(r.data)['response']['user']['authentication_token']
+
+    def test_token_in_json_body(self):
+        data = json.dumps(dict(auth_token=self._get_token()))
+        self.logout()
+        r = self.client.open('/token', method='GET', data=data,
+                             content_type='application/json')
+        self.assertIn(b'Token Authentication', r.data)
+
+
+class AuthRequiredMechanismTests(TokenAuthenticationJsonTests):
+
+    AUTH_CONFIG = {}
+
+    def test_token_in_json_body(self):
+        data = json.dumps(dict(auth_token=self._get_token()))
+        self.logout()
+        r = self.client.open('/token', method='GET', data=data,
+                             content_type='application/json')
+        self.assertEqual(401, r.status_code)
+
+    def test_missing_credentials_skip_datastore(self):
+        self._get('/')
+        calls = []
+        datastore = self.app.security.datastore
+        find_user = datastore.find_user
+        datastore.find_user = lambda **kw: calls.append(kw) or find_user(**kw)
+        try:
+            r = self._get('/multi_auth')
+        finally:
+            del datastore.find_user
+        self.assertEqual(401, r.status_code)
+        self.assertEqual([], calls)
+
+
+class LoginThrottleTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_LOGIN_THROTTLE': True,
+        'SECURITY_LOGIN_THROTTLE_IDENTITY_LIMIT': 2,
+        'SECURITY_LOGIN_THROTTLE_IP_LIMIT': 3
+    }
+
+    def test_identity_is_throttled_after_failed_logins(self):
+        for _ in range(2):
+            r = self.authenticate(password='bogus')
+            self.assertIn(b'Invalid password', r.data)
+        r = self.authenticate()
+        self.assertEqual(429, r.status_code)
+        self.assertIn(b'Too many login attempts', r.data)
+        self.assertTrue(int(r.headers['Retry-After']) > 0)
+
+    def test_address_is_throttled_across_identities(self):
+        environ = dict(REMOTE_ADDR='10.0.0.1')
+        for email in ('matt@lp.com', 'joe@lp.com', 'nobody@lp.com'):
+            self.client.post('/login', environ_base=environ,
+                             data=dict(email=email, password='bogus'))
+        data = json.dumps(dict(email='dave@lp.com', password='password'))
+        r = self.client.post('/login', data=data, environ_base=environ,
+                             content_type='application/json')
+        self.assertEqual(429, r.status_code)
+        self.assertEqual(429, json.loads(r.data)['meta']['code'])
+
+    def test_throttled_login_skips_datastore(self):
+        for _ in range(2):
+            self.authenticate(password='bogus')
+        calls = []
+        datastore = self.app.security.datastore
+        get_user = datastore.get_user
+        datastore.get_user = lambda i: calls.append(i) or get_user(i)
+        try:
+            r = self.authenticate()
+        finally:
+            del datastore.get_user
+        self.assertEqual(429, r.status_code)
+        self.assertEqual([], calls)
+
+    def test_successful_logins_are_not_counted(self):
+        for _ in range(3):
+            r = self.authenticate(follow_redirects=False)
+            self.assertEqual(302, r.status_code)
+            self.logout()
+
+    def test_http_auth_is_throttled(self):
+        self._get('/')
+        bad = base64.b64encode(b'matt@lp.com:bogus').decode('ascii')
+        good = base64.b64encode(b'matt@lp.com:password').decode('ascii')
+        for _ in range(2):
+            r = self._get('/http', headers={'Authorization': 'Basic ' + bad})
+            self.assertEqual(401, r.status_code)
+        r = self._get('/http', headers={'Authorization': 'Basic ' + good})
+        self.assertEqual(429, r.status_code)
+
+
+class TokenRevocationTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_TOKEN_REVOCATION': True
+    }
+
+    def _get_token(self):
+        r = self.json_authenticate()
+        self.logout()
+        return json.loads(r.data)['response']['user']['authentication_token']
+
+    def _get_token_page(self, token):
+        return self._get('/token', headers={'Authentication-Token': token})
+
+    def test_revoked_token_is_rejected(self):
+        from flask_security.utils import revoke_token
+        token = self._get_token()
+        self.assertIn(b'Token Authentication', self._get_token_page(token).data)
+        with self.app.test_request_context():
+            revoke_token(token)
+        self.assertEqual(401, self._get_token_page(token).status_code)
+
+    def test_revoked_token_skips_datastore(self):
+        from flask_security.utils import revoke_token
+        token = self._get_token()
+        with self.app.test_request_context():
+            revoke_token(token)
+        calls = []
+        datastore = self.app.security.datastore
+        find_user = datastore.find_user
+        datastore.find_user = lambda **kw: calls.append(kw) or find_user(**kw)
+        try:
+            r = self._get_token_page(token)
+        finally:
+            del datastore.find_user
+        self.assertEqual(401, r.status_code)
+        self.assertEqual([], calls)
+
+    def test_revoke_user_tokens(self):
+        from flask_security.passwordless import generate_login_token, \
+            login_token_status
+        from flask_security.utils import revoke_user_tokens
+        token = self._get_token()
+        with self.app.test_request_context():
+            user = self.app.security.datastore.find_user(email='matt@lp.com')
+            login_token = generate_login_token(user)
+            revoke_user_tokens(user)
+            self.assertEqual((False, True, None), login_token_status(login_token))
+        self.assertEqual(401, self._get_token_page(token).status_code)
+
+    def test_other_tokens_are_accepted(self):
+        from flask_security.utils import revoke_token
+        token = self._get_token()
+        with self.app.test_request_context():
+            revoke_token('not-' + token)
+        self.assertIn(b'Token Authentication', self._get_token_page(token).data)
+
+    def test_revocations_are_shared_through_the_store(self):
+        from flask_security.revocation import RevocationList
+        revocations = self.app.security.revocation_list
+        other = RevocationList(revocations.store, refresh_interval=0)
+        other.revoke('token')
+        other.revoke_user(42)
+        revocations.refresh()
+        self.assertTrue(revocations.is_revoked('token', 1, time.time()))
+        self.assertTrue(revocations.is_revoked('x', 42, time.time() - 1))
+        self.assertFalse(revocations.is_revoked('x', 1, time.time()))
+
+    def test_revocations_are_not_evicted(self):
+        revocations = self.app.security.revocation_list
+        for i in range(1000):
+            revocations.revoke('token%d' % i)
+        self.assertTrue(revocations.is_revoked('token0', 1, time.time()))
+
+    def test_expired_revocations_are_compacted(self):
+        from flask_security.revocation import MemoryRevocationStore, \
+            RevocationList
+        store = MemoryRevocationStore()
+        revocations = RevocationList(store, refresh_interval=0, max_age=-1,
+                                     compact_interval=0)
+        revocations.revoke('token')
+        revocations.revoke_user(42)
+        revocations.refresh()
+        self.assertEqual(([], 2), store.read(0))
+        self.assertFalse(revocations.is_revoked('token', 1, time.time()))
+        self.assertFalse(revocations.is_revoked('x', 42, 0))
+
+
+class SQLTokenRevocationTests(TokenRevocationTests):
+
+    def _create_app(self, auth_config, **kwargs):
+        from flask_security.revocation import SQLRevocationStore
+        self.store = SQLRevocationStore('sqlite://')
+        return super(SQLTokenRevocationTests, self)._create_app(
+            auth_config, revocation_store=self.store, **kwargs)
+
+    def test_revocations_survive_restarts(self):
+        from flask_security.revocation import RevocationList
+        from flask_security.utils import revoke_token
+        token = self._get_token()
+        with self.app.test_request_context():
+            revoke_token(token)
+        restarted = RevocationList(self.store)
+        self.assertTrue(restarted.is_revoked(token, 1, time.time()))
+        self.assertFalse(restarted.is_revoked('x', 1, time.time()))
+
+    def test_expired_revocations_are_compacted(self):
+        from flask_security.revocation import RevocationList
+        revocations = RevocationList(self.store, refresh_interval=0,
+                                     max_age=-1, compact_interval=0)
+        revocations.revoke('token')
+        revocations.revoke_user(42)
+        revocations.refresh()
+        entries, version = self.store.read(0)
+        self.assertEqual([], entries)
+        self.assertFalse(revocations.is_revoked('token', 1, time.time()))
+        self.assertFalse(revocations.is_revoked('x', 42, 0))
+
+    def test_late_commits_are_read(self):
+        from flask_security.revocation import RevocationList, get_token_id
+        revocations = RevocationList(self.store, refresh_interval=0)
+        revocations.revoke('first')
+        revocations.revoke('second')
+        revocations.refresh()
+        # a row with a lower version committed after the last read
+        with self.store.engine.begin() as conn:
+            conn.execute(self.store.table.delete().where(
+                self.store.table.c.key == get_token_id('first')))
+            conn.execute(self.store.table.insert().values(
+                version=1, kind='t', key=get_token_id('late'), value=0))
+        other = RevocationList(self.store, refresh_interval=0)
+        other.refresh()
+        self.assertTrue(other.is_revoked('late', 1, time.time()))
+        revocations.refresh()
+        self.assertTrue(revocations.is_revoked('late', 1, time.time()))
+
+    def test_read_version_comes_from_the_read_rows(self):
+        self.store.append('t', 'a', 0, None)
+        entries, version = self.store.read(0)
+        self.assertEqual(1, version)
+        entries, version = self.store.read(5)
+        self.assertEqual(5, version)
+
+
+class TokenStatusesTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_CONFIRMABLE': True
+    }
+
+    def test_token_statuses(self):
+        from flask_security.confirmable import generate_confirmation_token
+        from flask_security.utils import get_token_statuses
+        self._get('/')
+        with self.app.test_request_context():
+            datastore = self.app.security.datastore
+            users = [datastore.find_user(email=email)
+                     for email in ('matt@lp.com', 'joe@lp.com')]
+            tokens = [generate_confirmation_token(user) for user in users]
+            calls = []
+            datastore.find_user = lambda **kw: calls.append(kw)
+            try:
+                statuses = get_token_statuses(tokens + ['bogus'], 'confirm',
+                                              'CONFIRM_EMAIL')
+            finally:
+                del datastore.find_user
+            self.assertEqual([], calls)
+            self.assertEqual([(False, False, users[0]), (False, False, users[1]),
+                              (False, True, None)], statuses)
+
+    def test_find_users_by_id(self):
+        self._get('/')
+        with self.app.test_request_context():
+            datastore = self.app.security.datastore
+            user = datastore.find_user(email='matt@lp.com')
+            users = datastore.find_users_by_id([str(user.id), '9999'])
+            self.assertEqual({str(user.id): user}, users)
+
+
+class LazyUserTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_LAZY_USER': True
+    }
+
+    def setUp(self):
+        super(LazyUserTests, self).setUp()
+
+        @self.app.route('/is_authenticated')
+        def is_authenticated():
+            from flask_security import current_user
+            admin = current_user.is_authenticated() and current_user.has_role('admin')
+            return '%s %s' % (current_user.is_authenticated(), admin)
+
+    def _count_find_user(self, route):
+        calls = []
+        datastore = self.app.security.datastore
+        find_user = datastore.find_user
+        datastore.find_user = lambda **kw: calls.append(kw) or find_user(**kw)
+        try:
+            r = self._get(route)
+        finally:
+            del datastore.find_user
+        return r, len(calls)
+
+    def test_authentication_check_skips_datastore(self):
+        self.authenticate()
+        r, calls = self._count_find_user('/is_authenticated')
+        self.assertEqual(b'True True', r.data)
+        self.assertEqual(0, calls)
+
+    def test_user_is_loaded_on_attribute_access(self):
+        self.authenticate()
+        r, calls = self._count_find_user('/profile')
+        self.assertIn(b'Hello matt@lp.com', r.data)
+        self.assertEqual(1, calls)
+
+    def test_expired_snapshot_is_refreshed(self):
+        self.authenticate()
+        with self.client.session_transaction() as s:
+            s['_security_user']['expires'] = 0
+        r, calls = self._count_find_user('/is_authenticated')
+        self.assertEqual(1, calls)
+        r, calls = self._count_find_user('/is_authenticated')
+        self.assertEqual(0, calls)
+
+    def test_logout_removes_snapshot(self):
+        self.authenticate()
+        self.logout()
+        with self.client.session_transaction() as s:
+            self.assertNotIn('_security_user', s)
+        r, calls = self._count_find_user('/is_authenticated')
+        self.assertEqual(b'False False', r.data)
+
+
+class CompactSessionTests(LazyUserTests):
+
+    AUTH_CONFIG = {
+        'SECURITY_LAZY_USER': True,
+        'SECURITY_SESSION_FORMAT': 'compact',
+        'SECURITY_ROLE_CACHE_SIZE': 100,
+        'SECURITY_CHANGEABLE': True,
+        'SECURITY_SEND_PASSWORD_CHANGE_EMAIL': False
+    }
+
+    def _get_snapshot(self):
+        cookie = [c.value for c in self.client.cookie_jar if c.name == 'session']
+        with self.client.session_transaction() as s:
+            data = s['_security_user']
+        return cookie[0], self.app.security.session_serializer.loads(data)
+
+    def test_session_is_packed(self):
+        self.authenticate()
+        cookie, snapshot = self._get_snapshot()
+        self.assertTrue(len(cookie) < 100)
+        self.assertEqual(1, snapshot['id'])
+        self.assertTrue(snapshot['active'])
+        self.assertNotIn('roles', snapshot)
+
+    def test_cookie_serializer(self):
+        from flask_security.session import CompactCookieSerializer
+        serializer = CompactCookieSerializer()
+        snapshot = dict(id=u'ab', active=False, expires=10, role_version=None,
+                        fingerprint='0123456789abcdef0123')
+        for data in [{}, dict(_fresh=False), dict(user_id=u'1', _id='00ff'),
+                     dict(user_id=u'1', _flashes=[['info', 'Hi']]),
+                     dict(user_id=u'1', _id='not hex'),
+                     dict(user_id=u'2', _security_user=dict(snapshot, id=1))]:
+            self.assertEqual(data, serializer.loads(serializer.dumps(data)))
+        data = dict(user_id=u'ab', _fresh=True, _security_user=snapshot)
+        self.assertEqual(
+            dict(data, _security_user=dict(snapshot, fingerprint='0123456789abcdef')),
+            serializer.loads(serializer.dumps(data)))
+        self.assertEqual(b'\x00', serializer.dumps(data)[:1])
+        self.assertEqual(b'{', serializer.dumps(dict(other=1))[:1])
+
+    def test_expired_snapshot_is_refreshed(self):
+        self.authenticate()
+        serializer = self.app.security.session_serializer
+        data, snapshot = self._get_snapshot()
+        with self.client.session_transaction() as s:
+            s['_security_user'] = serializer.dumps(dict(snapshot, expires=0))
+        r, calls = self._count_find_user('/is_authenticated')
+        self.assertEqual(1, calls)
+        r, calls = self._count_find_user('/is_authenticated')
+        self.assertEqual(0, calls)
+
+    def test_other_session_keys_are_kept(self):
+        self.authenticate()
+        with self.client.session_transaction() as s:
+            s['cart'] = [1, 2]
+        r, calls = self._count_find_user('/is_authenticated')
+        self.assertEqual(b'True True', r.data)
+        self.assertEqual(0, calls)
+        with self.client.session_transaction() as s:
+            self.assertEqual([1, 2], s['cart'])
+
+    def test_role_change_refreshes_snapshot(self):
+        self.authenticate()
+        with self.app.test_request_context():
+            datastore = self.app.security.datastore
+            datastore.remove_role_from_user('matt@lp.com', 'admin')
+            datastore.commit()
+        r, calls = self._count_find_user('/is_authenticated')
+        self.assertEqual(b'True False', r.data)
+        self.assertEqual(1, calls)
+
+    def test_password_change_elsewhere_ends_session(self):
+        from flask_security.utils import encrypt_password, invalidate_role_cache
+        self.authenticate()
+        with self.app.test_request_context():
+            datastore = self.app.security.datastore
+            user = datastore.find_user(email='matt@lp.com')
+            user.password = encrypt_password('newpassword')
+            datastore.put(user)
+            datastore.commit()
+            invalidate_role_cache(user)
+        self.assertEqual(b'False False', self._get('/is_authenticated').data)
+
+    def test_compact_format_requires_role_cache(self):
+        from tests.test_app.sqlalchemy import create_app
+        config = dict(self.AUTH_CONFIG, SECURITY_ROLE_CACHE_SIZE=0)
+        self.assertRaises(ValueError, create_app, config)
+
+    def test_password_change_keeps_session(self):
+        self.authenticate()
+        data = dict(password='password', new_password='newpassword',
+                    new_password_confirm='newpassword')
+        self._post('/change', data=data)
+        with self.app.test_request_context():
+            from flask_security.utils import invalidate_role_cache
+            invalidate_role_cache(1)
+        self.assertEqual(b'True True', self._get('/is_authenticated').data)
+
+
+class SharedRoleCacheTests(CompactSessionTests):
+
+    def _create_app(self, auth_config, **kwargs):
+        from flask_security.cache import LRUCache
+        self.role_cache = LRUCache()
+        return super(SharedRoleCacheTests, self)._create_app(
+            auth_config, role_cache=self.role_cache, **kwargs)
+
+    def test_missing_role_version_is_seeded(self):
+        self.authenticate()
+        with self.client.session_transaction() as s:
+            data = s['_security_user']
+        self.role_cache.clear()
+        r, calls = self._count_find_user('/is_authenticated')
+        self.assertEqual(b'True True', r.data)
+        self.assertEqual(1, calls)
+        with self.client.session_transaction() as s:
+            self.assertEqual(data, s['_security_user'])
+        r, calls = self._count_find_user('/is_authenticated')
+        self.assertEqual(0, calls)
+
+    def test_invalidation_reaches_other_apps(self):
+        from flask_security.utils import invalidate_role_cache
+        other = super(SharedRoleCacheTests, self)._create_app(
+            self.AUTH_CONFIG, role_cache=self.role_cache)
+        self.authenticate()
+        with other.test_request_context():
+            invalidate_role_cache(1)
+        r, calls = self._count_find_user('/is_authenticated')
+        self.assertEqual(1, calls)
+        r, calls = self._count_find_user('/is_authenticated')
+        self.assertEqual(0, calls)
+
+
+class RoleLoadingTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'ROLE_LOADING': 'joined'
+    }
+
+    def _count_queries(self, fn):
+        from sqlalchemy import event
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        engine = self.app.security.datastore.db.engine
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            fn()
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        return len(statements)
+
+    def test_find_user_loads_roles(self):
+        self._get('/')
+        with self.app.test_request_context():
+            datastore = self.app.security.datastore
+            self.assertEqual(1, self._count_queries(
+                lambda: datastore.find_user(email='matt@lp.com').roles))
+            datastore.db.session.expunge_all()
+            self.assertEqual(1, self._count_queries(
+                lambda: datastore.get_user('joe@lp.com').roles))
+
+    def test_find_users_loads_roles_at_once(self):
+        self._get('/')
+        with self.app.test_request_context():
+            datastore = self.app.security.datastore
+            datastore.role_loading = None
+
+            def load():
+                return [(u.email, sorted(r.name for r in u.roles))
+                        for u in datastore.find_users(active=True)]
+
+            self.assertEqual(2, self._count_queries(load))
+            users = dict(load())
+            self.assertEqual(['admin'], users['matt@lp.com'])
+            self.assertTrue(len(users) > 2)
+
+    def test_lazy_roles_by_default(self):
+        self._get('/')
+        with self.app.test_request_context():
+            datastore = self.app.security.datastore
+            datastore.role_loading = None
+            self.assertEqual(2, self._count_queries(
+                lambda: datastore.find_user(email='matt@lp.com').roles))
+
+    def test_unknown_strategy(self):
+        from flask_security import SQLAlchemyUserDatastore
+        datastore = self.app.security.datastore
+        self.assertRaises(ValueError, SQLAlchemyUserDatastore, datastore.db,
+                          datastore.user_model, datastore.role_model,
+                          role_loading='eager')
+
+    def test_selectin_needs_sqlalchemy_1_2(self):
+        import sqlalchemy.orm
+        from flask_security import SQLAlchemyUserDatastore
+        datastore = self.app.security.datastore
+        selectinload = getattr(sqlalchemy.orm, 'selectinload', None)
+        if selectinload is not None:
+            del sqlalchemy.orm.selectinload
+        try:
+            try:
+                SQLAlchemyUserDatastore(datastore.db, datastore.user_model,
+                                        datastore.role_model,
+                                        role_loading='selectin')
+            except ValueError as e:
+                self.assertIn('SQLAlchemy 1.2', str(e))
+            else:
+                self.fail('ValueError not raised')
+        finally:
+            if selectinload is not None:
+                sqlalchemy.orm.selectinload = selectinload
+
+
+class RoleNamesTests(SecurityTest):
+
+    def setUp(self):
+        super(RoleNamesTests, self).setUp()
+        self._get('/')
+        self.ds = self.app.security.datastore
+
+    def test_role_changes_invalidate_role_names(self):
+        with self.app.test_request_context():
+            matt = self.ds.find_user(email='matt@lp.com')
+            self.assertFalse(matt.has_any_role('editor', 'author'))
+            self.ds.add_role_to_user(matt, 'editor')
+            self.assertTrue(matt.has_all_roles('admin', 'editor'))
+            self.ds.remove_role_from_user(matt, 'admin')
+            self.assertFalse(matt.has_role('admin'))
+
+    def test_role_names_in_templates(self):
+        self.authenticate('jill@lp.com')
+        r = self._get('/roles')
+        self.assertNotIn(b'Any of admin and editor', r.data)
+        self.assertNotIn(b'All of admin and editor', r.data)
+        self._get('/logout')
+        self.authenticate('matt@lp.com')
+        r = self._get('/roles')
+        self.assertIn(b'Any of admin and editor', r.data)
+        self.assertNotIn(b'All of admin and editor', r.data)
+        self._get('/logout')
+        self.authenticate('dave@lp.com')
+        r = self._get('/roles')
+        self.assertIn(b'All of admin and editor', r.data)
+
+    def test_bulk_role_changes_invalidate_current_user(self):
+        from flask import _request_ctx_stack
+        with self.app.test_request_context():
+            matt = self.ds.find_user(email='matt@lp.com')
+            _request_ctx_stack.top.user = matt
+            self.assertFalse(matt.has_role('editor'))
+            self.ds.add_role_to_users(['matt@lp.com'], 'editor')
+            self.ds.commit()
+            self.assertTrue(matt.has_role('editor'))
+
+
+class ServerSessionTests(SecurityTest):
+
+    AUTH_CONFIG = {
+        'SECURITY_SERVER_SESSION': True,
+        'SECURITY_TOKEN_REVOCATION': True
+    }
+
+    def _get_sid(self, client=None):
+        for cookie in (client or self.client).cookie_jar:
+            if cookie.name == self.app.session_cookie_name:
+                return cookie.value
+
+    def _get_stored(self, sid):
+        interface = self.app.security.session_interface
+        return interface.store.get(interface.key_prefix + sid)
+
+    def test_session_is_stored_server_side(self):
+        self.authenticate()
+        sid = self._get_sid()
+        self.assertTrue(len(sid) < 64)
+        self.assertIn(b'user_id', self._get_stored(sid))
+        self.assertIn(b'Hello matt@lp.com', self._get('/profile').data)
+
+    def test_login_and_logout_move_the_session(self):
+        self._get('/login')
+        anonymous_sid = self._get_sid()
+        self.authenticate()
+        sid = self._get_sid()
+        self.assertNotEqual(anonymous_sid, sid)
+        self.logout()
+        self.assertNotEqual(sid, self._get_sid())
+        self.assertIsNone(self._get_stored(sid))
+
+    def test_revoke_user_sessions(self):
+        from flask_security.utils import revoke_user_sessions
+        other = self.app.test_client()
+        self.authenticate()
+        other.post('/login', data=dict(email='matt@lp.com', password='password'))
+        self.assertIn(b'Hello matt@lp.com', other.get('/profile').data)
+        with self.app.test_request_context():
+            revoke_user_sessions(self.app.security.datastore.find_user(
+                email='matt@lp.com'))
+        for client in (self.client, other):
+            r = client.get('/profile', follow_redirects=True)
+            self.assertNotIn(b'Hello matt@lp.com', r.data)
+        self.authenticate()
+        self.assertIn(b'Hello matt@lp.com', self._get('/profile').data)
+
+    def test_expired_sessions_are_swept(self):
+        from flask_security.session import MemorySessionStore
+        store = MemorySessionStore()
+        store.setex('a', -1, b'x')
+        store.setex('b', 60, b'y')
+        self.assertIsNone(store.get('a'))
+        self.assertEqual(1, store.sweep())
+        self.assertEqual(b'y', store.get('b'))
+
+
+class SQLServerSessionTests(ServerSessionTests):
+
+    def _create_app(self, auth_config, **kwargs):
+        from flask_security.session import SQLSessionStore
+        self.store = SQLSessionStore('sqlite://')
+        return super(SQLServerSessionTests, self)._create_app(
+            auth_config, session_store=self.store, **kwargs)
+
+    def test_store(self):
+        self.store.setex('a', 60, b'x')
+        self.store.setex('a', 60, b'y')
+        self.assertEqual(b'y', self.store.get('a'))
+        self.assertEqual(1, self.store.incr('n'))
+        self.assertEqual(2, self.store.incr('n'))
+        self.store.delete('a', 'n')
+        self.assertIsNone(self.store.get('a'))
+
+    def test_expired_sessions_are_swept(self):
+        self.store.setex('a', -1, b'x')
+        self.store.setex('b', 60, b'y')
+        self.store.incr('n')
+        self.assertIsNone(self.store.get('a'))
+        self.assertEqual(1, self.store.sweep())
+        self.assertEqual(b'y', self.store.get('b'))
+        self.assertEqual(b'1', self.store.get('n'))
+
+    def test_concurrent_increments(self):
+        import os
+        import tempfile
+        import threading
+        from flask_security.session import SQLSessionStore
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        try:
+            store = SQLSessionStore('sqlite:///' + path)
+            results = []
+
+            def increment():
+                for _ in range(10):
+                    results.append(store.incr('n'))
+
+            threads = [threading.Thread(target=increment) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(list(range(1, 41)), sorted(results))
+            self.assertEqual(b'40', store.get('n'))
+            store.engine.dispose()
+        finally:
+            os.remove(path)
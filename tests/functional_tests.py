@@ -247,6 +247,13 @@ class PeeweeSecurityTests(DefaultSecurityTests):
         return create_app(auth_config, **kwargs)
 
 
+class CachedDatastoreSecurityTests(DefaultSecurityTests):
+
+    AUTH_CONFIG = {
+        'USER_CACHE': True
+    }
+
+
 class DefaultDatastoreTests(SecurityTest):
 
     def test_add_role_to_user(self):
@@ -270,6 +277,13 @@ class DefaultDatastoreTests(SecurityTest):
         self.assertIn(b'success', r.data)
 
 
+class CachedDatastoreTests(DefaultDatastoreTests):
+
+    AUTH_CONFIG = {
+        'USER_CACHE': True
+    }
+
+
 class MongoEngineDatastoreTests(DefaultDatastoreTests):
 
     def _create_app(self, auth_config, **kwargs):
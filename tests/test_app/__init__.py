@@ -81,6 +81,11 @@ def create_app(config):
     def admin_or_editor():
         return render_template('index.html', content='Admin or Editor Page')
 
+    @app.route('/roles')
+    @login_required
+    def roles():
+        return render_template('roles.html')
+
     @app.route('/unauthorized')
     def unauthorized():
         return render_template('unauthorized.html')
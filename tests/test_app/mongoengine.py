@@ -16,11 +16,11 @@ from tests.test_app import create_app as create_base_app, populate_data, \
 def create_app(config, **kwargs):
     app = create_base_app(config)
 
-    app.config['MONGODB_SETTINGS'] = dict(
+    app.config.setdefault('MONGODB_SETTINGS', dict(
         db='flask_security_test',
         host='localhost',
         port=27017
-    )
+    ))
 
     db = MongoEngine(app)
 
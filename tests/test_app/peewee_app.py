@@ -17,10 +17,10 @@ from tests.test_app import create_app as create_base_app, populate_data, \
 
 def create_app(config, **kwargs):
     app = create_base_app(config)
-    app.config['DATABASE'] = {
+    app.config.setdefault('DATABASE', {
         'name': 'peewee.db',
         'engine': 'peewee.SqliteDatabase'
-    }
+    })
     db = Database(app)
 
     class Role(db.Model, RoleMixin):
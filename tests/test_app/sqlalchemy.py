@@ -9,7 +9,7 @@ sys.path.insert(0, os.getcwd())
 
 from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.security import Security, UserMixin, RoleMixin, \
-     SQLAlchemyUserDatastore
+     SQLAlchemyUserDatastore, CachedUserDatastore
 
 from tests.test_app import create_app as create_base_app, populate_data, \
      add_context_processors
@@ -50,7 +50,12 @@ def create_app(config, **kwargs):
         db.create_all()
         populate_data(app.config.get('USER_COUNT', None))
 
-    app.security = Security(app, datastore=SQLAlchemyUserDatastore(db, User, Role), **kwargs)
+    datastore = SQLAlchemyUserDatastore(db, User, Role,
+                                        role_loading=app.config.get('ROLE_LOADING'))
+    if app.config.get('USER_CACHE', False):
+        datastore = CachedUserDatastore(datastore)
+
+    app.security = Security(app, datastore=datastore, **kwargs)
 
     add_context_processors(app.security)
 
@@ -37,10 +37,33 @@ class SecurityEntityTests(unittest.TestCase):
     def test_user_mixin_has_role_with_role_obj(self):
         self.assertTrue(user.has_role(Role('admin')))
 
+    def test_user_mixin_has_any_role(self):
+        self.assertTrue(user.has_any_role('author', Role('editor')))
+        self.assertFalse(user.has_any_role('author', 'reader'))
+        self.assertFalse(user.has_any_role())
+
+    def test_user_mixin_has_all_roles(self):
+        self.assertTrue(user.has_all_roles('admin', Role('editor')))
+        self.assertFalse(user.has_all_roles('admin', 'author'))
+        self.assertTrue(user.has_all_roles())
+
+    def test_user_mixin_role_names_are_cached(self):
+        u = User('joe@lp.com', [admin])
+        self.assertTrue(u.has_role('admin'))
+        u.roles = [editor]
+        self.assertTrue(u.has_role('admin'))
+        self.assertFalse(u.has_role('editor'))
+
+    def test_role_mixin_hash(self):
+        self.assertEqual(1, len(set([admin, admin2])))
+        self.assertTrue('admin' in set([admin, editor]))
+
     def test_anonymous_user_has_no_roles(self):
         au = AnonymousUser()
         self.assertEqual(0, len(au.roles))
         self.assertFalse(au.has_role('admin'))
+        self.assertFalse(au.has_any_role('admin'))
+        self.assertFalse(au.has_all_roles('admin'))
 
 
 class DatastoreTests(unittest.TestCase):
@@ -86,3 +109,40 @@ class DatastoreTests(unittest.TestCase):
     def test_activate_returns_false_if_already_true(self):
         user.active = True
         self.assertFalse(self.ds.activate_user(user))
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        super(LRUCacheTests, self).setUp()
+        from flask_security.cache import LRUCache
+        self.cache = LRUCache(threshold=2, default_timeout=300)
+
+    def test_get_and_set(self):
+        self.assertEqual(None, self.cache.get('a'))
+        self.cache.set('a', 1)
+        self.assertEqual(1, self.cache.get('a'))
+
+    def test_least_recently_used_is_discarded(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertEqual(None, self.cache.get('b'))
+        self.assertEqual(2, len(self.cache))
+
+    def test_expired_items_are_not_returned(self):
+        self.cache.set('a', 1, timeout=-1)
+        self.assertEqual(None, self.cache.get('a'))
+
+    def test_add_does_not_overwrite(self):
+        self.assertTrue(self.cache.add('a', 1))
+        self.assertFalse(self.cache.add('a', 2))
+        self.assertEqual(1, self.cache.get('a'))
+
+    def test_inc_and_delete(self):
+        self.assertEqual(1, self.cache.inc('a'))
+        self.assertEqual(3, self.cache.inc('a', 2))
+        self.assertTrue(self.cache.delete('a'))
+        self.assertFalse(self.cache.delete('a'))